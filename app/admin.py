@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib.contenttypes.admin import GenericTabularInline
 
-from .models import TelegramUser, ResourceCollection, Guild, Notification, TemporaryNPC, GuildMembership
+from .models import TelegramUser, ResourceCollection, Guild, Notification, TemporaryNPC, GuildMembership, AuditRecord
 
 
 @admin.register(TelegramUser)
@@ -68,3 +68,19 @@ class TemporaryNPCAdmin(admin.ModelAdmin):
     list_display = ('pk', 'caption', 'in_guild', 'at', 'by')
     list_filter = ('in_guild',)
     inlines = [NotificationInline]
+
+
+@admin.register(AuditRecord)
+class AuditRecordAdmin(admin.ModelAdmin):
+    list_display = ('time', 'action', 'model', 'object_id', 'fields')
+    list_filter = ('action', 'model')
+    search_fields = ['=object_id']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
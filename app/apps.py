@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class AppConfig(AppConfig):
     name = 'app'
+
+    def ready(self):
+        from app import audit, npc_list
+        audit.connect()
+        npc_list.connect()
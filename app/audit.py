@@ -0,0 +1,144 @@
+"""
+audit trail of model changes. post_save/post_delete receivers only append a record to an in-process buffer; a
+background thread writes the buffer in batches (every AUDIT['FLUSH_INTERVAL'] seconds or as soon as
+AUDIT['BATCH_SIZE'] records are waiting) to the AuditRecord table ('db' sink) or to the 'app.audit' logger
+('log' sink). Records still buffered at exit are written by an atexit hook and before a fork (the stock rq worker
+forks a child per job), the child starts with an empty buffer. A forked child leaves with os._exit and loses its
+unflushed records
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+from collections import deque
+
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+sink_logger = logging.getLogger('app.audit')
+
+DEFAULT_MODELS = ('app.TelegramUser', 'app.Guild', 'app.GuildMembership', 'app.ResourceCollection',
+                  'app.TemporaryNPC')
+
+
+def _config():
+    return getattr(settings, 'AUDIT', {})
+
+
+class AuditTrail(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._buffer = deque()
+        self._thread = None
+        self._pid = None
+        self.dropped = 0
+
+    def add(self, action, instance, fields=None):
+        config = _config()
+        record = {
+            'time': timezone.now(),
+            'action': action,
+            'model': instance._meta.label_lower,
+            'object_id': instance.pk,
+            'fields': sorted(fields) if fields else None,
+        }
+        maxsize = config.get('MAXSIZE', 10000)
+        with self._lock:
+            if len(self._buffer) >= maxsize:
+                self._buffer.popleft()
+                self.dropped += 1
+            self._buffer.append(record)
+            size = len(self._buffer)
+        if config.get('BACKGROUND', True):
+            self._ensure_thread()
+            if size >= config.get('BATCH_SIZE', 100):
+                self._wakeup.set()
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='audit', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(_config().get('FLUSH_INTERVAL', 5))
+            self._wakeup.clear()
+            self.flush()
+            close_old_connections()
+
+    def flush(self):
+        """writes the buffered records, returns their number"""
+        batch_size = _config().get('BATCH_SIZE', 100)
+        written = 0
+        while True:
+            with self._lock:
+                records = [self._buffer.popleft() for _ in range(min(batch_size, len(self._buffer)))]
+            if not records:
+                return written
+            try:
+                self._write(records)
+            except Exception as e:
+                logger.warning(f'can\'t write {len(records)} audit records: {e}')
+                with self._lock:
+                    self._buffer.extendleft(reversed(records))
+                return written
+            written += len(records)
+
+    @staticmethod
+    def _write(records):
+        if _config().get('SINK', 'db') == 'log':
+            for r in records:
+                sink_logger.info(json.dumps(dict(r, time=r['time'].isoformat())))
+            return
+        from app.models import AuditRecord
+        AuditRecord.objects.bulk_create([
+            AuditRecord(time=r['time'], action=r['action'], model=r['model'], object_id=r['object_id'],
+                        fields=','.join(r['fields']) if r['fields'] else None)
+            for r in records
+        ])
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._buffer.clear()
+        self._thread = None
+
+
+trail = AuditTrail()
+atexit.register(trail.flush)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=trail.flush, after_in_child=trail._after_fork)
+
+
+def _enabled():
+    return _config().get('ENABLED', True)
+
+
+def on_save(sender, instance, created, update_fields=None, raw=False, **kwargs):
+    if raw or not _enabled():
+        return
+    trail.add('created' if created else 'changed', instance, None if created else update_fields)
+
+
+def on_delete(sender, instance, **kwargs):
+    if _enabled():
+        trail.add('deleted', instance)
+
+
+def connect():
+    """connects the receivers to AUDIT['MODELS'] (called from AppConfig.ready)"""
+    for label in _config().get('MODELS', DEFAULT_MODELS):
+        model = apps.get_model(label)
+        post_save.connect(on_save, sender=model, dispatch_uid=f'audit_save_{label}')
+        post_delete.connect(on_delete, sender=model, dispatch_uid=f'audit_delete_{label}')
@@ -0,0 +1,129 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+
+from app.connections import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """
+    thread safe mapping with a size limit (the least recently used entries are evicted) and a time to live.
+    Entries older than `ttl` seconds are treated as missing, so changes made by other processes are picked up
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            return value if expires >= time.monotonic() else default
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class Invalidation(object):
+    """
+    deletes keys of named caches in the other processes through redis pub/sub, so processes which cache the same
+    rows (shards of the bot) see each other's changes at once instead of after the TTL. Off until `start()`
+    """
+
+    CHANNEL = 'app:cache:invalidate'
+
+    def __init__(self, queue_name='default'):
+        self.queue_name = queue_name
+        self.caches = {}
+        self.origin = uuid.uuid4().hex
+        self.running = False
+        self._thread = None
+
+    def register(self, name, cache):
+        self.caches[name] = cache
+
+    def publish(self, name, key):
+        if not self.running:
+            return
+        message = json.dumps({'origin': self.origin, 'cache': name, 'key': key})
+        try:
+            get_redis(self.queue_name).publish(self.CHANNEL, message)
+        except RedisError as e:
+            logger.warning(f'can\'t publish invalidation of {name} {key}: {e}')
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._thread = threading.Thread(target=self._listen, name='cache-invalidation', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        if self._thread is not None:
+            self._thread.join()
+
+    def _listen(self):
+        while self.running:
+            try:
+                pubsub = get_redis(self.queue_name).pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.CHANNEL)
+                while self.running:
+                    message = pubsub.get_message(timeout=1)
+                    if message is not None:
+                        self.apply(json.loads(message['data']))
+                pubsub.close()
+            except RedisError as e:
+                logger.warning(f'cache invalidation listener: {e}')
+                time.sleep(1)
+
+    def apply(self, message):
+        if message['origin'] == self.origin:
+            return
+        cache = self.caches.get(message['cache'])
+        if cache is not None:
+            key = message['key']
+            # json has no tuples
+            cache.delete(tuple(key) if isinstance(key, list) else key)
+
+
+invalidation = Invalidation()
@@ -0,0 +1,33 @@
+import threading
+
+from django.conf import settings
+from redis import ConnectionPool, Redis
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(queue_name='default'):
+    """one ConnectionPool per RQ_QUEUES entry for the whole process"""
+    pool = _pools.get(queue_name)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(queue_name)
+            if pool is None:
+                config = settings.RQ_QUEUES[queue_name]
+                if 'URL' in config:
+                    pool = ConnectionPool.from_url(config['URL'], db=config.get('DB'))
+                else:
+                    pool = ConnectionPool(
+                        host=config.get('HOST', 'localhost'),
+                        port=config.get('PORT', 6379),
+                        db=config.get('DB', 0),
+                        password=config.get('PASSWORD') or None,
+                        socket_timeout=config.get('SOCKET_TIMEOUT'),
+                    )
+                _pools[queue_name] = pool
+    return pool
+
+
+def get_redis(queue_name='default'):
+    return Redis(connection_pool=get_connection_pool(queue_name))
@@ -0,0 +1,102 @@
+import logging
+from queue import Queue
+from threading import Thread
+
+from django.conf import settings
+from django.db import close_old_connections
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, JobQueue
+
+from app.tracing import TracedRequest
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrentDispatcher(Dispatcher):
+    """
+    processes updates of different chats in parallel with `update_workers` threads. Every chat is pinned to one
+    worker (chat id modulo number of workers), so updates of one chat - and callback queries of its messages - are
+    handled in the order they came. Worker queues are bounded: when a worker falls behind, the dispatcher thread
+    blocks on it and the update queue fills up (which is what webhook backpressure relies on)
+    """
+
+    def __init__(self, *args, update_workers=4, worker_queue_size=100, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.update_workers = update_workers
+        self._worker_queues = [Queue(maxsize=worker_queue_size) for _ in range(update_workers)]
+        self._worker_threads = []
+
+    @staticmethod
+    def get_key(update):
+        """chat id (or user id for updates without a chat) which defines the order, None for other objects"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    def process_update(self, update):
+        key = self.get_key(update)
+        if key is None or not self._worker_threads:
+            # errors from the updater and anything processed before start() are handled in place
+            super().process_update(update)
+            return
+        self._worker_queues[key % self.update_workers].put(update)
+
+    def start(self, ready=None):
+        if not self._worker_threads:
+            for i, queue in enumerate(self._worker_queues):
+                thread = self._init_worker(queue, 'update_worker_{}'.format(i))
+                self._worker_threads.append(thread)
+        super().start(ready)
+
+    def stop(self):
+        super().stop()
+        for queue in self._worker_queues:
+            queue.put(None)
+        for thread in self._worker_threads:
+            thread.join()
+        self._worker_threads = []
+
+    def _init_worker(self, queue, name):
+        thread = Thread(target=self._work, args=(queue,), name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def _work(self, queue):
+        while True:
+            update = queue.get()
+            if update is None:
+                return
+            close_old_connections()
+            try:
+                Dispatcher.process_update(self, update)
+            except Exception:
+                logger.exception('update {} failed'.format(getattr(update, 'update_id', update)))
+            finally:
+                close_old_connections()
+                queue.task_done()
+
+
+def build_dispatcher(update_workers=1, queue_size=0, shards=None):
+    """
+    bot, update queue and job queue from settings wired into a dispatcher: ConcurrentDispatcher when
+    `update_workers` > 1, the plain sequential one otherwise, ShardRouter when `shards` is given.
+    `queue_size` bounds the update queue (0 - unbounded)
+    """
+    async_workers = 4
+    bot = Bot(settings.TELEGRAM_TOKEN, base_url=getattr(settings, 'TELEGRAM_BASE_URL', None),
+              request=TracedRequest(con_pool_size=async_workers + update_workers + 4))
+    job_queue = JobQueue()
+    kwargs = {'job_queue': job_queue, 'workers': async_workers, 'use_context': True}
+    if shards:
+        from app.sharding import ShardRouter
+        dispatcher = ShardRouter(bot, Queue(maxsize=queue_size), shards=shards, **kwargs)
+    elif update_workers > 1:
+        dispatcher = ConcurrentDispatcher(bot, Queue(maxsize=queue_size), update_workers=update_workers, **kwargs)
+    else:
+        dispatcher = Dispatcher(bot, Queue(maxsize=queue_size), **kwargs)
+    job_queue.set_dispatcher(dispatcher)
+    return dispatcher
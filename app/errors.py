@@ -0,0 +1,166 @@
+"""
+error reports for developers. Handlers only register an exception: it gets a fingerprint (exception type and the
+innermost traceback frame of the project's code) and is counted. A background thread sends at most one digest per
+fingerprint every ERROR_REPORTING['INTERVAL'] seconds - the first occurrence right away, repeats as a count with
+the last sample - so an error storm doesn't block the dispatcher or flood the bot. Recent samples are kept in a ring
+buffer of ERROR_REPORTING['SAMPLES'] entries
+"""
+import html
+import logging
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from telegram import ParseMode, constants
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+MAX_FINGERPRINTS = 1000
+
+
+def _location(tb):
+    """innermost frame of the project's code (the innermost one at all if there is none) as 'file:line in func'"""
+    frames = traceback.extract_tb(tb)
+    if not frames:
+        return 'unknown'
+    own = [f for f in frames if f.filename.startswith(settings.BASE_DIR) and 'site-packages' not in f.filename]
+    frame = (own or frames)[-1]
+    return f'{os.path.relpath(frame.filename, settings.BASE_DIR)}:{frame.lineno} in {frame.name}'
+
+
+class ErrorStats(object):
+    def __init__(self, error_type, location):
+        self.error_type = error_type
+        self.location = location
+        self.total = 0
+        self.pending = 0  # occurrences since the last digest
+        self.last_digest = None
+        self.last_message = ''
+        self.last_details = ''
+        self.last_trace = ''
+
+
+class ErrorReporter(object):
+    def __init__(self, send, interval=300, samples=100, background=True):
+        self.send = send
+        self.interval = interval
+        self.samples = deque(maxlen=samples)  # (time, fingerprint, message, details)
+        self.background = background
+        self._stats = OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_settings(cls):
+        from app.sender import get_sender
+        config = getattr(settings, 'ERROR_REPORTING', {})
+        chats = config.get('CHATS', [])
+
+        def send(text, chats=chats):
+            for chat_id in chats:
+                try:
+                    get_sender().send_message(chat_id, text, parse_mode=ParseMode.HTML)
+                except RetryAfter as e:
+                    # there is no JobQueue in the reporter's thread, the digest is repeated for this chat only
+                    logger.info(f'flood control in chat {chat_id}, error digest deferred by {e.retry_after}s')
+                    timer = threading.Timer(e.retry_after, send, (text, [chat_id]))
+                    timer.daemon = True
+                    timer.start()
+                except Exception as e:
+                    logger.error(f'can\'t send error digest to chat {chat_id} due to "{e}":\n{text}')
+        return cls(send, interval=config.get('INTERVAL', 300), samples=config.get('SAMPLES', 100))
+
+    def report(self, error, details=''):
+        """registers `error` (raised, with __traceback__) and returns its fingerprint"""
+        error_type = type(error).__name__
+        location = _location(error.__traceback__)
+        fingerprint = f'{error_type} at {location}'
+        now = time.time()
+        with self._lock:
+            stats = self._stats.get(fingerprint)
+            if stats is None:
+                if len(self._stats) >= MAX_FINGERPRINTS:
+                    self._stats.popitem(last=False)
+                stats = self._stats[fingerprint] = ErrorStats(error_type, location)
+            else:
+                self._stats.move_to_end(fingerprint)
+            stats.total += 1
+            stats.pending += 1
+            stats.last_message = str(error)[:500]
+            stats.last_details = details
+            if stats.pending == 1:
+                stats.last_trace = ''.join(traceback.format_tb(error.__traceback__))
+            self.samples.append((now, fingerprint, stats.last_message, details))
+            first = stats.last_digest is None and stats.pending == 1
+        if self.background:
+            self._ensure_thread()
+            if first:
+                self._wakeup.set()
+        return fingerprint
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='error_reporter', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(1)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self, now=None):
+        """sends the due digests, returns their number"""
+        now = now or time.time()
+        digests = []
+        with self._lock:
+            for stats in self._stats.values():
+                if stats.pending and (stats.last_digest is None or now - stats.last_digest >= self.interval):
+                    digests.append(self.render(stats, now))
+                    stats.pending = 0
+                    stats.last_digest = now
+        for text in digests:
+            try:
+                self.send(text)
+            except Exception as e:
+                logger.error(f'can\'t send error digest due to "{e}":\n{text}')
+        return len(digests)
+
+    def render(self, stats, now):
+        e = html.escape
+        if stats.last_digest is None:
+            header = f'The error <code>{e(stats.error_type)}: {e(stats.last_message)}</code> happened'
+        else:
+            header = f'The error <code>{e(stats.error_type)}</code> repeated {stats.pending} times in the last ' \
+                     f'{now - stats.last_digest:.0f}s ({stats.total} since start), the last one: ' \
+                     f'<code>{e(stats.last_message)}</code>'
+        trace = stats.last_trace
+        while True:
+            text = f'{header}{stats.last_details} at <code>{e(stats.location)}</code>. The traceback:\n\n<pre>' \
+                   f'<code class="language-python">{e(trace)}</code></pre>'
+            if len(text) <= constants.MAX_MESSAGE_LENGTH or len(trace) <= 3:
+                break
+            # keep the innermost frames
+            trace = '...' + trace[len(text) - constants.MAX_MESSAGE_LENGTH + 3:]
+        return text
+
+
+_reporter = None
+_reporter_lock = threading.Lock()
+
+
+def get_reporter():
+    """process-wide ErrorReporter built from settings on the first call"""
+    global _reporter
+    if _reporter is None:
+        with _reporter_lock:
+            if _reporter is None:
+                _reporter = ErrorReporter.from_settings()
+    return _reporter
@@ -0,0 +1,126 @@
+"""local stand-in for the Telegram Bot API endpoints used by the bot, for benchmarks and tests"""
+import itertools
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+BOT_ID = 1000
+BOT_USERNAME = 'fake_influence_bot'
+
+
+class FakeBotAPI(object):
+    """
+    answers like Bot API: `getMe`, `getMyCommands`, `sendMessage`, `editMessageText`, `answerCallbackQuery`, `getChatMember`,
+    `promoteChatMember` and `setChatAdministratorCustomTitle`. The bot is an administrator with all rights in every
+    chat, everybody else is a plain member. `latency` seconds are slept before every answer
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    data = json.loads(body or b'{}')
+                else:
+                    data = dict(parse_qsl(body.decode()))
+                self.respond(data)
+
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                self.respond(dict(parse_qsl(query)), path)
+
+            def respond(self, data, path=None):
+                method = (path or self.path).rsplit('/', 1)[-1]
+                payload = json.dumps(api.answer(method, data)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-bot-api', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def answer(self, method, data):
+        with self._lock:
+            self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        handler = getattr(self, f'answer_{method}', None)
+        if handler is None:
+            return {'ok': False, 'error_code': 404, 'description': f'Not Found: method {method} not found'}
+        return {'ok': True, 'result': handler(data)}
+
+    def user(self, user_id):
+        user_id = int(user_id)
+        if user_id == BOT_ID:
+            return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bot', 'username': BOT_USERNAME}
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+    def message(self, data):
+        chat_id = int(data.get('chat_id', 0))
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup', 'title': 'chat'},
+            'from': self.user(BOT_ID),
+            'text': data.get('text', ''),
+        }
+
+    def answer_getMe(self, data):
+        return self.user(BOT_ID)
+
+    def answer_getMyCommands(self, data):
+        return []
+
+    def answer_sendMessage(self, data):
+        return self.message(data)
+
+    def answer_editMessageText(self, data):
+        return self.message(data)
+
+    def answer_answerCallbackQuery(self, data):
+        return True
+
+    def answer_getChatMember(self, data):
+        if int(data['user_id']) == BOT_ID:
+            return {'user': self.user(BOT_ID), 'status': 'administrator', 'can_promote_members': True,
+                    'can_change_info': True}
+        return {'user': self.user(data['user_id']), 'status': 'member'}
+
+    def answer_promoteChatMember(self, data):
+        return True
+
+    def answer_setChatAdministratorCustomTitle(self, data):
+        return True
@@ -0,0 +1,109 @@
+"""
+pending interactions: a message with a keyboard waits for the user's button press to finish a command. The store
+keeps (handler name, args) by (chat id, message id) of that message; entries expire after TTL seconds and the
+oldest ones are evicted above MAXSIZE
+"""
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from app.cache import LRUCache
+from app.connections import get_redis
+
+
+class BaseInteractionStore(object):
+    def __init__(self, maxsize=10000, ttl=24 * 60 * 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+    def put(self, chat_id, message_id, handler_name, args):
+        raise NotImplementedError
+
+    def pop(self, chat_id, message_id):
+        """(handler name, args) or None if there is no such interaction or it has expired"""
+        raise NotImplementedError
+
+
+class MemoryInteractionStore(BaseInteractionStore):
+    """process local, lost on restart"""
+
+    def __init__(self, maxsize=10000, ttl=24 * 60 * 60):
+        super().__init__(maxsize, ttl)
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def put(self, chat_id, message_id, handler_name, args):
+        self._cache.set((int(chat_id), int(message_id)), (handler_name, list(args)))
+
+    def pop(self, chat_id, message_id):
+        return self._cache.pop((int(chat_id), int(message_id)))
+
+
+class RedisInteractionStore(BaseInteractionStore):
+    """
+    shared by every bot process and survives restarts. Each interaction is a key with TTL; a sorted set by
+    expiration time is the index used to evict the oldest interactions above `maxsize`
+    """
+    PREFIX = 'app:interaction:'
+    INDEX_KEY = 'app:interactions'
+
+    def __init__(self, maxsize=10000, ttl=24 * 60 * 60, queue_name='default'):
+        super().__init__(maxsize, ttl)
+        self.queue_name = queue_name
+
+    def key(self, chat_id, message_id):
+        return f'{self.PREFIX}{int(chat_id)}:{int(message_id)}'
+
+    def put(self, chat_id, message_id, handler_name, args):
+        redis = get_redis(self.queue_name)
+        key = self.key(chat_id, message_id)
+        now = time.time()
+        with redis.pipeline() as pipe:
+            pipe.set(key, json.dumps([handler_name, list(args)]), ex=self.ttl)
+            pipe.zadd(self.INDEX_KEY, {key: now + self.ttl})
+            pipe.zremrangebyscore(self.INDEX_KEY, '-inf', now)
+            pipe.zcard(self.INDEX_KEY)
+            size = pipe.execute()[-1]
+        if size > self.maxsize:
+            with redis.pipeline() as pipe:
+                pipe.zrange(self.INDEX_KEY, 0, size - self.maxsize - 1)
+                pipe.zremrangebyrank(self.INDEX_KEY, 0, size - self.maxsize - 1)
+                evicted = pipe.execute()[0]
+            if evicted:
+                redis.delete(*evicted)
+
+    def pop(self, chat_id, message_id):
+        key = self.key(chat_id, message_id)
+        with get_redis(self.queue_name).pipeline() as pipe:
+            pipe.get(key)
+            pipe.delete(key)
+            pipe.zrem(self.INDEX_KEY, key)
+            value = pipe.execute()[0]
+        if value is None:
+            return None
+        handler_name, args = json.loads(value)
+        return handler_name, args
+
+
+_store = None
+_store_lock = threading.Lock()
+
+BACKENDS = {
+    'memory': 'app.interactions.MemoryInteractionStore',
+    'redis': 'app.interactions.RedisInteractionStore',
+}
+
+
+def get_interactions():
+    """process-wide store chosen by PENDING_INTERACTIONS setting"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = getattr(settings, 'PENDING_INTERACTIONS', {})
+                name = config.get('BACKEND', 'memory')
+                _store = import_string(BACKENDS.get(name, name))(
+                    maxsize=config.get('MAXSIZE', 10000), ttl=config.get('TTL', 24 * 60 * 60))
+    return _store
@@ -0,0 +1,119 @@
+"""
+logging pipeline pieces used by LOGGING: records are put into a queue by the calling thread and written to files by
+a background listener thread, so handlers never wait for the disk or for rotation
+"""
+import atexit
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from logging.config import ConvertingList
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from queue import Full, Queue
+
+
+class QueueListenerHandler(QueueHandler):
+    """
+    puts records into a bounded queue (dropping them when it is full) and runs a QueueListener which passes them
+    to `handlers`. In LOGGING the handlers are given as 'cfg://handlers.<name>' and must sort before this one
+    """
+
+    def __init__(self, handlers, maxsize=10000, respect_handler_level=True):
+        super().__init__(Queue(maxsize=maxsize))
+        if isinstance(handlers, ConvertingList):
+            handlers = [handlers[i] for i in range(len(handlers))]
+        self.handlers = handlers
+        self.respect_handler_level = respect_handler_level
+        self.dropped = 0
+        self._listener = None
+        self.start()
+        atexit.register(self.stop)
+        if hasattr(os, 'register_at_fork'):
+            # the listener thread doesn't survive fork (rq's forking worker), the child needs its own one
+            os.register_at_fork(after_in_child=self._restart)
+
+    def start(self):
+        self._listener = QueueListener(self.queue, *self.handlers, respect_handler_level=self.respect_handler_level)
+        self._listener.start()
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def _restart(self):
+        self.queue = Queue(maxsize=self.queue.maxsize)
+        self.start()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    lets through at most `rate` records per `per` seconds from every logger. The first record after a dropped
+    series mentions how many were dropped
+    """
+
+    def __init__(self, rate=100, per=1.0):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self._lock = threading.Lock()
+        self._windows = {}  # logger name -> [window start, records in the window, dropped]
+
+    def filter(self, record):
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.setdefault(record.name, [now, 0, 0])
+            if now - window[0] >= self.per:
+                window[0], window[1] = now, 0
+            if window[1] >= self.rate:
+                window[2] += 1
+                return False
+            window[1] += 1
+            dropped, window[2] = window[2], 0
+        if dropped:
+            record.msg = f'({dropped} records dropped by rate limit) {record.getMessage()}'
+            record.args = None
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """one JSON object per line"""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+    def formatTime(self, record, datefmt=None):
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + '.%03d' % record.msecs
+
+
+class GzipTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """TimedRotatingFileHandler which compresses rotated files"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self._compress
+
+    @staticmethod
+    def _compress(source, dest):
+        with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections, close_old_connections
+from django.test.utils import override_settings
+from django.utils import timezone
+from telegram import User as ApiUser
+
+from app.models import TelegramUser, Guild, GuildMembership, ResourceCollection, Notification
+from app.writes import writer
+
+ROLES = ('bot', 'worker', 'scheduler')
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0
+
+
+class Command(BaseCommand):
+    help = 'the bot, the worker and the scheduler as three processes writing one sqlite file: operations per ' \
+           'second, latency and "database is locked" errors for every DATABASE_PROFILES entry with WRITE_BATCHING ' \
+           'off and on'
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', nargs='+', default=list(settings.DATABASE_PROFILES))
+        parser.add_argument('--batching', nargs='+', choices=('off', 'on'), default=['off', 'on'])
+        parser.add_argument('--seconds', type=float, default=10)
+        parser.add_argument('--threads', type=int, default=4, help='threads per process')
+        parser.add_argument('--guilds', type=int, default=20)
+        parser.add_argument('--role', choices=ROLES + ('setup',), help=argparse.SUPPRESS)
+        parser.add_argument('--db', help=argparse.SUPPRESS)
+        parser.add_argument('--profile', help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['role']:
+            self.run_role(options)
+            return
+        self.stdout.write(f'{"profile":<18} {"batching":<9} {"process":<10} {"ops":>7} {"ops/s":>8} {"p50 ms":>8} '
+                          f'{"p99 ms":>8} {"locked":>7} {"errors":>7}')
+        for profile in options['profiles']:
+            for batching in options['batching']:
+                with tempfile.TemporaryDirectory() as directory:
+                    db = os.path.join(directory, 'bench.sqlite3')
+                    self.spawn('setup', db, profile, batching, options).wait()
+                    processes = [self.spawn(role, db, profile, batching, options, stdout=subprocess.PIPE)
+                                 for role in ROLES]
+                    for role, process in zip(ROLES, processes):
+                        out, _ = process.communicate()
+                        r = json.loads(out.decode().strip().splitlines()[-1])
+                        self.stdout.write(
+                            f'{profile:<18} {batching:<9} {role:<10} {r["ops"]:>7} '
+                            f'{r["ops"] / options["seconds"]:>8.1f} {r["p50"] * 1000:>8.1f} {r["p99"] * 1000:>8.1f} '
+                            f'{r["locked"]:>7} {r["errors"]:>7}'
+                        )
+
+    @staticmethod
+    def spawn(role, db, profile, batching, options, stdout=None):
+        args = [sys.executable, sys.argv[0], 'bench_sqlite', '--role', role, '--db', db, '--profile', profile,
+                '--batching', batching, '--seconds', str(options['seconds']), '--threads', str(options['threads']),
+                '--guilds', str(options['guilds'])]
+        return subprocess.Popen(args, stdout=stdout)
+
+    def run_role(self, options):
+        database = settings.DATABASES['default']
+        database.update(settings.DATABASE_PROFILES[options['profile']], NAME=options['db'])
+        connections.databases['default'].update(database)
+        # the connection of this thread may already exist with the old ENGINE
+        connections['default'].close()
+        del connections['default']
+        batching = dict(getattr(settings, 'WRITE_BATCHING', {}), ENABLED=options['batching'] == ['on'])
+        with override_settings(WRITE_BATCHING=batching, AUDIT={'ENABLED': False}):
+            if options['role'] == 'setup':
+                call_command('migrate', verbosity=0)
+                self.setup(options['guilds'])
+                return
+            step = getattr(self, options['role'])
+            result = self.run_threads(step, options['threads'], options['seconds'])
+        self.stdout.write(json.dumps(result))
+
+    @staticmethod
+    def setup(guilds):
+        for i in range(guilds):
+            guild = Guild.objects.create(name=f'g{i}', chat_id=str(-1 - i))
+            tuser = TelegramUser.objects.create(django=User.objects.create(username=f'u{i}'), chat_id=str(i + 1))
+            GuildMembership.objects.create(tuser=tuser, guild=guild)
+
+    @staticmethod
+    def run_threads(step, threads, seconds):
+        latencies, counters = [], {'locked': 0, 'errors': 0}
+        lock = threading.Lock()
+        stop = time.perf_counter() + seconds
+
+        def work():
+            guilds = list(Guild.objects.all())
+            while time.perf_counter() < stop:
+                start = time.perf_counter()
+                try:
+                    step(random.choice(guilds))
+                except OperationalError as e:
+                    with lock:
+                        counters['locked' if 'locked' in str(e) else 'errors'] += 1
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+            close_old_connections()
+
+        pool = [threading.Thread(target=work) for _ in range(threads)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        return dict(counters, ops=len(latencies), p50=percentile(latencies, 0.5), p99=percentile(latencies, 0.99))
+
+    @staticmethod
+    def bot(guild):
+        """/collect: profile refresh, a new collection, its notification instead of the pending ones"""
+        api_user = ApiUser(int(-int(guild.chat_id)), uuid.uuid4().hex[:8], False)
+        tuser, _ = TelegramUser.get_or_create_by_api(api_user)
+        collection = ResourceCollection.objects.create(by=tuser, at=timezone.now(), in_guild=guild)
+        Notification.objects.filter(resource_collection__in_guild=guild).pending().update(canceled=True)
+        Notification.objects.create(caused_by=collection, time=timezone.now(), job_id=str(uuid.uuid4()))
+        # the profile refresh is queued with wait=False, the step is done when it's committed too
+        writer.flush()
+
+    @staticmethod
+    def worker(guild):
+        """notification job: load a pending notification, mark it notified, create the next one"""
+        n = Notification.objects.filter(resource_collection__in_guild=guild).pending().order_by('time').first()
+        if n is None:
+            return
+        reason = n.caused_by
+        writer.update(Notification, [n.pk], notified=True)
+        Notification.objects.create(caused_by=reason, time=timezone.now(), number=n.number + 1,
+                                    job_id=str(uuid.uuid4()))
+
+    @staticmethod
+    def scheduler(guild):
+        """reconcile-like pass: pending jobs of the guild and a rescheduled one"""
+        pending = list(Notification.objects.filter(resource_collection__in_guild=guild).pending()
+                       .values_list('pk', 'job_id'))
+        if pending:
+            pk, _ = random.choice(pending)
+            Notification.objects.filter(pk=pk).update(job_id=str(uuid.uuid4()))
@@ -0,0 +1,50 @@
+import statistics
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.timers import TimerEngine
+
+
+class Command(BaseCommand):
+    help = 'measure how late timers of the in-process notification scheduler fire'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timers', type=int, default=100000, help='number of pending timers')
+        parser.add_argument('--spread', type=float, default=10, help='timers fire during this number of seconds')
+        parser.add_argument('--start-in', type=float, default=2, help='seconds before the first timer')
+        parser.add_argument('--workers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        n = options['timers']
+        lateness = []
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def callback(job_id, payload, timestamp):
+            late = time.time() - timestamp
+            with lock:
+                lateness.append(late)
+                if len(lateness) == n:
+                    done.set()
+
+        engine = TimerEngine(callback, workers=options['workers'])
+        engine.start()
+        start = time.time() + options['start_in']
+        step = options['spread'] / n
+        t = time.perf_counter()
+        for i in range(n):
+            engine.schedule(start + i * step, f'job-{i}', i)
+        self.stdout.write(f'scheduled {n} timers in {time.perf_counter() - t:.3f}s')
+
+        done.wait(options['start_in'] + options['spread'] + 60)
+        engine.stop()
+        if len(lateness) < n:
+            self.stderr.write(f'only {len(lateness)} of {n} timers fired')
+        lateness.sort()
+
+        def ms(q):
+            return lateness[min(len(lateness) - 1, int(q * len(lateness)))] * 1000
+        self.stdout.write(f'lateness, ms: mean {statistics.mean(lateness) * 1000:.2f}, p50 {ms(0.5):.2f}, '
+                          f'p99 {ms(0.99):.2f}, max {lateness[-1] * 1000:.2f}')
@@ -0,0 +1,76 @@
+import resource
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from rq import Queue, Worker
+
+from app.connections import get_redis
+from app.models import TelegramUser, Guild, ResourceCollection, Notification
+from app.tasks import notification_job
+from app.worker import ThreadedWorker
+
+
+def cpu_time():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+class Command(BaseCommand):
+    help = 'compare jobs per second of the stock forking rq worker and the threaded notification worker. ' \
+           'Uses RQ_QUEUES redis and the configured database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--jobs', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--queue', default='bench_worker')
+        parser.add_argument('--fakeredis', action='store_true',
+                            help='use fakeredis instead of RQ_QUEUES redis (forked jobs still run, their results '
+                                 'stay in the child)')
+
+    def handle(self, *args, **options):
+        if options['fakeredis']:
+            try:
+                import fakeredis
+            except ImportError:
+                raise CommandError('--fakeredis needs fakeredis (pipenv install --dev)')
+            connection = fakeredis.FakeRedis()
+        else:
+            connection = get_redis()
+
+        n = options['jobs']
+        user, _ = User.objects.get_or_create(username='bench_worker')
+        tuser, _ = TelegramUser.objects.get_or_create(django=user, defaults={'chat_id': '0'})
+        guild, _ = Guild.objects.get_or_create(chat_id='bench_worker', defaults={'name': 'bench_worker'})
+        collection = ResourceCollection.objects.create(by=tuser, at=timezone.now(), in_guild=guild)
+        # canceled notifications: the job loads the row and returns, so the worker overhead dominates
+        notifications = Notification.objects.bulk_create(
+            Notification(caused_by=collection, number=i, time=timezone.now(), canceled=True) for i in range(n)
+        )
+        pks = list(Notification.objects.filter(object_id=collection.pk, content_type__model='resourcecollection')
+                   .values_list('pk', flat=True))
+
+        queue = Queue(options['queue'], connection=connection)
+
+        def run(name, work):
+            queue.empty()
+            for pk in pks:
+                queue.enqueue(notification_job, pk, result_ttl=0)
+            cpu, wall = cpu_time(), time.perf_counter()
+            work()
+            cpu, wall = cpu_time() - cpu, time.perf_counter() - wall
+            self.stdout.write(f'{name}: {len(pks)} jobs in {wall:.2f}s, {len(pks) / wall:.1f} jobs/s, '
+                              f'{len(pks) / cpu:.1f} jobs per cpu second')
+            return len(pks) / cpu
+
+        try:
+            forking = run('forking rq worker', lambda: Worker([queue], connection=connection).work(burst=True))
+            threaded = run('threaded worker', lambda: ThreadedWorker(
+                [queue.name], connection, concurrency=options['concurrency']).work(burst=True))
+            self.stdout.write(f'threaded worker does {threaded / forking:.1f}x more jobs per cpu second')
+        finally:
+            queue.delete(delete_jobs=True)
+            Notification.objects.filter(pk__in=pks).delete()
+            collection.delete()
@@ -0,0 +1,200 @@
+import json
+import statistics
+import time
+from queue import Queue
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+
+from app import audit, connections, metrics, scheduler, sender
+from app.fake_bot_api import FakeBotAPI
+from app.management.commands.bot import Command as BotCommand
+from app.models import Notification
+from app.tasks import notification_job
+from app.tracing import TracedRequest
+
+TOKEN = '1000:benchmark'
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0
+
+
+class Command(BaseCommand):
+    help = 'offline end-to-end benchmark: bot handlers and notification jobs against fakeredis, a fake Bot API ' \
+           'and a temporary test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--guilds', type=int, default=10)
+        parser.add_argument('--users', type=int, default=10, help='users per guild')
+        parser.add_argument('--rounds', type=int, default=1, help='how many times every user runs the commands')
+        parser.add_argument('--api-latency', type=float, default=0, help='seconds the fake Bot API sleeps per call')
+        parser.add_argument('--baseline', help='json report of a previous run, fail if this run is worse')
+        parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+        parser.add_argument('--trace', action='store_true', help='trace every handler call and print trace_report')
+        parser.add_argument('--save', help='write json report to this file (e.g. to use it as a baseline)')
+
+    def handle(self, *args, **options):
+        try:
+            import fakeredis
+        except ImportError:
+            raise CommandError('benchmark needs fakeredis (pipenv install --dev)')
+
+        api = FakeBotAPI(latency=options['api_latency']).start()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        old_pool = connections._pools.get('default')
+        connections._pools['default'] = fakeredis.FakeRedis().connection_pool
+        limits = {'ALL_BURST_LIMIT': 10 ** 6, 'GROUP_BURST_LIMIT': 10 ** 6}
+        try:
+            with override_settings(TELEGRAM_BASE_URL=api.base_url, TELEGRAM_TOKEN=TOKEN, TELEGRAM_SENDER=limits,
+                                   NOTIFICATION_SCHEDULER='rq', TRACING={'SAMPLE_RATE': 1 if options['trace'] else 0}):
+                scheduler._scheduler = sender._sender = None
+                report = self.run(api, options)
+                if options['trace']:
+                    metrics.registry.flush(force=True)
+                    call_command('trace_report', stdout=self.stdout)
+        finally:
+            metrics.registry.flush(force=True)
+            audit.trail.flush()  # into the test database, not the real one at exit
+            scheduler._scheduler = sender._sender = None
+            if old_pool is None:
+                connections._pools.pop('default', None)
+            else:
+                connections._pools['default'] = old_pool
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            api.stop()
+
+        self.print_report(report)
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(report, f, indent=2)
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                regressions = self.compare(json.load(f), report, options['tolerance'])
+            if regressions:
+                raise CommandError('worse than baseline:\n' + '\n'.join(regressions))
+            self.stdout.write('no regressions against the baseline')
+
+    def run(self, api, options):
+        bot = Bot(TOKEN, base_url=api.base_url, request=TracedRequest(con_pool_size=8))
+        dispatcher = Dispatcher(bot, Queue(), workers=1, use_context=True)
+        BotCommand().add_handlers(dispatcher)
+        errors = []
+        dispatcher.add_error_handler(lambda update, context: errors.append(context.error))
+
+        update_ids = iter(range(1, 10 ** 9))
+
+        def command(chat_id, user_id, text):
+            chat = {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private', 'title': f'chat {chat_id}'}
+            update_id = next(update_ids)
+            return Update.de_json({
+                'update_id': update_id,
+                'message': {
+                    'message_id': update_id,
+                    'date': int(time.time()),
+                    'chat': chat,
+                    'from': api.user(user_id),
+                    'text': text,
+                    'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}],
+                },
+            }, bot)
+
+        guilds = [-1000000000000 - i for i in range(options['guilds'])]
+        users = {chat_id: [10 ** 6 + i * options['users'] + j for j in range(options['users'])]
+                 for i, chat_id in enumerate(guilds)}
+        for i, chat_id in enumerate(guilds):
+            dispatcher.process_update(command(chat_id, users[chat_id][0], f'/register Guild {i}'))
+
+        latency = {}
+        queries = {}
+        start = time.perf_counter()
+        for _ in range(options['rounds']):
+            for chat_id in guilds:
+                for j, user_id in enumerate(users[chat_id]):
+                    for text in ('/collect', f'/new_npc 1d2h NPC {j}', '/get_npc_list'):
+                        name = text.split()[0][1:]
+                        update = command(chat_id, user_id, text)
+                        with CaptureQueriesContext(connection) as captured:
+                            t = time.perf_counter()
+                            dispatcher.process_update(update)
+                            latency.setdefault(name, []).append(time.perf_counter() - t)
+                        queries.setdefault(name, []).append(len(captured))
+        handlers_time = time.perf_counter() - start
+        updates = sum(len(v) for v in latency.values())
+
+        # every pending notification becomes due right now and all of them are fired one after another
+        due = timezone.now()
+        pks = list(Notification.objects.pending().values_list('pk', flat=True))
+        Notification.objects.filter(pk__in=pks).update(time=due)
+        lateness = []
+        start = time.perf_counter()
+        for pk in pks:
+            if notification_job(pk):
+                lateness.append((timezone.now() - due).total_seconds())
+        jobs_time = time.perf_counter() - start
+
+        return {
+            'guilds': options['guilds'],
+            'users': options['users'],
+            'updates': updates,
+            'errors': len(errors),
+            'updates_per_second': updates / handlers_time,
+            'handlers': {
+                name: {
+                    'p50_ms': percentile(values, 0.5) * 1000,
+                    'p99_ms': percentile(values, 0.99) * 1000,
+                    'queries_per_update': statistics.mean(queries[name]),
+                }
+                for name, values in latency.items()
+            },
+            'notifications': {
+                'jobs': len(pks),
+                'messages': len(lateness),
+                'jobs_per_second': len(pks) / jobs_time if jobs_time else 0,
+                'lateness_p50_ms': percentile(lateness, 0.5) * 1000,
+                'lateness_p99_ms': percentile(lateness, 0.99) * 1000,
+            },
+            'api_calls': dict(api.calls),
+        }
+
+    def print_report(self, report):
+        self.stdout.write(f'{report["updates"]} updates from {report["guilds"]} guilds x {report["users"]} users: '
+                          f'{report["updates_per_second"]:.1f} updates/s, {report["errors"]} errors')
+        for name, r in sorted(report['handlers'].items()):
+            self.stdout.write(f'  /{name}: p50 {r["p50_ms"]:.2f}ms, p99 {r["p99_ms"]:.2f}ms, '
+                              f'{r["queries_per_update"]:.1f} queries per update')
+        n = report['notifications']
+        self.stdout.write(f'{n["jobs"]} notification jobs, {n["messages"]} messages: {n["jobs_per_second"]:.1f} '
+                          f'jobs/s, lateness p50 {n["lateness_p50_ms"]:.1f}ms, p99 {n["lateness_p99_ms"]:.1f}ms')
+        self.stdout.write('Bot API calls: ' + ', '.join(f'{k} {v}' for k, v in sorted(report['api_calls'].items())))
+
+    def compare(self, baseline, report, tolerance):
+        """descriptions of the numbers which are worse than in the baseline by more than `tolerance`"""
+        lower_is_better = [('errors',)]
+        for name in baseline.get('handlers', {}):
+            if name in report['handlers']:
+                lower_is_better += [('handlers', name, 'p99_ms'), ('handlers', name, 'queries_per_update')]
+        lower_is_better.append(('notifications', 'lateness_p99_ms'))
+        higher_is_better = [('updates_per_second',), ('notifications', 'jobs_per_second')]
+
+        def get(d, path):
+            for key in path:
+                d = d[key]
+            return d
+
+        regressions = []
+        for path in lower_is_better:
+            old, new = get(baseline, path), get(report, path)
+            if new > old * (1 + tolerance) and new != old:
+                regressions.append(f'{".".join(path)}: {old:.2f} -> {new:.2f}')
+        for path in higher_is_better:
+            old, new = get(baseline, path), get(report, path)
+            if new < old * (1 - tolerance):
+                regressions.append(f'{".".join(path)}: {old:.2f} -> {new:.2f}')
+        return regressions
@@ -1,19 +1,28 @@
+import math
 import re
-import sys
-import traceback
 from functools import wraps
 import logging
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 from django.utils import timezone
-from telegram.error import ChatMigrated
+from telegram.error import ChatMigrated, TelegramError
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, CallbackContext
-from telegram import ReplyKeyboardRemove, ParseMode, InlineKeyboardButton, InlineKeyboardMarkup, Chat, ChatMember, \
-    Update, constants
+from telegram import ReplyKeyboardRemove, ParseMode, InlineKeyboardButton, InlineKeyboardMarkup, Chat, \
+    ChatMember, Update, constants
 from telegram.utils.helpers import mention_html, escape_markdown
 
+from app import metrics, npc_list, titles
+from app.cache import invalidation
+from app.dispatcher import build_dispatcher
+from app.errors import get_reporter
+from app.interactions import get_interactions
 from app.models import Guild, TelegramUser, ResourceCollection, TemporaryNPC
+from app.scheduler import get_scheduler, reconcile
+from app.sender import call_or_defer, chat_remap, send_or_defer
+from app.sharding import ShardUpdater
+from app.tracing import trace
+from app.webhook import WebhookUpdater
 
 logger = logging.getLogger(__name__)
 
@@ -25,55 +34,55 @@ class Log(object):
         self.at_start = at_start
         self.at_finish = at_finish
         self.level = level
+        self.levelno = logging.getLevelName(level)
 
     def __call__(self, func):
         @wraps(func)
         def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
-            if self.at_start:
+            # error handlers get update=None for errors of polling itself, there is nobody to log or to reply to
+            if self.at_start and update is not None:
                 self.log('start', update)
-            if not kwargs.get('reply'):
-                kwargs['reply'] = self.get_text_replier(update)
+            if not kwargs.get('reply') and update is not None:
+                kwargs['reply'] = self.get_text_replier(update, context)
             result = func(update, context, *args, **kwargs)
-            if self.at_finish:
+            if self.at_finish and update is not None:
                 self.log('finish', update)
             return result
 
         self.func_name = func.__name__
         return wrapper
 
-    def _get_format_kwargs(self, update: Update):
-        return {
-            'name': self.func_name,
-            'chat': update.effective_chat.id,
-            'sender': update.effective_message.from_user.id
-        }
+    def _get_format_args(self, update: Update):
+        return self.func_name, update.effective_chat.id, update.effective_message.from_user.id
 
     def log(self, action, update: Update):
-        log_message = "{action} '{name}' function in {chat} chat. Sender id: {sender}".format(
-            action=action,
-            **self._get_format_kwargs(update)
-        )
-        logger.log(logging.getLevelName(self.level), log_message)
+        if logger.isEnabledFor(self.levelno):
+            logger.log(self.levelno, "%s '%s' function in %s chat. Sender id: %s",
+                       action, *self._get_format_args(update))
 
-    def get_text_replier(self, update: Update):
+    def get_text_replier(self, update: Update, context: CallbackContext):
         @wraps(update.effective_message.reply_text)
         def reply_text(*args, **kwargs):
-            log_message = "inside '{name}': try to reply in {chat} chat to message from {sender}".format(
-                **self._get_format_kwargs(update)
-            )
-            logger.log(logging.getLevelName(self.level), log_message)
+            # None if deferred by flood control, the `on_sent` kwarg gets the message when it's sent
+            if logger.isEnabledFor(self.levelno):
+                logger.log(self.levelno, "inside '%s': try to reply in %s chat to message from %s",
+                           *self._get_format_args(update))
             # logger.info(f'mes: {update.effective_message}, args: {args}, kwargs: {kwargs}')
-            return update.effective_message.reply_text(*args, **kwargs)
+            return call_or_defer(context.job_queue, update.effective_message.reply_text, *args, **kwargs)
 
         return reply_text
 
 
 def private_guild_choice(f):
-    """pass `guild` arg in `f` if chat is private and `tuser` arg"""
+    """
+    pass `guild` arg in `f` if chat is private and `tuser` arg. In a private chat the guild is asked with a keyboard,
+    `f` is called by `guild_callback` after the choice (found by its name, with the same `context.args`)
+    """
     try:
-        mem = private_guild_choice.mem
+        handlers = private_guild_choice.handlers
     except AttributeError:
-        mem = private_guild_choice.mem = {}
+        handlers = private_guild_choice.handlers = {}
+    handlers[f.__name__] = f
 
     @wraps(f)
     @Log(at_start=True, at_finish=True)
@@ -81,7 +90,7 @@ def private_guild_choice(f):
         chat = update.effective_chat
         if chat.type == chat.PRIVATE:
             try:
-                tuser = TelegramUser.objects.get(chat_id=chat.id)
+                tuser = TelegramUser.get_cached(chat.id)
             except TelegramUser.DoesNotExist as e:
                 message = 'Я пока что не знаю кто Вы и к какой гильдии относитесь. В первый раз напишите, ' \
                           'пожалуйста, обращение ко мне через свою группу.'
@@ -98,8 +107,11 @@ def private_guild_choice(f):
                 for row in
                 [guilds[i:i+3] for i in range(0, len(guilds), 3)]
             ]
-            m = reply('Выберите гильдию:', reply_markup=InlineKeyboardMarkup(keyboard))
-            mem[(m.chat.id, m.message_id)] = (f, context)
+            args = context.args or []
+
+            def remember(m):
+                get_interactions().put(m.chat.id, m.message_id, f.__name__, args)
+            reply('Выберите гильдию:', reply_markup=InlineKeyboardMarkup(keyboard), on_sent=remember)
             return
         logger.info(f'start {f.__name__} function in wrapper')
         ret = f(update, context, *args, reply=reply, **kwargs)
@@ -127,25 +139,29 @@ def guild_callback(update: Update, context: CallbackContext, *args, reply=None,
             elif parse_mode == ParseMode.MARKDOWN:
                 text = f'_({escape_markdown(g.name, 1)})_ {text}'
             logger.info(f'try to edit message')
-            return query.edit_message_text(text, *args2, **kwargs2)  # text=f"{query.data}"
+            # text=f"{query.data}"
+            return call_or_defer(context.job_queue, query.edit_message_text, text, *args2, **kwargs2)
         return edit_message_text
 
     if query.data == "other":
-        query.edit_message_text('Напишите обращение ко мне из группы гильдии, чтобы я запомнил, что Вы в ней состоите')
+        call_or_defer(context.job_queue, query.edit_message_text,
+                      'Напишите обращение ко мне из группы гильдии, чтобы я запомнил, что Вы в ней состоите')
         return
 
     m = update.effective_message
-    key_in_mem = (m.chat.id, m.message_id)
-    f, old_context = private_guild_choice.mem.get(key_in_mem, (None, None))
+    interaction = get_interactions().pop(m.chat.id, m.message_id)
+    f = None
+    if interaction is not None:
+        handler_name, context.args = interaction
+        f = getattr(private_guild_choice, 'handlers', {}).get(handler_name)
     if f is not None:
-        guild = Guild.objects.get(chat_id=update.callback_query.data)  # need to check?
+        guild = Guild.get_by_chat_id(update.callback_query.data)  # need to check?
         tuser, _ = TelegramUser.get_or_create_by_api(update.effective_user)
         logger.info(f'start {f.__name__} function in callback')
-        ret = f(update, old_context, reply=get_edit_message_text_for_guild(guild), guild=guild, tuser=tuser)
-        del private_guild_choice.mem[key_in_mem]
+        ret = f(update, context, reply=get_edit_message_text_for_guild(guild), guild=guild, tuser=tuser)
         logger.info(f'finish {f.__name__} function in callback')
         return ret
-    logger.info(f'can\'t remember {key_in_mem} message to call it in callback')  # may be use another level?
+    logger.info(f'can\'t remember {(m.chat.id, m.message_id)} message to call it in callback')  # may be use another level?
 
 
 def chat_types_only(type_list, message, *args, **kwargs):
@@ -180,7 +196,7 @@ def group_registered(f):
         chat = update.effective_chat
         if chat.type in [chat.GROUP, chat.SUPERGROUP]:
             try:
-                guild = Guild.objects.get(chat_id=chat.id)
+                guild = Guild.get_by_chat_id(chat.id)
                 kwargs['guild'] = guild
 
                 tuser, created = TelegramUser.get_or_create_by_api(update.effective_message.from_user)
@@ -205,10 +221,7 @@ def group_registered(f):
 
 class Command(BaseCommand):
 
-    def handle(self, *args, **options):
-        updater = Updater(token=settings.TELEGRAM_TOKEN, use_context=True)
-        dispatcher = updater.dispatcher
-
+    def add_handlers(self, dispatcher):
         @Log(at_start=True, at_finish=True)
         def start(update: Update, context: CallbackContext, reply=None):
             reply("Здравствуйте! Нажмите на /help , чтобы узнать как пользоваться ботом.",
@@ -223,20 +236,8 @@ class Command(BaseCommand):
 
             if update.effective_chat.type == Chat.PRIVATE:
                 text = f"Пользователь {tuser.mention_html_for_guild(guild)} собрал ресурсы."
-                try:
-                    context.bot.send_message(guild.chat_id,
-                                             text,
-                                             disable_notification=True,
-                                             parse_mode=ParseMode.HTML)
-                except ChatMigrated as e:
-                    new_id = e.new_chat_id
-                    context.bot.send_message(new_id,
-                                             text,
-                                             disable_notification=True,
-                                             parse_mode=ParseMode.HTML)
-                    logger.info(f'edit chat id in guild pk {guild.pk} which migrated from {guild.chat_id} to {new_id}')
-                    guild.chat_id = new_id
-                    guild.save()
+                send_or_defer(context.bot, context.job_queue, guild.chat_id, text, disable_notification=True,
+                              parse_mode=ParseMode.HTML)
 
         @groups_only('Разрешается регистрировать лишь группы. Добавьте бота как участника группы и вызовите после '
                      'этого там команду.')
@@ -244,7 +245,7 @@ class Command(BaseCommand):
             chat = update.effective_chat
             name = " ".join(context.args)
             try:
-                guild = Guild.objects.get(chat_id=chat.id)
+                guild = Guild.get_by_chat_id(chat.id)
                 message = f'Данный чат уже зарегистрирован на гильдию "{guild.name}". Потом сделаем возможность ' \
                           f'переименовывания, пока только вручную.. обращаться к @borograam'
                 reply(message)
@@ -326,7 +327,8 @@ group info</u> (что самое меньшее зло, среди всех в
 info</u>, чтобы выдавать его другим. Сам он даже не будет пытаться что-либо изменить.
 Каждый юзер может задать свой ник для каждой гильдии, в которой является участником. Дабы не засорять чат гильдии \
 такими попытками, эту команду разрешено использовать только в личной переписке с ботом.
-- <i>(лс)</i> /set_display_name - установить ник в гильдию (будет предложен выбор)""",
+- <i>(лс)</i> /set_display_name - установить ник в гильдию (будет предложен выбор)
+- <i>(рег)</i> <i>(гр)</i> /sync_titles - установить титулы всем участникам с никами (например, после выдачи боту прав), только для администраторов чата""",
             
                 """\
 <b>4. Уведомление об окончании временных построек</b>
@@ -362,14 +364,20 @@ info</u>, чтобы выдавать его другим. Сам он даже
         @groups_only('Разрешается устанавливать уведомления только из группы гильдии')
         @group_registered
         def set_additional_notifications(update: Update, context: CallbackContext, reply=None, guild=None, tuser=None):
-            string = ''.join(context.args)
-            regexp = re.compile(r'^(?:\+\d+[mh](?:\[(\d+|\*)\])?)*$')
-            if regexp.match(string) is None:
+            try:
+                schedule = guild.set_additional_notifications(''.join(context.args))
+            except ValueError:
                 reply('Неверный формат. Пример правильного формата: +5m +10m +15m[3] +1h[*]')
                 return
-            guild.additional_notifications = string
-            guild.save()
-            reply('Сохранён новый график дополнительных уведомлений при несборе ресурсов.')
+            text = 'Сохранён новый график дополнительных уведомлений при несборе ресурсов.'
+            now = timezone.localtime()
+            preview = schedule.fire_times(now, 6)
+            if preview:
+                times = ', '.join(t.strftime('%H:%M') for t in preview[:5])
+                text += f' Например, при переполнении в {now.strftime("%H:%M")} напоминания придут в {times}'
+                if len(preview) > 5:
+                    text += ' и т.д.'
+            reply(text)
 
         @group_registered
         @private_guild_choice
@@ -380,7 +388,7 @@ info</u>, чтобы выдавать его другим. Сам он даже
                 n = "<i>не задан</i>"
             reply(f'Текущий график дополнительных уведомлений: {n}', parse_mode=ParseMode.HTML)
 
-        @privates_only(f'Устанавливать имя можно только в [личной переписке]({updater.bot.link}) с ботом',
+        @privates_only(f'Устанавливать имя можно только в [личной переписке]({dispatcher.bot.link}) с ботом',
                        parse_mode=ParseMode.MARKDOWN_V2)
         @private_guild_choice
         def set_display_name(update: Update, context: CallbackContext, reply=None, guild=None, tuser=None):
@@ -392,27 +400,69 @@ info</u>, чтобы выдавать его другим. Сам он даже
 
             def e(s):
                 return escape_markdown(s, version=2)
-            feedback = f'Установлено имя *{e(name)}* для гильдии _{e(guild.name)}_\\.\n'
-
-            bot = context.bot
-            bot_member = bot.get_chat_member(guild.chat_id, bot.id)  # check if bot is a member(maybe someone kicked us)
-            if bot_member.can_promote_members and bot_member.can_change_info:
-                user_member = bot.get_chat_member(guild.chat_id, tuser.chat_id)
-                if user_member.status == ChatMember.CREATOR:
-                    feedback += f'Обнаружено, что Вы \\- создатель чата гильдии\\. Я не могу установить Вам титул, ' \
-                                f'т\\.к\\. это разрешено только Вам\\.'
+            reply(f'Установлено имя *{e(name)}* для гильдии _{e(guild.name)}_\\.', parse_mode=ParseMode.MARKDOWN_V2)
+
+            def sync_title():
+                try:
+                    result = titles.sync_title(context.bot, guild.chat_id, tuser.chat_id, name)
+                except TelegramError as exc:
+                    # run_async would only log it, the user is still waiting for the outcome
+                    logger.warning(f'can\'t set title of TelegramUser pk {tuser.pk} in Guild pk {guild.pk}: {exc}')
+                    result = titles.FAILED
+                if result in (titles.SET, titles.UNCHANGED):
+                    text = f'Имя *{e(name)}* так же установлено титулом в чат гильдии _{e(guild.name)}_\\.'
+                elif result == titles.CREATOR:
+                    text = f'Обнаружено, что Вы \\- создатель чата гильдии\\. Я не могу установить Вам титул, ' \
+                           f'т\\.к\\. это разрешено только Вам\\.'
+                elif result == titles.FAILED:
+                    text = f'По некоторой причине не получилось установить имя титулом в чат гильдии\\.'
                 else:
-                    if user_member.status != ChatMember.ADMINISTRATOR:
-                        bot.promote_chat_member(guild.chat_id, tuser.chat_id, can_change_info=True)
-                    result = bot.set_chat_administrator_custom_title(guild.chat_id, tuser.chat_id, name)
-                    if result:
-                        feedback += f'Так же оно было успешно установлено титулом в чат гильдии\\.'
-                    else:
-                        feedback += f'По некоторой причине не получилось установить его титулом в чат гильдии\\.'
-            else:
-                feedback += f'Если в чате гильдии боту выдадут права __Change group info__ и __Add new admins__, то ' \
-                            f'он сможет автоматически ставить отображаемое имя в титул участника группы\\.'
-            reply(feedback, parse_mode=ParseMode.MARKDOWN_V2)
+                    text = f'Если в чате гильдии боту выдадут права __Change group info__ и __Add new admins__, то ' \
+                           f'он сможет автоматически ставить отображаемое имя в титул участника группы\\.'
+                send_or_defer(context.bot, context.job_queue, update.effective_chat.id, text,
+                              parse_mode=ParseMode.MARKDOWN_V2)
+            context.dispatcher.run_async(sync_title)
+
+        @groups_only('Синхронизировать титулы можно только в группе гильдии')
+        @group_registered
+        def sync_titles(update: Update, context: CallbackContext, reply=None, guild=None, tuser=None):
+            # members with titles are administrators too (promoted with can_change_info only), so the right to add
+            # admins is required
+            member = context.bot.get_chat_member(update.effective_chat.id, update.effective_user.id)
+            if member.status != ChatMember.CREATOR and not (member.status == ChatMember.ADMINISTRATOR and
+                                                            member.can_promote_members):
+                reply('Синхронизировать титулы может только создатель чата или администратор с правом добавлять '
+                      'администраторов')
+                return
+            memberships = list(guild.guildmembership_set.exclude(display_name='').select_related('tuser', 'guild'))
+            if not memberships:
+                reply('Ни у кого в гильдии пока нет ника, установите его с помощью /set_display_name в личной '
+                      'переписке с ботом')
+                return
+            wait = titles.start_guild_sync(update.effective_chat.id)
+            if wait:
+                reply(f'Титулы уже синхронизировались недавно, повторить можно через {math.ceil(wait / 60)} мин.')
+                return
+            reply(f'Устанавливаю титулы участникам с никами ({len(memberships)})...')
+
+            def sync():
+                summary = titles.sync_guild_titles(context.bot, memberships)
+                texts = {
+                    titles.SET: 'установлено',
+                    titles.UNCHANGED: 'уже были',
+                    titles.CREATOR: 'создатель чата',
+                    titles.FAILED: 'не получилось',
+                    titles.NO_RIGHTS: 'нет прав у бота',
+                    'error': 'ошибка',
+                }
+                lines = '\n'.join(f'- {texts.get(result, result)}: {count}' for result, count in summary.most_common())
+                text = f'Синхронизация титулов завершена:\n{lines}'
+                if summary[titles.NO_RIGHTS]:
+                    # no cooldown for a sync which did nothing, the command is repeated once the rights are given
+                    titles.cancel_guild_sync(update.effective_chat.id)
+                    text += '\nВыдайте боту права Change group info и Add new admins и повторите команду.'
+                send_or_defer(context.bot, context.job_queue, update.effective_chat.id, text)
+            context.dispatcher.run_async(sync)
 
         @groups_only('Сообщать о новом временном строении можно только в группе гильдии')
         @group_registered
@@ -448,37 +498,11 @@ info</u>, чтобы выдавать его другим. Сам он даже
         @private_guild_choice
         @group_registered
         def get_npc_list(update: Update, context: CallbackContext, reply=None, guild=None, tuser=None):
-            # text = "\n".join(
-            #     [f'({i+1}) {str(npc.at - timezone.now()).split(".")[0]} {npc.caption}'
-            #      for i, npc in enumerate(TemporaryNPC.objects.filter(in_guild=guild, expired=False).order_by('-at'))]
-            # )
-            text = ''
-            now = timezone.now()
-            zero = timezone.timedelta()
-            for i, npc in enumerate(TemporaryNPC.objects.filter(in_guild=guild, expired=False).order_by('at')):
-                delta = npc.at - now
-                delta_text = ''
-                if delta < zero:
-                    delta = zero
-                if delta.days > 0:
-                    delta_text += f'{delta.days}d'
-                hours = delta.seconds // 3600
-                if hours > 0:
-                    delta_text += f' {hours}h'
-                minutes = delta.seconds % 3600 // 60
-                if minutes > 0:
-                    delta_text += f' {minutes}m'
-                # seconds = delta.seconds % 60
-                # if seconds > 0:
-                #     delta_text += f' {seconds}s'
-                if delta_text == '':
-                    delta_text = "<i>ожидание сообщения об окончании</i>"
-
-                text += f'<code>{i+1}</code> <u>{delta_text}</u> <i>{npc.caption}</i>\n'
-            if text == '':
-                text += 'пока что пуст. Добавьте новых с помощью /new_npc'
-
-            reply(f'Список NPC:\n{text}', parse_mode=ParseMode.HTML)
+            first, *rest = npc_list.render(npc_list.get_rows(guild))
+            reply(first, parse_mode=ParseMode.HTML)
+            for page in rest:
+                send_or_defer(context.bot, context.job_queue, update.effective_chat.id, page,
+                              parse_mode=ParseMode.HTML)
             # TODO: i need some method to change npc's remaining time
 
         @Log(at_start=True, at_finish=True)
@@ -487,70 +511,114 @@ info</u>, чтобы выдавать его другим. Сам он даже
             old_id = m.migrate_from_chat_id or m.chat_id
             new_id = m.migrate_to_chat_id or m.chat_id
 
-            try:
-                guild = Guild.objects.get(chat_id=old_id)
-                guild.chat_id = new_id
-                guild.save()
-                logger.info(f'guild pk {guild.pk} migrated from {old_id} to {new_id}')
-            except Guild.DoesNotExist:
-                pass
+            if old_id != new_id:
+                chat_remap.add(old_id, new_id)
+
+        def bot_membership(update: Update, context: CallbackContext):
+            m = update.message
+            members = m.new_chat_members or [m.left_chat_member]
+            if any(member.id == context.bot.id for member in members if member):
+                titles.invalidate(m.chat_id)
 
         @Log(at_start=True, level="ERROR")
         def error(update: Update, context: CallbackContext, reply=None):
             payload = ''
             if isinstance(context.error, ChatMigrated):
                 payload += f" MIGRATE. update: {update}"
-            devs = [163127202]
-            trace = "".join(traceback.format_tb(sys.exc_info()[2]))
-            if update.effective_user:
+            if update is not None and update.effective_user:
                 payload += f' with the user {mention_html(int(update.effective_user.id), update.effective_user.name)}'
-            if update.effective_chat:
+            if update is not None and update.effective_chat:
                 payload += f' within the chat <i>{update.effective_chat.title}</i>'
                 if update.effective_chat.username:
                     payload += f' (@{update.effective_chat.username})'
-            trace = trace.replace('<', '&lt;').replace('>', '&gt;').replace('&', '&amp;')
-            text = f'The error <code>{context.error}</code> happened{payload}. The full traceback:\n\n<pre>' \
-                   f'<code class="language-python">{trace}</code></pre>'
-            try:
-                for dev in devs:
-                    context.bot.send_message(dev, text, parse_mode=ParseMode.HTML)
-            except Exception as e:
-                logger.error(f'can\'t send dev message due to "{e}":\n{text}')
-            # logger.error(f"error in update {update} and context {context}")
-            print('Error. look in the log')
+            fingerprint = get_reporter().report(context.error, payload)
+            logger.error(f'{fingerprint}: {context.error}', exc_info=context.error)
             raise
 
         def failed(update: Update, context: CallbackContext):
             raise
 
-        dispatcher.add_handler(CommandHandler('start', start))
+        dispatcher.add_handler(CommandHandler('start', trace('start')(start)))
 
-        dispatcher.add_handler(CommandHandler('collect', collect))
-        dispatcher.add_handler(CallbackQueryHandler(guild_callback))
+        dispatcher.add_handler(CommandHandler('collect', trace('collect')(collect)))
+        dispatcher.add_handler(CallbackQueryHandler(trace('guild_callback')(guild_callback)))
 
-        dispatcher.add_handler(CommandHandler('register', register, pass_args=True))
-        dispatcher.add_handler(CommandHandler('help', help_command))
+        dispatcher.add_handler(CommandHandler('register', trace('register')(register), pass_args=True))
+        dispatcher.add_handler(CommandHandler('help', trace('help')(help_command)))
         dispatcher.add_handler(CommandHandler('set_additional_notifications',
-                                              set_additional_notifications,
+                                              trace('set_additional_notifications')(set_additional_notifications),
                                               pass_args=True))
-        dispatcher.add_handler(CommandHandler('get_additional_notifications', get_additional_notifications))
-        dispatcher.add_handler(CommandHandler('set_display_name', set_display_name, pass_args=True))
-        dispatcher.add_handler(CommandHandler('new_npc', new_npc, pass_args=True))
-        dispatcher.add_handler(CommandHandler('get_npc_list', get_npc_list))
+        dispatcher.add_handler(CommandHandler('get_additional_notifications',
+                                              trace('get_additional_notifications')(get_additional_notifications)))
+        dispatcher.add_handler(CommandHandler('set_display_name', trace('set_display_name')(set_display_name),
+                                              pass_args=True))
+        dispatcher.add_handler(CommandHandler('sync_titles', trace('sync_titles')(sync_titles)))
+        dispatcher.add_handler(CommandHandler('new_npc', trace('new_npc')(new_npc), pass_args=True))
+        dispatcher.add_handler(CommandHandler('get_npc_list', trace('get_npc_list')(get_npc_list)))
 
         # TODO: /schedule command - all the future notifications
         # TODO: /stats command
         # TODO: bot set own command list
         # TODO: webhook sending to discord
-        dispatcher.add_handler(MessageHandler(Filters.status_update.migrate, chat_migration))
+        dispatcher.add_handler(MessageHandler(Filters.status_update.migrate,
+                                              trace('chat_migration')(chat_migration)))
+        dispatcher.add_handler(MessageHandler(Filters.status_update.new_chat_members |
+                                              Filters.status_update.left_chat_member, bot_membership))
         dispatcher.add_handler(CommandHandler('failed', failed))
         dispatcher.add_error_handler(error)
 
+    def add_arguments(self, parser):
+        parser.add_argument('--webhook', action='store_true',
+                            help='receive updates with the webhook endpoint (settings.WEBHOOK) instead of polling')
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'BOT_UPDATE_WORKERS', 1),
+                            help='threads processing updates of different chats in parallel')
+        parser.add_argument('--shards', type=int, default=getattr(settings, 'BOT_SHARDS', 1),
+                            help='number of shard processes in the sharded mode (see app/sharding.py)')
+        parser.add_argument('--router', action='store_true',
+                            help='receive updates and pass them to the shards instead of handling them')
+        parser.add_argument('--shard', type=int, help='handle updates of this shard (0..shards-1)')
+
+    def handle(self, *args, **options):
+        if options['router'] or options['shard'] is not None:
+            if getattr(settings, 'NOTIFICATION_SCHEDULER', 'rq') == 'timer':
+                raise CommandError('the sharded mode needs a shared notification scheduler, not "timer"')
+            if getattr(settings, 'PENDING_INTERACTIONS', {}).get('BACKEND', 'memory') == 'memory':
+                logger.warning('pending interactions are kept in memory, the sharded bot should use redis for them')
+
+        if options['shard'] is not None:
+            if not 0 <= options['shard'] < options['shards']:
+                raise CommandError(f'--shard must be in 0..{options["shards"] - 1}')
+            dispatcher = build_dispatcher(options['workers'], queue_size=100)
+            updater = ShardUpdater(dispatcher, options['shard'])
+            invalidation.start()
+            mode = f'shard {options["shard"]}'
+        else:
+            shards = options['shards'] if options['router'] else None
+            if options['webhook']:
+                updater = WebhookUpdater.from_settings(update_workers=options['workers'], shards=shards)
+            else:
+                updater = Updater(dispatcher=build_dispatcher(options['workers'], shards=shards), workers=None,
+                                  use_context=True)
+            mode = 'webhook' if options['webhook'] else 'polling'
+            if shards:
+                mode += f' router to {shards} shards'
+
+        if not options['router']:
+            self.add_handlers(updater.dispatcher)
+            get_scheduler().start()
+            metrics.registry.start()
+            if getattr(settings, 'RECONCILE_NOTIFICATIONS_ON_STARTUP', False) and not options['shard']:
+                enqueued, dropped = reconcile()
+                logger.info(f'reconcile notifications: {enqueued} jobs enqueued again, {dropped} orphan jobs dropped')
+
         print('starting the bot... Ctrl-C to exit')
-        logger.info("start bot polling")
-        updater.start_polling()
+        logger.info(f"start bot {mode}")
+        if options['shard'] is not None or options['webhook']:
+            updater.start()
+        else:
+            updater.start_polling()
         updater.idle()
-        logger.info("stop bot polling")
+        logger.info(f"stop bot {mode}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from app import metrics
+
+
+class Command(BaseCommand):
+    help = 'print notification metrics in prometheus text format'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='remove stored metrics after printing')
+
+    def handle(self, *args, **options):
+        self.stdout.write(metrics.render(), ending='')
+        if options['reset']:
+            metrics.get_redis().delete(metrics.REDIS_KEY)
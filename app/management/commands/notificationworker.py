@@ -0,0 +1,30 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from app import metrics
+from app.connections import get_redis
+from app.worker import ThreadedWorker
+
+
+class Command(BaseCommand):
+    help = 'run rq jobs (notifications) in a thread pool of one long-lived process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queues', nargs='*', default=['default'])
+        parser.add_argument('--concurrency', '-c', type=int, default=8, help='number of jobs running at once')
+        parser.add_argument('--burst', '-b', action='store_true', help='stop when the queues are empty')
+
+    def handle(self, *args, **options):
+        queues = options['queues']
+        worker = ThreadedWorker(queues, get_redis(queues[0]), concurrency=options['concurrency'])
+
+        def stop(signum, frame):
+            print('stopping the worker, waiting for running jobs...')
+            worker.stop()
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+
+        metrics.registry.start()
+        print('starting the worker... Ctrl-C to exit')
+        worker.work(burst=options['burst'])
@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.scheduler import reconcile
+
+
+class Command(BaseCommand):
+    help = 're-enqueue jobs of pending notifications which the scheduler lost and drop jobs without notification'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='only count missing and orphan jobs')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        missing, orphans = reconcile(dry_run=options['dry_run'])
+        verb = 'found' if options['dry_run'] else 'fixed'
+        self.stdout.write(f'{verb} {missing} missing and {orphans} orphan jobs in {time.perf_counter() - start:.2f}s')
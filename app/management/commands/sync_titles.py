@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app import titles
+from app.models import GuildMembership
+from app.sender import get_sender
+
+
+class Command(BaseCommand):
+    help = 'set display names of guild members as their custom titles in guild chats (rate limited, see TITLES_SYNC)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('chat_ids', nargs='*', help='chat ids of the guilds, all guilds when omitted')
+
+    def handle(self, *args, **options):
+        memberships = GuildMembership.objects.exclude(display_name='').select_related('tuser', 'guild')
+        if options['chat_ids']:
+            memberships = memberships.filter(guild__chat_id__in=options['chat_ids'])
+
+        def progress(done, total, membership, result):
+            if options['verbosity'] > 1 or result == 'error' or done == total or done % 50 == 0:
+                self.stdout.write(f'[{done}/{total}] {membership.guild.name} / {membership.display_name}: {result}')
+
+        start = time.perf_counter()
+        summary = titles.sync_guild_titles(get_sender().bot, memberships, progress=progress)
+        results = ', '.join(f'{result} {count}' for result, count in summary.most_common()) or 'nothing to sync'
+        self.stdout.write(f'{results} in {time.perf_counter() - start:.2f}s')
@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand
+
+from app import metrics
+
+SORT_KEYS = {
+    'total': lambda r: r['wall'],
+    'avg': lambda r: r['wall'] / r['count'],
+    'p95': lambda r: r['p95'],
+    'queries': lambda r: r['queries'] / r['count'],
+    'api': lambda r: r['api_time'] / r['count'],
+}
+
+
+def percentile(buckets, count, q):
+    """upper bound of the histogram bucket which holds the `q` quantile"""
+    total = 0
+    for le in [str(b) for b in metrics.HANDLER_BUCKETS] + ['+Inf']:
+        total += buckets.get(le, 0)
+        if total >= q * count:
+            return float(le)
+    return float('inf')
+
+
+def collect(samples):
+    """per command aggregates of the sampled handler spans"""
+    fields = {
+        'handler_seconds_count': 'count',
+        'handler_seconds_sum': 'wall',
+        'handler_queries_total': 'queries',
+        'handler_query_seconds_total': 'query_time',
+        'handler_api_calls_total': 'api_calls',
+        'handler_api_seconds_total': 'api_time',
+    }
+    rows = {}
+    for key, value in samples.items():
+        name, labels = metrics.parse(key)
+        if 'command' not in labels or not name.startswith('handler_'):
+            continue
+        row = rows.setdefault(labels['command'], {'command': labels['command'], 'buckets': {}})
+        if name == 'handler_seconds_bucket':
+            row['buckets'][labels['le']] = value
+        elif name in fields:
+            row[fields[name]] = value
+    result = []
+    for row in rows.values():
+        if not row.get('count'):
+            continue
+        for field in fields.values():
+            row.setdefault(field, 0)
+        row['p95'] = percentile(row['buckets'], row['count'], 0.95)
+        result.append(row)
+    return result
+
+
+class Command(BaseCommand):
+    help = 'bot commands ordered by time spent in them (sampled handler spans from all processes)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sort', choices=sorted(SORT_KEYS), default='total')
+        parser.add_argument('--limit', type=int, default=10)
+
+    def handle(self, *args, **options):
+        rows = sorted(collect(metrics.load()), key=SORT_KEYS[options['sort']], reverse=True)[:options['limit']]
+        if not rows:
+            self.stdout.write('no spans yet (is TRACING["SAMPLE_RATE"] above 0?)')
+            return
+        self.stdout.write(f'{"command":<30} {"spans":>7} {"total s":>9} {"avg ms":>8} {"p95 ms":>8} '
+                          f'{"queries":>8} {"query ms":>9} {"api calls":>9} {"api ms":>8}')
+        for r in rows:
+            count = r['count']
+            self.stdout.write(
+                f'{r["command"]:<30} {count:>7.0f} {r["wall"]:>9.2f} {r["wall"] / count * 1000:>8.1f} '
+                f'{"<=" + format(r["p95"] * 1000, ".0f"):>8} {r["queries"] / count:>8.1f} '
+                f'{r["query_time"] / count * 1000:>9.1f} {r["api_calls"] / count:>9.1f} '
+                f'{r["api_time"] / count * 1000:>8.1f}'
+            )
@@ -0,0 +1,182 @@
+import atexit
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from app.connections import get_redis
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY = 'app:metrics'
+FLUSH_INTERVAL = 10
+LATENESS_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+HANDLER_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HELP = {
+    'notification_lateness_seconds': 'time between Notification.time and the moment its message was sent',
+    'notification_stage_seconds': 'duration of notification_job stages',
+    'notifications_total': 'processed notifications by reason model and result',
+    'handler_seconds': 'wall time of sampled bot handler calls',
+    'handler_queries_total': 'ORM queries made by sampled bot handler calls',
+    'handler_query_seconds_total': 'time spent in ORM queries by sampled bot handler calls',
+    'handler_api_calls_total': 'Bot API requests made by sampled bot handler calls',
+    'handler_api_seconds_total': 'time spent in Bot API requests by sampled bot handler calls',
+}
+TYPES = {
+    'notification_lateness_seconds': 'histogram',
+    'notification_stage_seconds': 'histogram',
+    'notifications_total': 'counter',
+    'handler_seconds': 'histogram',
+    'handler_queries_total': 'counter',
+    'handler_query_seconds_total': 'counter',
+    'handler_api_calls_total': 'counter',
+    'handler_api_seconds_total': 'counter',
+}
+BUCKETS = {
+    'notification_lateness_seconds': LATENESS_BUCKETS,
+    'notification_stage_seconds': STAGE_BUCKETS,
+    'handler_seconds': HANDLER_BUCKETS,
+}
+
+
+def _labels(labels):
+    return ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+
+
+def _sample(name, labels):
+    return f'{name}{{{_labels(labels)}}}' if labels else name
+
+
+class Registry(object):
+    """
+    in-process counters and histograms. Observing is a dict update under a lock; accumulated values are added
+    to a redis hash by `flush()` (at most every FLUSH_INTERVAL seconds), so every process contributes to the same
+    numbers and the web process can render them. Long-running processes call `start()` to flush periodically
+    and at exit
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._last_flush = 0
+        self._thread = None
+
+    def start(self):
+        """flush from a background thread every FLUSH_INTERVAL seconds (also without traffic) and at exit"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush, force=True)
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def inc(self, name, value=1, **labels):
+        key = _sample(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = BUCKETS[name]
+        i = bisect_left(buckets, value)
+        le = str(buckets[i]) if i < len(buckets) else '+Inf'
+        bucket = _sample(f'{name}_bucket', dict(labels, le=le))
+        total = _sample(f'{name}_sum', labels)
+        count = _sample(f'{name}_count', labels)
+        with self._lock:
+            self._values[bucket] = self._values.get(bucket, 0) + 1
+            self._values[total] = self._values.get(total, 0) + value
+            self._values[count] = self._values.get(count, 0) + 1
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('notification_stage_seconds', time.perf_counter() - start, stage=name)
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        with self._lock:
+            if not self._values or (not force and now - self._last_flush < FLUSH_INTERVAL):
+                return
+            values, self._values = self._values, {}
+            self._last_flush = now
+        try:
+            with get_redis().pipeline(transaction=False) as pipe:
+                for key, value in values.items():
+                    pipe.hincrbyfloat(REDIS_KEY, key, value)
+                pipe.execute()
+        except Exception as e:
+            logger.warning(f'can\'t flush metrics: {e}')
+            with self._lock:
+                for key, value in values.items():
+                    self._values[key] = self._values.get(key, 0) + value
+
+
+registry = Registry()
+
+
+def load():
+    """stored samples: {'name{labels}': value}"""
+    return {key.decode(): float(value) for key, value in get_redis().hgetall(REDIS_KEY).items()}
+
+
+def parse(key):
+    """'name{a="1",b="2"}' -> ('name', {'a': '1', 'b': '2'})"""
+    name, _, labels = key.partition('{')
+    if not labels:
+        return name, {}
+    return name, {k: v.strip('"') for k, v in (part.split('=', 1) for part in labels[:-1].split(','))}
+
+
+def render():
+    """stored metrics in prometheus text format"""
+    samples = load()
+
+    families = {}
+    for key, value in samples.items():
+        name = key.split('{', 1)[0]
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in TYPES:
+                name = name[:-len(suffix)]
+        families.setdefault(name, []).append((key, value))
+
+    lines = []
+    for name in sorted(families):
+        lines.append(f'# HELP {name} {HELP.get(name, name)}')
+        lines.append(f'# TYPE {name} {TYPES.get(name, "untyped")}')
+        if TYPES.get(name) == 'histogram':
+            lines.extend(_cumulative(name, families[name]))
+        else:
+            lines.extend(f'{key} {value:g}' for key, value in sorted(families[name]))
+    return '\n'.join(lines) + '\n'
+
+
+def _cumulative(name, samples):
+    """buckets are stored as plain counts, prometheus expects each of them to include all the lower ones"""
+    series = {}
+    other = []
+    for key, value in samples:
+        if key.startswith(f'{name}_bucket{{'):
+            labels = dict(part.split('=', 1) for part in key[len(name) + 8:-1].split(','))
+            le = labels.pop('le').strip('"')
+            series.setdefault(tuple(sorted((k, v.strip('"')) for k, v in labels.items())), {})[le] = value
+        else:
+            other.append((key, value))
+    lines = []
+    for labels, buckets in sorted(series.items()):
+        total = 0
+        for le in [str(b) for b in BUCKETS[name]] + ['+Inf']:
+            total += buckets.get(le, 0)
+            lines.append(f'{_sample(name + "_bucket", dict(labels, le=le))} {total:g}')
+    lines.extend(f'{key} {value:g}' for key, value in sorted(other))
+    return lines
@@ -0,0 +1,28 @@
+# Generated by Django 3.0.6 on 2026-10-16 23:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_auto_20200531_1551_squashed_0011_temporarynpc_expired'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditRecord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField()),
+                ('action', models.CharField(choices=[('created', 'created'), ('changed', 'changed'), ('deleted', 'deleted')], max_length=7)),
+                ('model', models.CharField(max_length=100)),
+                ('object_id', models.PositiveIntegerField(null=True)),
+                ('fields', models.TextField(null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='auditrecord',
+            index=models.Index(fields=['model', 'object_id'], name='app_auditre_model_52c6eb_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.6 on 2026-10-16 23:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_auditrecord'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='temporarynpc',
+            index=models.Index(fields=['in_guild', 'expired', 'at'], name='app_tempora_in_guil_f1f4fb_idx'),
+        ),
+    ]
@@ -1,23 +1,59 @@
 import logging
-import re
+import operator
 import uuid
+from functools import reduce
 
+from django.apps import apps
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericRelation, GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
-from redis import Redis
-from rq_scheduler import Scheduler
-from telegram import ParseMode
-from telegram.ext import Updater
 
-from app.tasks import notification_job
+from app import metrics
+from app.cache import LRUCache, invalidation
+from app.schedule import NotificationSchedule
+from app.scheduler import get_scheduler
+from app.writes import writer
 
 logger = logging.getLogger(__name__)
 
 
+def _identity_cache():
+    config = getattr(settings, 'IDENTITY_CACHE', {})
+    return LRUCache(maxsize=config.get('MAXSIZE', 10000), ttl=config.get('TTL', 300))
+
+
+# instances are cached on load and replaced when a save in this process commits; changes made by other processes
+# (e.g. the admin) are seen after IDENTITY_CACHE['TTL'], saves of other shards of the bot at once (see
+# app.cache.Invalidation). Callers get their own copy, cached instances are never modified. Cached instances may be
+# stale, so their changes are saved with update_fields
+guild_cache = _identity_cache()  # chat_id -> Guild
+user_cache = _identity_cache()  # chat_id -> TelegramUser
+membership_cache = _identity_cache()  # (guild pk, tuser pk) -> GuildMembership
+invalidation.register('guild', guild_cache)
+invalidation.register('user', user_cache)
+invalidation.register('membership', membership_cache)
+
+
+def _detached(obj):
+    """new instance with the field values of `obj`"""
+    fields = obj._meta.concrete_fields
+    return type(obj).from_db(obj._state.db, [f.attname for f in fields], [getattr(obj, f.attname) for f in fields])
+
+
+def _cache_on_commit(name, key, obj):
+    """cache a copy of just saved `obj` unless the transaction is rolled back, other processes drop their copy"""
+    obj = _detached(obj)
+    cache = invalidation.caches[name]
+
+    def commit():
+        cache.set(key, obj)
+        invalidation.publish(name, key)
+    transaction.on_commit(commit)
+
+
 class TelegramUser(models.Model):
     django = models.OneToOneField(User, on_delete=models.CASCADE, related_name='telegram')
     first_name = models.CharField(max_length=30, null=True)
@@ -27,23 +63,36 @@ class TelegramUser(models.Model):
 
     chat_id = models.CharField(max_length=20)
 
+    PROFILE_FIELDS = ('first_name', 'last_name', 'link', 'name')
+
+    @classmethod
+    def get_cached(cls, chat_id):
+        """throws TelegramUser.DoesNotExist"""
+        obj = user_cache.get(str(chat_id))
+        if obj is None:
+            obj = cls.objects.get(chat_id=chat_id)
+            user_cache.set(str(chat_id), _detached(obj))
+            return obj
+        return _detached(obj)
+
     @classmethod
     def get_or_create_by_api(cls, api_user):
-        created = False
+        """the profile is written only if it differs from `api_user`"""
+        profile = {field: getattr(api_user, field) for field in cls.PROFILE_FIELDS}
         try:
-            obj = cls.objects.get(chat_id=api_user.id)
+            obj = cls.get_cached(api_user.id)
         except cls.DoesNotExist:
             user = User.objects.create(username=uuid.uuid4())
-            obj = cls.objects.create(django=user, chat_id=api_user.id)
-            created = True
-
-        obj.first_name = api_user.first_name
-        obj.last_name = api_user.last_name
-        obj.link = api_user.link
-        obj.name = api_user.name
-        obj.save()
+            obj = cls.objects.create(django=user, chat_id=str(api_user.id), **profile)
+            return obj, True
 
-        return obj, created
+        changed = [field for field, value in profile.items() if getattr(obj, field) != value]
+        if changed:
+            for field in changed:
+                setattr(obj, field, profile[field])
+            # nobody needs to wait for the row, the cache is refreshed when it is written
+            writer.save(obj, changed, wait=False)
+        return obj, False
 
     def get_display_name_for_guild(self, guild):
         """
@@ -51,21 +100,21 @@ class TelegramUser(models.Model):
         :return: string - display_name from GuildMembership or self.name
         throws GuildMembership.DoesNotExist if user is not member of guild
         """
-        name = GuildMembership.objects.get(tuser=self, guild=guild).display_name
+        name = GuildMembership.get_cached(self, guild).display_name
         return name or self.name
 
     def set_display_name_for_guild(self, name, guild):
-        obj = GuildMembership.objects.get(tuser=self, guild=guild)
+        obj = GuildMembership.get_cached(self, guild)
         obj.display_name = name
-        obj.save()
+        obj.save(update_fields=['display_name'])
 
     def mention_html_for_guild(self, guild):
         from telegram.utils.helpers import mention_html
         return mention_html(int(self.chat_id), self.get_display_name_for_guild(guild))
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        logger.info('create TelegramUser pk {}'.format(self.pk))
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        _cache_on_commit('user', str(self.chat_id), self)
 
     def __str__(self):
         return self.name
@@ -77,19 +126,40 @@ class Guild(models.Model):
     chat_id = models.CharField(max_length=20)
     additional_notifications = models.CharField(max_length=100, default='')
 
+    @classmethod
+    def get_by_chat_id(cls, chat_id):
+        """throws Guild.DoesNotExist"""
+        obj = guild_cache.get(str(chat_id))
+        if obj is None:
+            obj = cls.objects.get(chat_id=chat_id)
+            guild_cache.set(str(chat_id), _detached(obj))
+            return obj
+        return _detached(obj)
+
     def make_sure_user_is_member(self, tuser):
-        added = False
         try:
-            self.members.get(pk=tuser.pk)
-        except TelegramUser.DoesNotExist:
+            GuildMembership.get_cached(tuser, self)
+        except GuildMembership.DoesNotExist:
             GuildMembership.objects.create(tuser=tuser, guild=self)
-            logger.info('add TelegramUser pk {} as member to Guild pk {}', tuser.pk, self.pk)
-            added = True
-        return added
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        logger.info('create Guild pk {}'.format(self.pk))
+            logger.info('add TelegramUser pk {} as member to Guild pk {}'.format(tuser.pk, self.pk))
+            return True
+        return False
+
+    def set_additional_notifications(self, string):
+        """throws ValueError if `string` is not a schedule"""
+        string = ''.join(string.split())
+        schedule = NotificationSchedule.get(string)
+        self.additional_notifications = string
+        self.save(update_fields=['additional_notifications'])
+        return schedule
+
+    @property
+    def notification_schedule(self):
+        return NotificationSchedule.get(self.additional_notifications)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        _cache_on_commit('guild', str(self.chat_id), self)
 
     def __str__(self):
         return self.name
@@ -102,6 +172,55 @@ class GuildMembership(models.Model):
     display_name = models.CharField(max_length=16, blank=True)
     # TODO: history of name changes ?
 
+    @classmethod
+    def get_cached(cls, tuser, guild):
+        """throws GuildMembership.DoesNotExist"""
+        obj = membership_cache.get((guild.pk, tuser.pk))
+        if obj is None:
+            obj = cls.objects.filter(tuser=tuser, guild=guild).first()
+            if obj is None:
+                raise cls.DoesNotExist
+            membership_cache.set((guild.pk, tuser.pk), _detached(obj))
+            return obj
+        return _detached(obj)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        _cache_on_commit('membership', (self.guild_id, self.tuser_id), self)
+
+
+class NotificationQuerySet(models.QuerySet):
+    def pending(self):
+        return self.filter(canceled=False, notified=False)
+
+    def for_chat(self, chat_id):
+        """notifications caused by any ActionMixin model in the guild with `chat_id`"""
+        return self.filter(reduce(operator.or_, [
+            models.Q(
+                content_type=ContentType.objects.get_for_model(model),
+                object_id__in=model.objects.filter(in_guild__chat_id=chat_id).values('pk'),
+            )
+            for model in ActionMixin.get_models()
+        ]))
+
+    def cancel(self):
+        """
+        cancel every pending notification of the queryset with one UPDATE and one scheduler round trip
+        :return: number of cancelled notifications
+        """
+        with transaction.atomic():
+            pending = self.pending()
+            rows = list(pending.values_list('job_id', 'content_type'))
+            if not rows:
+                return 0
+            count = pending.update(canceled=True)
+            get_scheduler().cancel_many([job_id for job_id, _ in rows])
+        for _, content_type in rows:
+            metrics.registry.inc('notifications_total', model=ContentType.objects.get_for_id(content_type).model,
+                                 result='cancelled')
+        logger.info('cancelled {} future Notifications'.format(count))
+        return count
+
 
 class Notification(models.Model):
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
@@ -114,6 +233,8 @@ class Notification(models.Model):
     canceled = models.BooleanField(default=False)
     notified = models.BooleanField(default=False)
 
+    objects = NotificationQuerySet.as_manager()
+
     @classmethod
     def filter_by_reason(cls, obj_or_model):
         from django.db.models.base import ModelBase
@@ -133,21 +254,20 @@ class Notification(models.Model):
             if cls.objects.filter(content_type=content_type, object_id=reason.id, number__gte=number).exists():
                 return None  # exception?
         #cls.objects.filter(content_type=content_type, object_id=)
-        obj = cls.objects.create(time=at_time, caused_by=reason, number=number)
-        scheduler = Scheduler(connection=Redis())
-        job = scheduler.enqueue_at(at_time, notification_job, obj.pk)
+        scheduler = get_scheduler()
+        obj = cls.objects.create(time=at_time, caused_by=reason, number=number, job_id=scheduler.new_job_id())
+        scheduler.enqueue_at(at_time, obj.pk, obj.job_id)
         logger.info('Notification pk {}: enqueue job to scheduler'.format(obj.pk))
-        obj.job_id = job.id
-        obj.save()
 
         return obj
 
     def cancel(self):
         logger.info('cancelling future Notification pk {}'.format(self.pk))
-        scheduler = Scheduler(connection=Redis())
-        scheduler.cancel(self.job_id)
+        get_scheduler().cancel(self.job_id)
         self.canceled = True
         self.save()
+        metrics.registry.inc('notifications_total', model=ContentType.objects.get_for_id(self.content_type_id).model,
+                             result='cancelled')
 
     def __str__(self):
         return "{} - {}".format(self.caused_by, self.number)
@@ -161,10 +281,19 @@ class ActionMixin(models.Model):
     in_guild = models.ForeignKey(Guild, on_delete=models.PROTECT)
     # notifications = GenericRelation(Notification, related_query_name='caused_by')
 
-    def notify(self, notification):
-        """this method will be called from rq queue"""
+    @classmethod
+    def get_models(cls):
+        """installed models implementing ActionMixin (historical models built by migrations subclass it too)"""
+        return [model for model in apps.get_app_config('app').get_models() if issubclass(model, cls)]
+
+    def render_notification(self, notification):
+        """HTML text of the notification"""
         raise NotImplementedError
 
+    def notification_sent(self, notification):
+        """side effects of the sent notification"""
+        pass
+
     def get_next_notification_delta(self, last_notification):
         return None
 
@@ -174,57 +303,23 @@ class ResourceCollection(ActionMixin):
 
     @classmethod
     def create(cls, tuser, guild, time=None):
+        """the pending notifications of the guild's previous collections are cancelled"""
         if time is None:
             time = timezone.now()
         obj = cls.objects.create(by=tuser, at=time, in_guild=guild)
-
-        for notification in Notification.objects.filter(
-                canceled=False,
-                notified=False,
-                resource_collection__in_guild=guild):
-            notification.cancel()
+        Notification.objects.filter(resource_collection__in_guild=guild).cancel()
 
         Notification.create(obj, time + timezone.timedelta(seconds=30))  # TODO: change interval to 8 hours
         return obj
 
-    def notify(self, notification):
-        updater = Updater(token=settings.TELEGRAM_TOKEN, use_context=True)
+    def render_notification(self, notification):
         # TODO: make this message customization
         if notification.number == 0:
-            message = "Согласно моим данным, ресурсы переполнились."
-        else:
-            message = "Повторяю: ресурсы переполнились и никто их не хочет собирать!"
-        updater.bot.send_message(self.in_guild.chat_id, message)
-        logger.info("  message sent to chat {}, which stored in Guild pk {}".format(
-            self.in_guild.chat_id,
-            self.in_guild.pk)
-        )
+            return "Согласно моим данным, ресурсы переполнились."
+        return "Повторяю: ресурсы переполнились и никто их не хочет собирать!"
 
     def get_next_notification_delta(self, last_notification):
-        def generator():
-            string = self.in_guild.additional_notifications
-            regexp = re.compile(r'\+(\d+)([mh])(?:\[(\d+|\*)\])?')
-            for t in regexp.findall(string):
-                minutes = int(t[0]) * (60 if t[1] == 'h' else 1)
-                repeat = t[2]
-                if repeat == '*':
-                    while True:
-                        yield minutes
-                repeat = int(repeat) if repeat != '' else 1
-                for _ in range(repeat):
-                    yield minutes
-
-        skip = last_notification.number
-        for minutes in generator():
-            if skip > 0:
-                skip -= 1
-                continue
-            return timezone.timedelta(minutes=minutes)
-        return None
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        logger.info('create ResourceCollection object pk {}'.format(self.pk))
+        return self.in_guild.notification_schedule.delta(last_notification.number)
 
     def __str__(self):
         return "{} - {}".format(self.in_guild.name, self.at.astimezone().strftime("%d.%m.%y %H:%M"))
@@ -235,6 +330,9 @@ class TemporaryNPC(ActionMixin):
     caption = models.CharField(max_length=50)
     expired = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [models.Index(fields=['in_guild', 'expired', 'at'])]
+
     @classmethod
     def create(cls, caption=None, by=None, in_guild=None, ended_at=None):
         if not caption or not by or not in_guild or not ended_at:
@@ -251,21 +349,21 @@ class TemporaryNPC(ActionMixin):
             Notification.create(obj, ended_at - timezone.timedelta(days=1))
         return obj
 
-    def notify(self, notification):
-        updater = Updater(token=settings.TELEGRAM_TOKEN, use_context=True)
+    def render_notification(self, notification):
         if notification.number == 0:
-            text = f'По моим данным, <b>{self.caption}</b> уходит через сутки. Теперь игра показывает не только ' \
+            return f'По моим данным, <b>{self.caption}</b> уходит через сутки. Теперь игра показывает не только ' \
                    f'оставшиеся часы, но ещё и минуты. Сверьте их, пожалуйста, для более точного уведомления об ' \
                    f'окончании.\nКто-угодно, находясь в игре, вызовите у бота команду /get_npc_list'
         elif notification.number == 1:
-            text = f'Через час закончится время, когда <b>{self.caption}</b> находится в крепости.'
+            return f'Через час закончится время, когда <b>{self.caption}</b> находится в крепости.'
         elif notification.number == 2:
-            text = f'Осталось лишь 15 минут! <b>{self.caption}</b> уже написал завещание!'
-        else:
-            text = f'<b>{self.caption}</b> ушёл из крепости.'
+            return f'Осталось лишь 15 минут! <b>{self.caption}</b> уже написал завещание!'
+        return f'<b>{self.caption}</b> ушёл из крепости.'
+
+    def notification_sent(self, notification):
+        if notification.number == 3:
             self.expired = True
-            self.save()
-        updater.bot.send_message(self.in_guild.chat_id, text, parse_mode=ParseMode.HTML)
+            self.save(update_fields=['expired'])
 
     def get_next_notification_delta(self, last_notification):
         if last_notification.number == 0:
@@ -278,3 +376,20 @@ class TemporaryNPC(ActionMixin):
 
     def __str__(self):
         return f'({self.pk}) {self.caption} - {self.in_guild.name}'
+
+
+class AuditRecord(models.Model):
+    """creation, change or deletion of a model instance, written in batches by app.audit"""
+    ACTIONS = (('created', 'created'), ('changed', 'changed'), ('deleted', 'deleted'))
+
+    time = models.DateTimeField()
+    action = models.CharField(max_length=7, choices=ACTIONS)
+    model = models.CharField(max_length=100)
+    object_id = models.PositiveIntegerField(null=True)
+    fields = models.TextField(null=True)  # comma separated update_fields of a change, empty when all were saved
+
+    class Meta:
+        indexes = [models.Index(fields=['model', 'object_id'])]
+
+    def __str__(self):
+        return f'{self.time:%d.%m.%y %H:%M:%S} {self.action} {self.model} {self.object_id}'
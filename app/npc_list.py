@@ -0,0 +1,98 @@
+"""
+/get_npc_list of a guild: active TemporaryNPC rows are cached in redis per guild (shared by every bot process) as
+(end time, pre-rendered line), only the countdowns are rendered at request time. post_save/post_delete of
+TemporaryNPC drop the guild's entry after the transaction commits (connected in AppConfig.ready)
+"""
+import json
+import logging
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+from redis.exceptions import RedisError
+from telegram import constants
+
+from app.connections import get_redis
+
+logger = logging.getLogger(__name__)
+
+KEY = 'app:npc_list:{}'
+TTL = 60 * 60
+HEADER = 'Список NPC:\n'
+EMPTY = 'пока что пуст. Добавьте новых с помощью /new_npc'
+
+
+def _load(guild):
+    from app.models import TemporaryNPC
+    rows = TemporaryNPC.objects.filter(in_guild=guild, expired=False).order_by('at').values_list('at', 'caption')
+    return [(at.timestamp(), f'<i>{caption}</i>') for at, caption in rows]
+
+
+def get_rows(guild):
+    """[(end timestamp, caption html)] of the guild's active NPCs ordered by end time"""
+    redis = get_redis()
+    key = KEY.format(guild.pk)
+    try:
+        cached = redis.get(key)
+    except RedisError as e:
+        logger.warning(f'can\'t read npc list of guild pk {guild.pk}: {e}')
+        return _load(guild)
+    if cached is not None:
+        return json.loads(cached)
+    rows = _load(guild)
+    try:
+        redis.set(key, json.dumps(rows), ex=TTL)
+    except RedisError as e:
+        logger.warning(f'can\'t cache npc list of guild pk {guild.pk}: {e}')
+    return rows
+
+
+def invalidate(guild_id):
+    try:
+        get_redis().delete(KEY.format(guild_id))
+    except RedisError as e:
+        logger.warning(f'can\'t invalidate npc list of guild pk {guild_id}: {e}')
+
+
+def countdown(delta):
+    if delta.total_seconds() <= 0:
+        return ''
+    text = ''
+    if delta.days > 0:
+        text += f'{delta.days}d'
+    hours = delta.seconds // 3600
+    if hours > 0:
+        text += f' {hours}h'
+    minutes = delta.seconds % 3600 // 60
+    if minutes > 0:
+        text += f' {minutes}m'
+    return text
+
+
+def render(rows, now=None):
+    """message texts of the list, each one shorter than MAX_MESSAGE_LENGTH"""
+    if not rows:
+        return [HEADER + EMPTY]
+    now = (now or timezone.now()).timestamp()
+    pages = []
+    page = HEADER
+    for i, (at, caption) in enumerate(rows):
+        delta_text = countdown(timezone.timedelta(seconds=at - now)) or '<i>ожидание сообщения об окончании</i>'
+        line = f'<code>{i+1}</code> <u>{delta_text}</u> {caption}\n'
+        if len(page) + len(line) > constants.MAX_MESSAGE_LENGTH:
+            pages.append(page)
+            page = ''
+        page += line
+    pages.append(page)
+    return pages
+
+
+def _on_change(sender, instance, **kwargs):
+    guild_id = instance.in_guild_id
+    transaction.on_commit(lambda: invalidate(guild_id))
+
+
+def connect():
+    from app.models import TemporaryNPC
+    post_save.connect(_on_change, sender=TemporaryNPC, dispatch_uid='npc_list_save')
+    post_delete.connect(_on_change, sender=TemporaryNPC, dispatch_uid='npc_list_delete')
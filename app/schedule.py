@@ -0,0 +1,97 @@
+import re
+from bisect import bisect_right
+from functools import lru_cache
+
+from django.utils import timezone
+
+SCHEDULE_RE = re.compile(r'^(?:\+\d+[mh](?:\[(\d+|\*)\])?)*$')
+ITEM_RE = re.compile(r'\+(\d+)([mh])(?:\[(\d+|\*)\])?')
+
+
+class NotificationSchedule(object):
+    """
+    compiled schedule of additional notifications like `+15m[2] +30m +1h[*]`.
+    It is a finite prefix of intervals (stored as runs of equal intervals) and an optional interval which repeats
+    forever after the prefix. Intervals are in minutes, the interval with index `n` separates notifications `n` and
+    `n + 1`
+    """
+
+    def __init__(self, runs=(), tail=None):
+        self.runs = tuple(runs)
+        self.tail = tail
+        self._ends = []
+        self._offsets = []
+        length = minutes = 0
+        for count, interval in self.runs:
+            self._offsets.append(minutes)
+            length += count
+            minutes += count * interval
+            self._ends.append(length)
+        self.length = length
+        self.prefix_minutes = minutes
+
+    @classmethod
+    def parse(cls, string):
+        """throws ValueError if `string` is not a schedule"""
+        string = ''.join(string.split())
+        if SCHEDULE_RE.match(string) is None:
+            raise ValueError(f'wrong schedule format: {string}')
+        runs = []
+        tail = None
+        for amount, unit, repeat in ITEM_RE.findall(string):
+            interval = int(amount) * (60 if unit == 'h' else 1)
+            if repeat == '*':
+                tail = interval
+                break  # nothing after an infinite repeat is reachable
+            count = int(repeat) if repeat != '' else 1
+            if count == 0:
+                continue
+            if runs and runs[-1][1] == interval:
+                runs[-1] = (runs[-1][0] + count, interval)
+            else:
+                runs.append((count, interval))
+        return cls(runs, tail)
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def get(string):
+        """compiled schedule, cached by its string"""
+        return NotificationSchedule.parse(string)
+
+    def interval(self, number):
+        """minutes between notifications `number` and `number + 1` or None if the schedule ends earlier"""
+        if number < self.length:
+            return self.runs[bisect_right(self._ends, number)][1]
+        return self.tail
+
+    def delta(self, number):
+        interval = self.interval(number)
+        return timezone.timedelta(minutes=interval) if interval is not None else None
+
+    def offset(self, number):
+        """minutes between notifications 0 and `number` or None if there is no such notification"""
+        if number <= self.length:
+            if number == self.length:
+                return self.prefix_minutes
+            i = bisect_right(self._ends, number)
+            count, interval = self.runs[i]
+            return self._offsets[i] + (number - (self._ends[i] - count)) * interval
+        if self.tail is None:
+            return None
+        return self.prefix_minutes + (number - self.length) * self.tail
+
+    def fire_times(self, start, k, number=0):
+        """times of (at most `k`) notifications following the notification `number`, which fires at `start`"""
+        base = self.offset(number)
+        times = []
+        if base is None:
+            return times
+        for n in range(number + 1, number + k + 1):
+            offset = self.offset(n)
+            if offset is None:
+                break
+            times.append(start + timezone.timedelta(minutes=offset - base))
+        return times
+
+    def __bool__(self):
+        return bool(self.runs) or self.tail is not None
@@ -0,0 +1,218 @@
+import logging
+import threading
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+from rq.registry import StartedJobRegistry
+from rq_scheduler import Scheduler
+from rq_scheduler.utils import to_unix
+
+from app.connections import get_redis
+from app.tasks import notification_job
+
+logger = logging.getLogger(__name__)
+
+
+class Batch(object):
+    """collects enqueue/cancel operations and passes all of them to the backend at once"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.to_enqueue = []
+        self.to_cancel = []
+
+    def enqueue_at(self, at_time, notification_pk, job_id=None):
+        job_id = job_id or self.backend.new_job_id()
+        self.to_enqueue.append((at_time, notification_pk, job_id))
+        return job_id
+
+    def cancel(self, job_id):
+        if job_id:
+            self.to_cancel.append(job_id)
+
+    def execute(self):
+        if not self.to_enqueue and not self.to_cancel:
+            return
+        self.backend.execute(self.to_enqueue, self.to_cancel)
+        logger.info('scheduler batch: {} enqueued, {} cancelled'.format(len(self.to_enqueue), len(self.to_cancel)))
+        self.to_enqueue = []
+        self.to_cancel = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+
+
+class BaseSchedulerBackend(object):
+    """runs `notification_job(notification_pk)` at the given time"""
+
+    def new_job_id(self):
+        return str(uuid.uuid4())
+
+    def execute(self, to_enqueue, to_cancel):
+        """to_enqueue are (at_time, notification_pk, job_id) tuples, to_cancel are job ids"""
+        raise NotImplementedError
+
+    def start(self):
+        """called by the process which is going to run the jobs"""
+        pass
+
+    def scheduled_job_ids(self):
+        """ids of all the jobs which are going to run"""
+        raise NotImplementedError
+
+    def running_job_ids(self):
+        """ids of the jobs which are running right now"""
+        return set()
+
+    def drop_orphans(self, job_ids):
+        """forget jobs which have no pending notification. Returns the number of dropped jobs"""
+        raise NotImplementedError
+
+    def batch(self):
+        return Batch(self)
+
+    def enqueue_at(self, at_time, notification_pk, job_id=None):
+        with self.batch() as batch:
+            return batch.enqueue_at(at_time, notification_pk, job_id)
+
+    def cancel(self, job_id):
+        with self.batch() as batch:
+            batch.cancel(job_id)
+
+    def enqueue_many(self, items):
+        """items are (at_time, notification_pk, job_id) tuples. Returns the list of job ids"""
+        with self.batch() as batch:
+            return [batch.enqueue_at(*item) for item in items]
+
+    def cancel_many(self, job_ids):
+        with self.batch() as batch:
+            for job_id in job_ids:
+                batch.cancel(job_id)
+
+
+class RQSchedulerBackend(BaseSchedulerBackend):
+    """rq-scheduler over the shared connection pool of RQ_QUEUES[queue_name]"""
+
+    def __init__(self, queue_name='default'):
+        self.queue_name = queue_name
+        self.timeout = settings.RQ_QUEUES[queue_name].get('DEFAULT_TIMEOUT')
+        self.scheduler = Scheduler(queue_name=queue_name, connection=get_redis(queue_name))
+        self.queue_key = self.scheduler.queue_class(queue_name, connection=self.scheduler.connection).key
+
+    def create_job(self, notification_pk, job_id=None):
+        return self.scheduler._create_job(notification_job, args=(notification_pk,), id=job_id,
+                                          timeout=self.timeout, commit=False)
+
+    def execute(self, to_enqueue, to_cancel):
+        key = self.scheduler.scheduled_jobs_key
+        with self.scheduler.connection.pipeline() as pipe:
+            for at_time, notification_pk, job_id in to_enqueue:
+                self.create_job(notification_pk, job_id).save(pipeline=pipe)
+            if to_enqueue:
+                pipe.zadd(key, {job_id: to_unix(at_time) for at_time, _, job_id in to_enqueue})
+            if to_cancel:
+                pipe.zrem(key, *to_cancel)
+            pipe.execute()
+
+    def scheduled_job_ids(self):
+        """scheduled jobs and jobs already moved by rq-scheduler to the queue"""
+        connection = self.scheduler.connection
+        with connection.pipeline(transaction=False) as pipe:
+            pipe.zrange(self.scheduler.scheduled_jobs_key, 0, -1)
+            pipe.lrange(self.queue_key, 0, -1)
+            scheduled, queued = pipe.execute()
+        return {job_id.decode() for job_id in scheduled} | {job_id.decode() for job_id in queued}
+
+    def running_job_ids(self):
+        registry = StartedJobRegistry(self.queue_name, connection=self.scheduler.connection)
+        return set(registry.get_job_ids())
+
+    def drop_orphans(self, job_ids):
+        """only notification jobs are dropped, everything else in the queue is not ours to judge"""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return 0
+        job_class = self.scheduler.job_class
+        connection = self.scheduler.connection
+        with connection.pipeline(transaction=False) as pipe:
+            for job_id in job_ids:
+                pipe.hget(job_class.key_for(job_id), 'description')
+            descriptions = pipe.execute()
+        func_name = '{}.{}'.format(notification_job.__module__, notification_job.__name__)
+        orphans = [job_id for job_id, description in zip(job_ids, descriptions)
+                   if description is None or description.decode().startswith(func_name)]
+        if orphans:
+            with connection.pipeline() as pipe:
+                pipe.zrem(self.scheduler.scheduled_jobs_key, *orphans)
+                for job_id in orphans:
+                    pipe.lrem(self.queue_key, 0, job_id)
+                pipe.delete(*[job_class.key_for(job_id) for job_id in orphans])
+                pipe.execute()
+        return len(orphans)
+
+
+def reconcile(backend=None, dry_run=False, chunk_size=5000):
+    """
+    make the backend's jobs match pending notifications: jobs lost by the backend (e.g. flushed redis) are enqueued
+    again, jobs without a pending notification are dropped. Running jobs are neither: their notification is about to
+    be sent or has just been.
+    :return: (number of re-enqueued jobs, number of dropped jobs)
+    """
+    from django.apps import apps
+    Notification = apps.get_model('app', 'Notification')
+    backend = backend or get_scheduler()
+
+    pending = {}
+    without_job = []
+    for pk, at_time, job_id in Notification.objects.pending().values_list('pk', 'time', 'job_id').iterator():
+        if job_id:
+            pending[job_id] = (at_time, pk)
+        else:
+            without_job.append((at_time, pk, None))
+    scheduled = backend.scheduled_job_ids()
+    running = backend.running_job_ids()
+    missing = [(at_time, pk, job_id) for job_id, (at_time, pk) in pending.items()
+               if job_id not in scheduled and job_id not in running]
+    missing += without_job
+    orphans = scheduled - pending.keys() - running
+    logger.info('reconcile: {} pending notifications, {} scheduled jobs, {} running, {} missing, {} orphans'.format(
+        len(pending) + len(without_job), len(scheduled), len(running), len(missing), len(orphans)))
+    if dry_run:
+        return len(missing), len(orphans)
+
+    for i in range(0, len(missing), chunk_size):
+        chunk = missing[i:i + chunk_size]
+        job_ids = backend.enqueue_many(chunk)
+        without_job = [Notification(pk=pk, job_id=job_id)
+                       for job_id, (_, pk, old_job_id) in zip(job_ids, chunk) if old_job_id is None]
+        # one transaction per chunk, not a commit per row
+        with transaction.atomic():
+            Notification.objects.bulk_update(without_job, ['job_id'], batch_size=chunk_size)
+    dropped = backend.drop_orphans(orphans)
+    return len(missing), dropped
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+BACKENDS = {
+    'rq': 'app.scheduler.RQSchedulerBackend',
+    'timer': 'app.timers.TimerSchedulerBackend',
+}
+
+
+def get_scheduler():
+    """process-wide backend chosen by NOTIFICATION_SCHEDULER setting"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                name = getattr(settings, 'NOTIFICATION_SCHEDULER', 'rq')
+                _scheduler = import_string(BACKENDS.get(name, name))()
+    return _scheduler
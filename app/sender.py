@@ -0,0 +1,221 @@
+"""
+outgoing Bot API calls. SendRequest is the Request of every Bot in the project (bot and worker processes): it sends
+to the new id of migrated chats, repeats calls which failed with transient network errors after a jittered
+exponential backoff (calls which change something only if the connection couldn't be made) and leaves RetryAfter
+to the caller, which reschedules instead of sleeping (notification jobs are enqueued again, the bot uses its
+JobQueue - see call_or_defer). Sender adds Telegram's rate limits on top
+"""
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+from django.apps import apps
+from django.conf import settings
+from telegram import Bot
+from telegram.error import BadRequest, ChatMigrated, NetworkError, RetryAfter
+from telegram.utils.request import Request, urllib3
+
+from app.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class ChatRemap(object):
+    """old -> new ids of chats which became supergroups. Adding a pair moves the guild to the new id in one write"""
+
+    def __init__(self, maxsize=10000):
+        self._cache = LRUCache(maxsize=maxsize, ttl=float('inf'))
+
+    def resolve(self, chat_id):
+        return self._cache.get(str(chat_id), chat_id)
+
+    def add(self, old_chat_id, new_chat_id):
+        from app.cache import invalidation
+        from app.models import guild_cache
+        old_chat_id, new_chat_id = str(old_chat_id), str(new_chat_id)
+        self._cache.set(old_chat_id, int(new_chat_id))
+        updated = apps.get_model('app', 'Guild').objects.filter(chat_id=old_chat_id).update(chat_id=new_chat_id)
+        guild_cache.delete(old_chat_id)
+        invalidation.publish('guild', old_chat_id)
+        logger.info(f'chat {old_chat_id} migrated to {new_chat_id}, {updated} guild(s) moved')
+
+
+chat_remap = ChatRemap()
+
+
+def backoff(attempt, base=0.5, cap=10):
+    """'full jitter' exponential backoff: a random delay up to base * 2 ** attempt (at most cap) seconds"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_unsent(error):
+    """whether the NetworkError was raised before the request left the process: connection refused or timed out"""
+    cause = error.__cause__ or error.__context__
+    if isinstance(cause, urllib3.exceptions.MaxRetryError):
+        cause = cause.reason
+    # NewConnectionError (e.g. connection refused) is a ConnectTimeoutError too
+    return isinstance(cause, urllib3.exceptions.ConnectTimeoutError)
+
+
+class SendRequest(Request):
+    """
+    Request which replaces chat_id of migrated chats (learning new ids from ChatMigrated errors) and retries
+    transient errors up to `retries` times. Other than get* methods are retried only when the request wasn't sent
+    (see is_unsent): after a timeout, a 5xx response or a broken connection a message may have been delivered
+    """
+
+    def __init__(self, *args, retries=3, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retries = retries
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        migrated = False
+        attempt = 0
+        while True:
+            request_data = dict(data)
+            if 'chat_id' in request_data:
+                request_data['chat_id'] = chat_remap.resolve(request_data['chat_id'])
+            try:
+                return super().post(url, request_data, timeout=timeout)
+            except ChatMigrated as e:
+                if migrated:
+                    raise
+                migrated = True
+                chat_remap.add(request_data['chat_id'], e.new_chat_id)
+            except BadRequest:
+                raise
+            except NetworkError as e:
+                if attempt >= self.retries or not (method.startswith('get') or is_unsent(e)):
+                    raise
+                delay = backoff(attempt)
+                attempt += 1
+                logger.warning(f'{method} failed with "{e}", retry {attempt} in {delay:.2f}s')
+                time.sleep(delay)
+
+
+def call_or_defer(job_queue, method, *args, on_sent=None, **kwargs):
+    """
+    calls the Bot API `method` (e.g. a bound Bot.send_message or Message.reply_text), which is repeated by
+    `job_queue` when Telegram asks to retry later, for the bot process. Returns the result or None if the call was
+    deferred; `on_sent(result)` is called when the call succeeds, immediately or later
+    """
+    try:
+        result = method(*args, **kwargs)
+    except RetryAfter as e:
+        delay = e.retry_after * random.uniform(1, 1.2)
+        logger.info(f'flood control on {getattr(method, "__name__", "call")}, deferred by {delay:.1f}s')
+        job_queue.run_once(lambda context: call_or_defer(job_queue, method, *args, on_sent=on_sent, **kwargs), delay)
+        return None
+    if on_sent is not None:
+        on_sent(result)
+    return result
+
+
+def send_or_defer(bot, job_queue, chat_id, text, **kwargs):
+    """send_message through call_or_defer"""
+    return call_or_defer(job_queue, bot.send_message, chat_id, text, **kwargs)
+
+
+class RateLimiter(object):
+    """sliding window limiter: no more than `burst` calls within any `period` seconds"""
+
+    def __init__(self, burst, period):
+        self.burst = burst
+        self.period = period
+        self._slots = deque()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """reserve the nearest free slot and return the number of seconds to wait for it"""
+        with self._lock:
+            now = time.monotonic()
+            while self._slots and self._slots[0] <= now - self.period:
+                self._slots.popleft()
+            at = now
+            if len(self._slots) >= self.burst:
+                at = max(now, self._slots[-self.burst] + self.period)
+            self._slots.append(at)
+            return at - now
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def is_idle(self):
+        with self._lock:
+            return not self._slots or self._slots[-1] <= time.monotonic() - self.period
+
+
+class Sender(object):
+    """
+    One Bot with a keep-alive connection pool for the whole process. Every outgoing message passes through
+    the global limiter and, for group chats, through the limiter of that chat
+    """
+
+    def __init__(self, token, base_url=None, con_pool_size=8, all_burst_limit=30, all_time_limit=1,
+                 group_burst_limit=20, group_time_limit=60, retries=3):
+        self.bot = Bot(token, base_url=base_url, request=SendRequest(con_pool_size=con_pool_size, retries=retries))
+        self.all_limiter = RateLimiter(all_burst_limit, all_time_limit)
+        self.group_burst_limit = group_burst_limit
+        self.group_time_limit = group_time_limit
+        self._chat_limiters = {}
+        self._chat_limiters_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        conf = getattr(settings, 'TELEGRAM_SENDER', {})
+        return cls(
+            settings.TELEGRAM_TOKEN,
+            base_url=getattr(settings, 'TELEGRAM_BASE_URL', None),
+            con_pool_size=conf.get('CON_POOL_SIZE', 8),
+            all_burst_limit=conf.get('ALL_BURST_LIMIT', 30),
+            all_time_limit=conf.get('ALL_TIME_LIMIT', 1),
+            group_burst_limit=conf.get('GROUP_BURST_LIMIT', 20),
+            group_time_limit=conf.get('GROUP_TIME_LIMIT', 60),
+            retries=conf.get('RETRIES', 3),
+        )
+
+    def get_chat_limiter(self, chat_id):
+        """limiter of the group chat or None for private chats"""
+        if int(chat_id) > 0:
+            return None
+        with self._chat_limiters_lock:
+            limiter = self._chat_limiters.get(chat_id)
+            if limiter is None:
+                if len(self._chat_limiters) > 1000:
+                    self._chat_limiters = {k: v for k, v in self._chat_limiters.items() if not v.is_idle()}
+                limiter = self._chat_limiters[chat_id] = RateLimiter(self.group_burst_limit, self.group_time_limit)
+            return limiter
+
+    def wait(self, chat_id):
+        """block until a message to `chat_id` can be sent without breaking the limits"""
+        waited = 0
+        chat_limiter = self.get_chat_limiter(str(chat_remap.resolve(chat_id)))
+        if chat_limiter is not None:
+            waited += chat_limiter.acquire()
+        waited += self.all_limiter.acquire()
+        if waited > 0:
+            logger.info('sending to chat {} was delayed by {:.2f}s due to rate limits'.format(chat_id, waited))
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.wait(chat_id)
+        return self.bot.send_message(chat_id, text, **kwargs)
+
+
+_sender = None
+_sender_lock = threading.Lock()
+
+
+def get_sender():
+    """process-wide Sender built from settings on the first call"""
+    global _sender
+    if _sender is None:
+        with _sender_lock:
+            if _sender is None:
+                _sender = Sender.from_settings()
+    return _sender
@@ -0,0 +1,98 @@
+"""
+sharded deployment: one router process receives updates (polling or webhook) and pushes every update into a redis
+list of the shard which owns its chat; `bot --shard K` processes consume their lists. Chats are spread over shards
+with consistent hashing, so changing the number of shards moves only a part of them. Everything shared between
+shards lives in the DB or redis (PENDING_INTERACTIONS should use the 'redis' backend). Shards cache guilds, users
+and memberships in process (IDENTITY_CACHE), a save in one shard drops the copies of the others with a redis message
+(app.cache.Invalidation)
+"""
+import bisect
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from redis.exceptions import RedisError
+from telegram import Update, TelegramError
+from telegram.ext import Dispatcher, Updater
+
+from app.connections import get_redis
+from app.dispatcher import ConcurrentDispatcher
+
+logger = logging.getLogger(__name__)
+
+KEY = 'app:shard:{}:updates'
+
+
+def _hash(value):
+    return int(hashlib.md5(str(value).encode()).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """consistent hashing of keys to shard numbers 0..shards-1, `replicas` points on the ring per shard"""
+
+    def __init__(self, shards, replicas=100):
+        self.shards = shards
+        points = sorted((_hash(f'shard-{shard}-{i}'), shard) for shard in range(shards) for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def get_shard(self, key):
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[i]
+
+
+class ShardRouter(Dispatcher):
+    """dispatcher which doesn't handle updates but pushes them to the list of the shard owning the chat"""
+
+    def __init__(self, *args, shards, queue_name='default', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ring = HashRing(shards)
+        self.queue_name = queue_name
+
+    def process_update(self, update):
+        if isinstance(update, TelegramError):
+            super().process_update(update)
+            return
+        key = ConcurrentDispatcher.get_key(update)
+        shard = self.ring.get_shard(key) if key is not None else 0
+        get_redis(self.queue_name).rpush(KEY.format(shard), update.to_json())
+
+
+class ShardUpdater(Updater):
+    """
+    Updater which takes updates of one shard from redis instead of Telegram. The list is read only when the
+    dispatcher keeps up (its update queue should be bounded), the rest waits in redis
+    """
+
+    def __init__(self, dispatcher, shard, queue_name='default'):
+        super().__init__(dispatcher=dispatcher, workers=None, use_context=dispatcher.use_context)
+        self.shard = shard
+        self.queue_name = queue_name
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self.running:
+                return self.update_queue
+            self.running = True
+            self.job_queue.start()
+            self._init_thread(self.dispatcher.start, 'dispatcher')
+            self._init_thread(self._consume, 'updater')
+            return self.update_queue
+
+    def _consume(self):
+        redis = get_redis(self.queue_name)
+        key = KEY.format(self.shard)
+        logger.info('shard {} reads updates from {}'.format(self.shard, key))
+        while self.running:
+            try:
+                item = redis.blpop([key], timeout=1)
+            except RedisError as e:
+                logger.warning('shard {} can\'t read updates: {}'.format(self.shard, e))
+                time.sleep(1)
+                continue
+            if item is None:
+                continue
+            self.update_queue.put(Update.de_json(json.loads(item[1]), self.bot))
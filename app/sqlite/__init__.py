@@ -0,0 +1,3 @@
+"""
+sqlite3 database backend for several processes writing one file (ENGINE 'app.sqlite', see DATABASE_PROFILES)
+"""
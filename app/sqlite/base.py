@@ -0,0 +1,21 @@
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    sqlite3 backend which sets OPTIONS['pragmas'] (e.g. journal_mode=WAL, synchronous=NORMAL) on every new
+    connection and starts transactions with BEGIN IMMEDIATE. A deferred transaction which reads first and writes
+    later can't wait for the write lock (sqlite fails it with "database is locked" at once to avoid a deadlock),
+    an immediate one takes the lock at the start and waits up to OPTIONS['timeout'] seconds for it
+    """
+
+    def get_new_connection(self, conn_params):
+        conn_params = dict(conn_params)
+        pragmas = conn_params.pop('pragmas', {})
+        conn = super().get_new_connection(conn_params)
+        for name, value in pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
@@ -1,28 +1,154 @@
 import logging
+import random
+import uuid
 
 from django.apps import apps
+from django.conf import settings
+from django.db.models import Case, CharField, Value, When
+from django.utils import timezone
+from telegram import ParseMode
+from telegram.error import RetryAfter
 
+from app import metrics
+from app.sender import get_sender
 
 get_model = apps.get_model
 logger = logging.getLogger(__name__)
 
 
+def load_reasons(notifications):
+    """set `caused_by` of every notification with one query (guild included) per reason model"""
+    by_type = {}
+    for n in notifications:
+        by_type.setdefault(n.content_type, []).append(n)
+    for content_type, group in by_type.items():
+        reasons = content_type.model_class().objects.select_related('in_guild').in_bulk([n.object_id for n in group])
+        for n in group:
+            n.caused_by = reasons[n.object_id]
+
+
+def get_coalesced(notification):
+    """other pending notifications for the same chat which are due within NOTIFICATION_COALESCE_WINDOW seconds"""
+    window = getattr(settings, 'NOTIFICATION_COALESCE_WINDOW', 0)
+    if not window:
+        return []
+    Notification = get_model('app', 'Notification')
+    others = Notification.objects.pending().for_chat(notification.caused_by.in_guild.chat_id).filter(
+        time__lte=notification.time + timezone.timedelta(seconds=window)
+    ).exclude(pk=notification.pk).select_related('content_type').order_by('time')
+    others = list(others)
+    load_reasons(others)
+    return others
+
+
+def claim(notifications):
+    """
+    marks the still pending ones of `notifications` as notified with one conditional UPDATE and returns them. Jobs of
+    the same chat may run at once and coalesce each other's notifications, only the job which claimed a notification
+    sends it. Claimed rows get a one-off job id to tell them apart, the job id of a notified notification isn't used
+    """
+    Notification = get_model('app', 'Notification')
+    token = str(uuid.uuid4())
+    pks = [x.pk for x in notifications]
+    count = Notification.objects.filter(pk__in=pks).pending().update(notified=True, job_id=token)
+    if count == len(notifications):
+        return list(notifications)
+    claimed = set(Notification.objects.filter(pk__in=pks, job_id=token).values_list('pk', flat=True))
+    return [x for x in notifications if x.pk in claimed]
+
+
+def release(notifications):
+    """makes claimed notifications pending again with their old job ids"""
+    get_model('app', 'Notification').objects.filter(pk__in=[x.pk for x in notifications]).update(
+        notified=False,
+        job_id=Case(*[When(pk=x.pk, then=Value(x.job_id)) for x in notifications], output_field=CharField()),
+    )
+
+
+def defer(notification, delay):
+    """
+    runs the notification's job again after `delay` seconds (plus up to 20% jitter) instead of sleeping in the
+    worker. The job gets a new id: rq still owns the current one until it finishes
+    """
+    from app.scheduler import get_scheduler
+    at_time = timezone.now() + timezone.timedelta(seconds=delay * random.uniform(1, 1.2))
+    job_id = get_scheduler().enqueue_at(at_time, notification.pk)
+    get_model('app', 'Notification').objects.filter(pk=notification.pk).update(job_id=job_id)
+    logger.info('  Notification pk {} deferred to {} by flood control'.format(notification.pk, at_time))
+
+
 def notification_job(notification_pk):
     logger.info('start notification job. Notification pk {}'.format(notification_pk))
+    try:
+        result = _notification_job(notification_pk)
+    except Exception:
+        model = get_model('app', 'Notification').objects.filter(pk=notification_pk).values_list(
+            'content_type__model', flat=True).first()
+        metrics.registry.inc('notifications_total', model=model or 'unknown', result='failed')
+        raise
+    finally:
+        metrics.registry.flush()
+    logger.info('stop notification job. Notification pk {}'.format(notification_pk))
+    return result
+
+
+def _notification_job(notification_pk):
     Notification = get_model('app', 'Notification')
 
-    n = Notification.objects.get(pk=notification_pk)
-    if n.notified or n.canceled:
-        logger.warning("  Notification pk {} marked as canceled or already notified".format(notification_pk))
-        return False
+    with metrics.registry.stage('load'):
+        n = Notification.objects.select_related('content_type').get(pk=notification_pk)
+        if n.notified or n.canceled:
+            logger.warning("  Notification pk {} marked as canceled or already notified".format(notification_pk))
+            metrics.registry.inc('notifications_total', model=n.content_type.model, result='skipped')
+            return False
 
-    n.caused_by.notify(n)
-    n.notified = True
-    n.save()
+        # reasons are loaded together with their guild, the same instances are used down to rescheduling
+        load_reasons([n])
+        candidates = [n] + get_coalesced(n)
+        batch = claim(candidates)
+        for x in candidates:
+            if x not in batch:
+                metrics.registry.inc('notifications_total', model=x.content_type.model, result='skipped')
+        if not batch:
+            logger.warning("  Notification pk {} is sent by another job".format(notification_pk))
+            return False
 
-    delta = n.caused_by.get_next_notification_delta(n)
-    if delta is not None:
-        n2 = Notification.create(n.caused_by, n.time + delta)
-        logger.info('  create new notification pk {}'.format(n2.pk))
-    logger.info('stop notification job. Notification pk {}'.format(notification_pk))
+    with metrics.registry.stage('render'):
+        chat_id = n.caused_by.in_guild.chat_id
+        text = '\n\n'.join(x.caused_by.render_notification(x) for x in batch)
+
+    with metrics.registry.stage('send'):
+        try:
+            get_sender().send_message(chat_id, text, parse_mode=ParseMode.HTML)
+        except RetryAfter as e:
+            release(batch)
+            defer(batch[0], e.retry_after)
+            for x in batch:
+                metrics.registry.inc('notifications_total', model=x.content_type.model, result='deferred')
+            return False
+        except Exception:
+            release(batch)
+            raise
+    sent_at = timezone.now()
+    logger.info('  Notifications pk {} sent to chat {}, which stored in Guild pk {}'.format(
+        [x.pk for x in batch], chat_id, n.caused_by.in_guild.pk))
+    for x in batch:
+        metrics.registry.observe('notification_lateness_seconds', (sent_at - x.time).total_seconds())
+        metrics.registry.inc('notifications_total', model=x.content_type.model, result='sent')
+
+    with metrics.registry.stage('reschedule'):
+        for x in batch:
+            x.caused_by.notification_sent(x)
+        others = [x for x in batch if x.pk != n.pk]
+        if others:
+            from app.scheduler import get_scheduler
+            get_scheduler().cancel_many([x.job_id for x in others])
+
+        for x in batch:
+            x.notified = True
+            delta = x.caused_by.get_next_notification_delta(x)
+            if delta is not None:
+                n2 = Notification.create(x.caused_by, x.time + delta, number=x.number + 1)
+                if n2 is not None:
+                    logger.info('  create new notification pk {}'.format(n2.pk))
     return True
@@ -1,3 +1,1291 @@
-from django.test import TestCase
+import gzip
+import itertools
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from queue import Queue
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, connections, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from telegram import Bot, Chat, ChatMember, TelegramError, Update, User as ApiUser, constants
+from telegram.error import BadRequest, ChatMigrated, NetworkError, RetryAfter, TimedOut
+from telegram.ext import CommandHandler, TypeHandler
+from telegram.utils.request import urllib3
+from rq import Queue as RQQueue
+from rq.job import JobStatus
+from rq.registry import FailedJobRegistry, StartedJobRegistry
+from tornado.testing import AsyncHTTPTestCase
+
+from app import metrics, npc_list, tasks, titles
+from app.audit import trail
+from app.cache import Invalidation, LRUCache
+from app.dispatcher import ConcurrentDispatcher
+from app.errors import ErrorReporter
+from app.logs import GzipTimedRotatingFileHandler, JSONFormatter, QueueListenerHandler, RateLimitFilter
+from app.management.commands.bot import Command as BotCommand, private_guild_choice
+from app.interactions import MemoryInteractionStore, RedisInteractionStore
+from app.sharding import KEY, HashRing, ShardRouter
+from app.sqlite.base import DatabaseWrapper
+from app.tracing import trace
+from app import models
+from app.schedule import NotificationSchedule
+from app.scheduler import RQSchedulerBackend, reconcile
+from app.models import TelegramUser, Guild, GuildMembership, ResourceCollection, TemporaryNPC, Notification, AuditRecord
+from app.sender import RateLimiter, SendRequest, call_or_defer, chat_remap, send_or_defer
+from app.tasks import notification_job
+from app.timers import TimerEngine, TimerSchedulerBackend
+from app.webhook import SECRET_HEADER, WebhookApplication
+from app.worker import ThreadedWorker
+from app.writes import Writer
+
+
+@override_settings(AUDIT={'ENABLED': False})
+class NotificationJobTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch('app.scheduler._scheduler')
+        self.scheduler = patcher.start()
+        self.scheduler.new_job_id.side_effect = lambda: str(uuid.uuid4())
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('app.sender._sender')
+        self.sender = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('app.metrics.registry.flush')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.tuser = TelegramUser.objects.create(django=User.objects.create(username='u'), chat_id='1')
+        self.guild = Guild.objects.create(name='g', chat_id='-1', additional_notifications='+15m[2]+1h[*]')
+        for model in (ResourceCollection, TemporaryNPC):
+            ContentType.objects.get_for_model(model)
+
+    def test_resource_collection_queries(self):
+        collection = ResourceCollection.objects.create(by=self.tuser, at=timezone.now(), in_guild=self.guild)
+        n = Notification.create(collection, timezone.now(), number=5)
+
+        # notification, the reason with its guild, coalesced ones, claim, check and create the next one
+        with self.assertNumQueries(6):
+            self.assertTrue(notification_job(n.pk))
+
+        self.sender.send_message.assert_called_once()
+        n2 = Notification.objects.get(number=6)
+        self.assertEqual(n2.time - n.time, timezone.timedelta(hours=1))
+        self.assertTrue(Notification.objects.get(pk=n.pk).notified)
+
+    def test_temporary_npc_last_notification_queries(self):
+        npc = TemporaryNPC.objects.create(caption='npc', by=self.tuser, in_guild=self.guild, at=timezone.now())
+        n = Notification.create(npc, timezone.now(), number=3)
+
+        # notification, the reason with its guild, coalesced ones, claim, expire npc
+        with self.assertNumQueries(5):
+            self.assertTrue(notification_job(n.pk))
+
+        self.assertTrue(TemporaryNPC.objects.get(pk=npc.pk).expired)
+
+    def test_canceled_notification_is_skipped(self):
+        collection = ResourceCollection.objects.create(by=self.tuser, at=timezone.now(), in_guild=self.guild)
+        n = Notification.create(collection, timezone.now())
+        Notification.objects.filter(pk=n.pk).cancel()
+
+        with self.assertNumQueries(1):
+            self.assertFalse(notification_job(n.pk))
+        self.sender.send_message.assert_not_called()
+
+    def test_flood_control_defers_the_job(self):
+        collection = ResourceCollection.objects.create(by=self.tuser, at=timezone.now(), in_guild=self.guild)
+        n = Notification.create(collection, timezone.now())
+        self.sender.send_message.side_effect = RetryAfter(30)
+        self.scheduler.enqueue_at.reset_mock()
+        self.scheduler.enqueue_at.return_value = 'retry-job'
+
+        self.assertFalse(notification_job(n.pk))
+        (at_time, pk), _ = self.scheduler.enqueue_at.call_args
+        self.assertEqual(pk, n.pk)
+        self.assertGreaterEqual(at_time, timezone.now() + timezone.timedelta(seconds=29))
+        n = Notification.objects.get(pk=n.pk)
+        self.assertEqual(n.job_id, 'retry-job')
+        self.assertFalse(n.notified)
+
+    def test_coalesced_notifications(self):
+        now = timezone.now()
+        collection = ResourceCollection.objects.create(by=self.tuser, at=now, in_guild=self.guild)
+        n = Notification.create(collection, now, number=0)
+        npc = TemporaryNPC.objects.create(caption='npc', by=self.tuser, in_guild=self.guild, at=now)
+        n_npc = Notification.create(npc, now + timezone.timedelta(seconds=2), number=3)
+        other_guild = Guild.objects.create(name='g2', chat_id='-2')
+        other_npc = TemporaryNPC.objects.create(caption='npc', by=self.tuser, in_guild=other_guild, at=now)
+        n_other = Notification.create(other_npc, now, number=3)
+        n_later = Notification.create(npc, now + timezone.timedelta(minutes=1), number=4)
+
+        self.assertTrue(notification_job(n.pk))
+
+        self.sender.send_message.assert_called_once()
+        chat_id, text = self.sender.send_message.call_args[0]
+        self.assertEqual(chat_id, '-1')
+        self.assertIn('<b>npc</b>', text)
+        self.scheduler.cancel_many.assert_called_once_with([n_npc.job_id])
+        self.assertEqual(set(Notification.objects.filter(notified=True).values_list('pk', flat=True)),
+                         {n.pk, n_npc.pk})
+        self.assertTrue(TemporaryNPC.objects.get(pk=npc.pk).expired)
+        self.assertFalse(notification_job(n_npc.pk))
+        self.assertFalse(Notification.objects.get(pk=n_other.pk).notified)
+        self.assertFalse(Notification.objects.get(pk=n_later.pk).notified)
+
+    def test_overlapping_jobs_send_once(self):
+        now = timezone.now()
+        collection = ResourceCollection.objects.create(by=self.tuser, at=now, in_guild=self.guild)
+        n = Notification.create(collection, now, number=0)
+        npc = TemporaryNPC.objects.create(caption='npc', by=self.tuser, in_guild=self.guild, at=now)
+        n_npc = Notification.create(npc, now + timezone.timedelta(seconds=2), number=3)
+        real_claim = tasks.claim
+        overlapped = []
+
+        def claim(notifications):
+            # the job of n_npc runs while the job of n has read both notifications as pending
+            if not overlapped:
+                overlapped.append(True)
+                self.assertTrue(notification_job(n_npc.pk))
+            return real_claim(notifications)
+
+        with mock.patch('app.tasks.claim', side_effect=claim):
+            self.assertFalse(notification_job(n.pk))
+
+        self.sender.send_message.assert_called_once()
+        self.assertIn('<b>npc</b>', self.sender.send_message.call_args[0][1])
+        self.assertEqual(Notification.objects.filter(notified=True).count(), 2)
+        self.assertEqual(Notification.objects.filter(resource_collection=collection, number=1).count(), 1)
+
+    def test_failed_send_releases_the_claim(self):
+        collection = ResourceCollection.objects.create(by=self.tuser, at=timezone.now(), in_guild=self.guild)
+        n = Notification.create(collection, timezone.now())
+        self.sender.send_message.side_effect = NetworkError('bad gateway')
+
+        with self.assertRaises(NetworkError):
+            notification_job(n.pk)
+        self.assertEqual(Notification.objects.pending().get().job_id, n.job_id)
+
+    def test_bulk_cancel(self):
+        now = timezone.now()
+        collection = ResourceCollection.objects.create(by=self.tuser, at=now, in_guild=self.guild)
+        pending = [Notification.create(collection, now + timezone.timedelta(minutes=i), number=i) for i in range(3)]
+        Notification.objects.create(caused_by=collection, time=now, number=3, job_id='sent', notified=True)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Notification.objects.filter(resource_collection__in_guild=self.guild).cancel(), 3)
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('UPDATE')]), 1)
+        self.scheduler.cancel_many.assert_called_once_with([n.job_id for n in pending])
+        self.assertEqual(Notification.objects.filter(canceled=True).count(), 3)
+
+        self.scheduler.cancel_many.reset_mock()
+        self.assertEqual(Notification.objects.filter(resource_collection__in_guild=self.guild).cancel(), 0)
+        self.scheduler.cancel_many.assert_not_called()
+
+    def test_collect_cancels_pending_notifications_of_the_guild(self):
+        first = ResourceCollection.create(self.tuser, self.guild)
+        other_guild = Guild.objects.create(name='g2', chat_id='-2')
+        other = ResourceCollection.create(self.tuser, other_guild)
+
+        second = ResourceCollection.create(self.tuser, self.guild)
+        self.assertIsInstance(second, ResourceCollection)
+        self.scheduler.cancel_many.assert_called_once_with([first.notifications.get().job_id])
+        self.assertTrue(first.notifications.get().canceled)
+        self.assertFalse(other.notifications.get().canceled)
+        self.assertFalse(second.notifications.get().canceled)
+
+
+def legacy_deltas(string, count):
+    """intervals in minutes of the generator which ResourceCollection used before NotificationSchedule"""
+    def generator():
+        for t in re.findall(r'\+(\d+)([mh])(?:\[(\d+|\*)\])?', string):
+            minutes = int(t[0]) * (60 if t[1] == 'h' else 1)
+            if t[2] == '*':
+                while True:
+                    yield minutes
+            for _ in range(int(t[2]) if t[2] != '' else 1):
+                yield minutes
+    return list(itertools.islice(generator(), count))
+
+
+class NotificationScheduleTest(SimpleTestCase):
+    schedules = ['', '+15m', '+15m[2]+30m+1h[*]', '+5m[0]+10m', '+1h[*]+5m', '+10m+10m[3]+2h[2]', '+1m[*]',
+                 '+90m[2]+1h']
+
+    def test_parity_with_the_generator(self):
+        start = timezone.now()
+        for string in self.schedules:
+            schedule = NotificationSchedule.parse(string)
+            expected = legacy_deltas(string, 30)
+            with self.subTest(string):
+                deltas = [schedule.interval(number) for number in range(20)]
+                self.assertEqual(deltas, (expected + [None] * 20)[:20])
+                offsets = [schedule.offset(number) for number in range(len(expected) + 1)]
+                self.assertEqual(offsets, list(itertools.accumulate([0] + expected)))
+                for number in range(min(len(expected), 20)):
+                    self.assertEqual(schedule.fire_times(start, 5, number), [
+                        start + timezone.timedelta(minutes=sum(expected[number:n + 1]))
+                        for n in range(number, min(number + 5, len(expected)))
+                    ])
+                self.assertEqual(bool(schedule), bool(expected))
+
+    def test_invalid(self):
+        for string in ['15m', '+15', '+15s', '+15m[', '+15m[x]', '+m', 'abc', '+15m,+30m']:
+            with self.subTest(string), self.assertRaises(ValueError):
+                NotificationSchedule.parse(string)
+        self.assertEqual(NotificationSchedule.parse(' +15m [2] ').runs, ((2, 15),))
+
+
+@override_settings(AUDIT={'ENABLED': False})
+class ReconcileTest(TestCase):
+    def setUp(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('fakeredis is not installed')
+        self.redis = fakeredis.FakeRedis()
+        with mock.patch('app.scheduler.get_redis', return_value=self.redis):
+            self.backend = RQSchedulerBackend()
+        tuser = TelegramUser.objects.create(django=User.objects.create(username='u'), chat_id='1')
+        guild = Guild.objects.create(name='g', chat_id='-1')
+        self.collection = ResourceCollection.objects.create(by=tuser, at=timezone.now(), in_guild=guild)
+        self.now = timezone.now()
+
+        self.scheduled = self.notification(0, 'scheduled')
+        self.backend.enqueue_at(self.now, self.scheduled.pk, 'scheduled')
+        self.lost = self.notification(1, 'lost')
+        self.without_job = self.notification(2, '')
+        self.running = self.notification(3, 'running')
+        # the job of a notification which has just been sent
+        for pk, job_id in [(self.running.pk, 'running'), (self.notification(4, 'sent', notified=True).pk, 'sent')]:
+            job = self.backend.create_job(pk, job_id)
+            job.save()
+            StartedJobRegistry('default', connection=self.redis).add(job, 60)
+        self.backend.enqueue_at(self.now, 1000, 'orphan')
+        RQQueue('default', connection=self.redis).enqueue(record_worker_run, job_id='foreign')
+
+    def notification(self, number, job_id, **kwargs):
+        return Notification.objects.create(caused_by=self.collection, time=self.now, number=number, job_id=job_id,
+                                           **kwargs)
+
+    def test_dry_run(self):
+        self.assertEqual(reconcile(self.backend, dry_run=True), (2, 2))
+        self.assertEqual(self.backend.scheduled_job_ids(), {'scheduled', 'orphan', 'foreign'})
+        self.assertEqual(Notification.objects.get(pk=self.without_job.pk).job_id, '')
+
+    def test_missing_and_orphan_jobs(self):
+        self.assertEqual(reconcile(self.backend), (2, 1))
+        job_id = Notification.objects.get(pk=self.without_job.pk).job_id
+        self.assertTrue(job_id)
+        # running jobs are neither enqueued again nor dropped, jobs of other functions are kept
+        self.assertEqual(self.backend.scheduled_job_ids(), {'scheduled', 'lost', job_id, 'foreign'})
+        self.assertEqual(self.backend.running_job_ids(), {'running', 'sent'})
+        self.assertIsNotNone(self.backend.scheduler.job_class.fetch('sent', connection=self.redis))
+        self.assertEqual(reconcile(self.backend), (0, 0))
+
+    def test_job_ids_are_written_in_bulk(self):
+        without_job = [self.without_job] + [self.notification(i, '') for i in range(5, 10)]
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(reconcile(self.backend, chunk_size=4), (7, 1))
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('UPDATE')]), 2)
+        job_ids = Notification.objects.filter(pk__in=[n.pk for n in without_job]).values_list('job_id', flat=True)
+        self.assertEqual(len(set(job_ids) - {''}), 6)
+        self.assertLessEqual(set(job_ids), self.backend.scheduled_job_ids())
+
+
+class MetricsTest(SimpleTestCase):
+    def setUp(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('fakeredis is not installed')
+        patcher = mock.patch('app.metrics.get_redis', return_value=fakeredis.FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_render(self):
+        registry = metrics.Registry()
+        registry.inc('notifications_total', model='temporarynpc', result='sent')
+        registry.inc('notifications_total', 2, model='resourcecollection', result='sent')
+        for value in (0.05, 0.3, 0.3, 1000):
+            registry.observe('notification_lateness_seconds', value)
+        registry.observe('notification_stage_seconds', 0.002, stage='send')
+        registry.flush(force=True)
+
+        lines = metrics.render().splitlines()
+        self.assertIn('# TYPE notifications_total counter', lines)
+        self.assertIn('notifications_total{model="resourcecollection",result="sent"} 2', lines)
+        self.assertIn('# TYPE notification_lateness_seconds histogram', lines)
+        # buckets are cumulative and end with +Inf which equals the count
+        self.assertIn('notification_lateness_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('notification_lateness_seconds_bucket{le="0.25"} 1', lines)
+        self.assertIn('notification_lateness_seconds_bucket{le="0.5"} 3', lines)
+        self.assertIn('notification_lateness_seconds_bucket{le="600"} 3', lines)
+        self.assertIn('notification_lateness_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('notification_lateness_seconds_count 4', lines)
+        self.assertIn('notification_lateness_seconds_sum 1000.65', lines)
+        self.assertIn('notification_stage_seconds_bucket{le="0.001",stage="send"} 0', lines)
+        self.assertIn('notification_stage_seconds_bucket{le="0.0025",stage="send"} 1', lines)
+
+    def test_values_are_kept_when_redis_fails(self):
+        registry = metrics.Registry()
+        registry.inc('notifications_total', model='temporarynpc', result='sent')
+        with mock.patch('app.metrics.get_redis', side_effect=ConnectionError('refused')), \
+                self.assertLogs('app.metrics', 'WARNING'):
+            registry.flush(force=True)
+        registry.inc('notifications_total', model='temporarynpc', result='sent')
+        registry.flush(force=True)
+        self.assertEqual(metrics.load(), {'notifications_total{model="temporarynpc",result="sent"}': 2})
+
+
+class TimerEngineTest(SimpleTestCase):
+    def setUp(self):
+        self.fired = []
+        self.done = threading.Event()
+        self.engine = TimerEngine(self.callback, workers=1)
+        self.addCleanup(self.engine.stop)
+
+    def callback(self, job_id, payload, timestamp):
+        self.fired.append((job_id, payload))
+        if job_id == 'last':
+            self.done.set()
+
+    def run_engine(self):
+        self.engine.schedule(time.time() + 0.1, 'last', None)
+        self.engine.start()
+        self.assertTrue(self.done.wait(5))
+        self.engine.stop()
+        return [job_id for job_id, _ in self.fired[:-1]]
+
+    def test_order(self):
+        now = time.time()
+        self.engine.schedule(now + 0.06, 'c', 3)
+        self.engine.schedule_many([(now + 0.04, 'b', 2), (now + 0.02, 'a', 1)])
+        self.assertEqual(len(self.engine), 3)
+        self.assertEqual(self.run_engine(), ['a', 'b', 'c'])
+        self.assertEqual(len(self.engine), 0)
+
+    def test_cancel(self):
+        self.assertFalse(self.engine.cancel('unknown'))
+        self.assertEqual(len(self.engine), 0)
+        self.engine.schedule(time.time() + 0.02, 'a', 1)
+        self.engine.schedule(time.time() + 0.02, 'b', 2)
+        self.assertTrue(self.engine.cancel('a'))
+        self.assertFalse(self.engine.cancel('a'))
+        self.assertEqual(len(self.engine), 1)
+        self.assertEqual(self.engine.job_ids(), {'b'})
+        self.assertEqual(self.run_engine(), ['b'])
+
+    def test_reschedule(self):
+        now = time.time()
+        self.engine.schedule(now + 0.02, 'a', 1)
+        self.engine.cancel('a')
+        self.engine.schedule(now + 0.04, 'a', 2)
+        self.engine.schedule(now + 0.01, 'b', 1)
+        self.engine.schedule_many([(now + 0.03, 'b', 2)])
+        self.assertEqual(len(self.engine), 2)
+        self.run_engine()
+        self.assertEqual(self.fired[:-1], [('b', 2), ('a', 2)])
+
+    def test_removed_entries_are_compacted(self):
+        self.engine.schedule_many([(time.time() + 60, str(i), i) for i in range(3000)])
+        for i in range(2000):
+            self.engine.cancel(str(i))
+        self.assertEqual(len(self.engine), 1000)
+        self.assertLess(len(self.engine._heap), 2000)
+
+
+@override_settings(AUDIT={'ENABLED': False})
+class TimerSchedulerBackendTest(TestCase):
+    def test_pending_notifications_are_loaded_on_start(self):
+        tuser = TelegramUser.objects.create(django=User.objects.create(username='u'), chat_id='1')
+        guild = Guild.objects.create(name='g', chat_id='-1')
+        collection = ResourceCollection.objects.create(by=tuser, at=timezone.now(), in_guild=guild)
+        now = timezone.now()
+        for number, job_id, state in [(0, 'a', {}), (1, 'b', {}), (2, 'c', {'canceled': True}),
+                                      (3, 'd', {'notified': True}), (4, '', {})]:
+            Notification.objects.create(caused_by=collection, time=now, number=number, job_id=job_id, **state)
+
+        backend = TimerSchedulerBackend()
+        self.addCleanup(backend.engine.stop)
+        with mock.patch.object(backend.engine, 'start') as start:
+            backend.start()
+        start.assert_called_once()
+        self.assertEqual(backend.scheduled_job_ids(), {'a', 'b'})
+
+        backend.execute([(now, 10, 'e'), (now, 11, 'a')], ['b'])
+        self.assertEqual(backend.scheduled_job_ids(), {'a', 'e'})
+        self.assertEqual(len(backend.engine), 2)
+        self.assertEqual(backend.drop_orphans(['e', 'unknown']), 1)
+
+
+@override_settings(AUDIT={'ENABLED': False})
+class IdentityCacheTest(TestCase):
+    def setUp(self):
+        for cache in (models.guild_cache, models.user_cache, models.membership_cache):
+            cache.clear()
+            self.addCleanup(cache.clear)
+        # TestCase never commits
+        patcher = mock.patch('app.models.transaction.on_commit', side_effect=lambda f: f())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.guild = Guild.objects.create(name='g', chat_id='-1')
+        self.api_user = ApiUser(1, 'First', False, last_name='Last', username='user')
+
+    def lookup(self):
+        guild = Guild.get_by_chat_id(-1)
+        tuser, created = TelegramUser.get_or_create_by_api(self.api_user)
+        guild.make_sure_user_is_member(tuser)
+        return guild, tuser, created
+
+    def test_known_user_costs_no_queries(self):
+        _, tuser, created = self.lookup()
+        self.assertTrue(created)
+        self.assertTrue(GuildMembership.objects.filter(tuser=tuser, guild=self.guild).exists())
+        models.guild_cache.clear()
+        models.user_cache.clear()
+        models.membership_cache.clear()
+        self.lookup()
+
+        with self.assertNumQueries(0):
+            _, _, created = self.lookup()
+        self.assertFalse(created)
+
+    def test_profile_is_saved_only_when_changed(self):
+        self.lookup()
+        self.api_user.first_name = 'Renamed'
+        with self.assertNumQueries(1):
+            _, tuser, _ = self.lookup()
+        self.assertEqual(TelegramUser.objects.get(pk=tuser.pk).first_name, 'Renamed')
+
+    def test_chat_migration(self):
+        self.lookup()
+        self.addCleanup(chat_remap._cache.clear)
+        chat_remap.add(-1, -100)
+        with self.assertRaises(Guild.DoesNotExist):
+            Guild.get_by_chat_id(-1)
+        self.assertEqual(Guild.get_by_chat_id(-100).pk, self.guild.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(Guild.get_by_chat_id(-100).pk, self.guild.pk)
+
+    def test_display_name(self):
+        _, tuser, _ = self.lookup()
+        tuser.set_display_name_for_guild('nick', self.guild)
+        with self.assertNumQueries(0):
+            self.assertEqual(tuser.get_display_name_for_guild(self.guild), 'nick')
+
+    def test_cached_instances_are_copies(self):
+        guild = Guild.get_by_chat_id(-1)
+        guild.name = 'changed in one thread'
+        self.assertEqual(Guild.get_by_chat_id(-1).name, 'g')
+        self.assertIsNot(Guild.get_by_chat_id(-1), Guild.get_by_chat_id(-1))
+
+    def test_stale_instance_keeps_other_changes(self):
+        guild = Guild.get_by_chat_id(-1)
+        Guild.objects.filter(pk=guild.pk).update(name='renamed by another process')
+        guild.set_additional_notifications('+15m')
+        guild = Guild.objects.get(pk=guild.pk)
+        self.assertEqual((guild.name, guild.additional_notifications), ('renamed by another process', '+15m'))
+
+
+@override_settings(AUDIT={'ENABLED': False})
+class IdentityCacheRollbackTest(TransactionTestCase):
+    def test_rolled_back_save_is_not_cached(self):
+        self.addCleanup(models.guild_cache.clear)
+        Guild.objects.create(name='g', chat_id='-1')
+        guild = Guild.get_by_chat_id(-1)
+        with self.assertRaises(ValueError), transaction.atomic():
+            guild.name = 'rolled back'
+            guild.save(update_fields=['name'])
+            raise ValueError
+        self.assertEqual(Guild.get_by_chat_id(-1).name, 'g')
+        guild.name = 'committed'
+        guild.save(update_fields=['name'])
+        with self.assertNumQueries(0):
+            self.assertEqual(Guild.get_by_chat_id(-1).name, 'committed')
+
+
+@override_settings(AUDIT={'ENABLED': True, 'BACKGROUND': False, 'SINK': 'db', 'BATCH_SIZE': 2})
+class AuditTest(TestCase):
+    def setUp(self):
+        trail._buffer.clear()
+        self.addCleanup(trail._buffer.clear)
+
+    def test_changes_are_written_in_batches(self):
+        guild = Guild.objects.create(name='g', chat_id='-1')
+        guild.name = 'renamed'
+        guild.save(update_fields=['name'])
+        pk = guild.pk
+        guild.delete()
+        self.assertFalse(AuditRecord.objects.exists())
+
+        with self.assertNumQueries(2):
+            self.assertEqual(trail.flush(), 3)
+        records = AuditRecord.objects.order_by('pk')
+        self.assertEqual([(r.action, r.model, r.object_id, r.fields) for r in records], [
+            ('created', 'app.guild', pk, None),
+            ('changed', 'app.guild', pk, 'name'),
+            ('deleted', 'app.guild', pk, None),
+        ])
+
+    @override_settings(AUDIT={'ENABLED': True, 'BACKGROUND': False, 'SINK': 'log'})
+    def test_log_sink(self):
+        audit_logger = logging.getLogger('app.audit')
+        self.assertTrue(audit_logger.isEnabledFor(logging.INFO))
+        self.assertTrue(audit_logger.handlers)
+        guild = Guild.objects.create(name='g', chat_id='-1')
+        with self.assertLogs('app.audit', 'INFO') as logs:
+            self.assertEqual(trail.flush(), 1)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual((record['action'], record['model'], record['object_id']), ('created', 'app.guild', guild.pk))
+
+    @override_settings(AUDIT={'ENABLED': True, 'BACKGROUND': False, 'SINK': 'log'})
+    def test_buffer_is_flushed_before_fork(self):
+        Guild.objects.create(name='g', chat_id='-1')
+        with self.assertLogs('app.audit', 'INFO') as logs:
+            pid = os.fork()
+            if pid == 0:
+                os._exit(0)
+            os.waitpid(pid, 0)
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(len(trail._buffer), 0)
+
+    def test_loading_is_not_audited(self):
+        Guild.objects.create(name='g', chat_id='-1')
+        trail._buffer.clear()
+        list(Guild.objects.all())
+        self.assertEqual(len(trail._buffer), 0)
+
+
+@override_settings(AUDIT={'ENABLED': False})
+class NpcListTest(TestCase):
+    def setUp(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('fakeredis is not installed')
+        patcher = mock.patch('app.npc_list.get_redis', return_value=fakeredis.FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # TestCase never commits
+        patcher = mock.patch('app.npc_list.transaction.on_commit', side_effect=lambda f: f())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tuser = TelegramUser.objects.create(django=User.objects.create(username='u'), chat_id='1')
+        self.guild = Guild.objects.create(name='g', chat_id='-1')
+
+    def create(self, caption, hours):
+        return TemporaryNPC.objects.create(caption=caption, by=self.tuser, in_guild=self.guild,
+                                           at=timezone.now() + timezone.timedelta(hours=hours))
+
+    def test_rows_are_cached_until_changed(self):
+        self.create('b', 2)
+        self.create('a', 1)
+        with self.assertNumQueries(1):
+            self.assertEqual([caption for _, caption in npc_list.get_rows(self.guild)], ['<i>a</i>', '<i>b</i>'])
+        with self.assertNumQueries(0):
+            npc_list.get_rows(self.guild)
+
+        npc = self.create('c', 3)
+        self.assertEqual(len(npc_list.get_rows(self.guild)), 3)
+        npc.expired = True
+        npc.save(update_fields=['expired'])
+        self.assertEqual(len(npc_list.get_rows(self.guild)), 2)
+        npc.delete()
+        with self.assertNumQueries(1):
+            npc_list.get_rows(self.guild)
+
+    def test_render_pages(self):
+        now = timezone.now()
+        self.assertIn('пуст', npc_list.render([], now)[0])
+        rows = [(now.timestamp() + 90060, f'<i>{"x" * 40} {i}</i>') for i in range(200)]
+        pages = npc_list.render(rows, now)
+        self.assertGreater(len(pages), 1)
+        self.assertTrue(all(len(page) <= constants.MAX_MESSAGE_LENGTH for page in pages))
+        lines = ''.join(pages).splitlines()[1:]
+        self.assertEqual(len(lines), 200)
+        self.assertEqual(lines[0], f'<code>1</code> <u>1d 1h 1m</u> <i>{"x" * 40} 0</i>')
+
+
+class TitlesTest(SimpleTestCase):
+    def setUp(self):
+        titles.rights_cache.clear()
+        self.addCleanup(titles.rights_cache.clear)
+        self.bot = mock.Mock(id=1000)
+        self.members = {1000: ChatMember(ApiUser(1000, 'bot', True), ChatMember.ADMINISTRATOR,
+                                         can_promote_members=True, can_change_info=True),
+                        1: ChatMember(ApiUser(1, 'user', False), ChatMember.MEMBER)}
+        self.bot.get_chat_member.side_effect = lambda chat_id, user_id: self.members[int(user_id)]
+        self.bot.set_chat_administrator_custom_title.return_value = True
+
+    def test_bot_rights_are_cached(self):
+        self.assertEqual(titles.sync_title(self.bot, -1, 1, 'nick'), titles.SET)
+        self.assertEqual(self.bot.get_chat_member.call_count, 2)
+        self.bot.promote_chat_member.assert_called_once_with(-1, 1, can_change_info=True)
+        self.assertEqual(titles.sync_title(self.bot, '-1', 1, 'nick'), titles.SET)
+        self.assertEqual(self.bot.get_chat_member.call_count, 3)
+
+        self.bot.set_chat_administrator_custom_title.side_effect = TelegramError('not enough rights')
+        with self.assertRaises(TelegramError):
+            titles.sync_title(self.bot, -1, 1, 'nick')
+        self.assertIsNone(titles.rights_cache.get(-1))
+
+    def test_no_rights(self):
+        self.members[1000] = ChatMember(ApiUser(1000, 'bot', True), ChatMember.MEMBER)
+        self.assertEqual(titles.sync_title(self.bot, -1, 1, 'nick'), titles.NO_RIGHTS)
+        self.assertEqual(titles.sync_title(self.bot, -1, 1, 'nick'), titles.NO_RIGHTS)
+        self.assertEqual(self.bot.get_chat_member.call_count, 2)
+        self.bot.set_chat_administrator_custom_title.assert_not_called()
+
+    @override_settings(TITLES_SYNC={'CONCURRENCY': 4, 'BURST_LIMIT': 1000, 'TIME_LIMIT': 1, 'RETRIES': 1})
+    @mock.patch.object(titles, '_sync_limiter', None)
+    def test_guild_sync_retries_after_flood_control(self):
+        guild = Guild(chat_id='-1')
+        memberships = [GuildMembership(pk=i, guild=guild, tuser=TelegramUser(chat_id=str(i)), display_name=f'n{i}')
+                       for i in range(1, 11)]
+        self.members.update({i: ChatMember(ApiUser(i, 'user', False), ChatMember.MEMBER) for i in range(2, 11)})
+        self.members[10] = ChatMember(ApiUser(10, 'user', False), ChatMember.ADMINISTRATOR, custom_title='n10')
+        flood = [RetryAfter(0.01)]
+
+        def set_title(chat_id, user_id, title):
+            if int(user_id) == 5 and flood:
+                raise flood.pop()
+            return True
+        self.bot.set_chat_administrator_custom_title.side_effect = set_title
+        progress = []
+        with mock.patch('app.titles.get_sender', return_value=mock.Mock(all_limiter=RateLimiter(1000, 1))):
+            summary = titles.sync_guild_titles(self.bot, memberships, progress=lambda done, *_: progress.append(done))
+        self.assertEqual(summary, {titles.SET: 9, titles.UNCHANGED: 1})
+        self.assertEqual(progress, list(range(1, 11)))
+        self.assertEqual(self.bot.set_chat_administrator_custom_title.call_count, 10)
+
+    @mock.patch.object(titles, '_sync_limiter', None)
+    def test_guild_syncs_share_the_limiters(self):
+        memberships = [GuildMembership(pk=1, guild=Guild(chat_id='-1'), tuser=TelegramUser(chat_id='1'),
+                                       display_name='n1')]
+        sender = mock.Mock()
+        with mock.patch('app.titles.get_sender', return_value=sender), \
+                mock.patch.object(RateLimiter, 'acquire') as acquire:
+            titles.sync_guild_titles(self.bot, memberships)
+            titles.sync_guild_titles(self.bot, memberships)
+        self.assertIs(titles.get_sync_limiter(), titles.get_sync_limiter())
+        calls = self.bot.method_calls
+        self.assertEqual(acquire.call_count, len(calls))
+        self.assertEqual(sender.all_limiter.acquire.call_count, len(calls))
+
+    @mock.patch.object(titles, '_sync_limiter', None)
+    def test_guild_sync_checks_fresh_rights(self):
+        # cached before the bot was given the rights
+        titles.rights_cache.set(-1, False)
+        memberships = [GuildMembership(pk=1, guild=Guild(chat_id='-1'), tuser=TelegramUser(chat_id='1'),
+                                       display_name='n1')]
+        with mock.patch('app.titles.get_sender', return_value=mock.Mock(all_limiter=RateLimiter(1000, 1))):
+            self.assertEqual(titles.sync_guild_titles(self.bot, memberships), {titles.SET: 1})
+        self.assertTrue(titles.rights_cache.get(-1))
+
+    @override_settings(TITLES_SYNC={'COOLDOWN': 600})
+    def test_guild_sync_cooldown(self):
+        self.addCleanup(titles._syncs.clear)
+        with mock.patch('app.titles.time.monotonic', return_value=1000):
+            self.assertEqual(titles.start_guild_sync('-1'), 0)
+            self.assertEqual(titles.start_guild_sync(-2), 0)
+        with mock.patch('app.titles.time.monotonic', return_value=1100):
+            self.assertEqual(titles.start_guild_sync(-1), 500)
+        with mock.patch('app.titles.time.monotonic', return_value=1600):
+            self.assertEqual(titles.start_guild_sync(-1), 0)
+
+
+@override_settings(AUDIT={'ENABLED': False})
+class SetDisplayNameTest(TestCase):
+    def setUp(self):
+        for cache in (models.guild_cache, models.user_cache, models.membership_cache):
+            cache.clear()
+            self.addCleanup(cache.clear)
+        BotCommand().add_handlers(mock.Mock())
+        self.handler = private_guild_choice.handlers['set_display_name']
+        self.guild = Guild.objects.create(name='g', chat_id='-1')
+        self.tuser = TelegramUser.objects.create(django=User.objects.create(username='u'), chat_id='1')
+        GuildMembership.objects.create(tuser=self.tuser, guild=self.guild)
+
+    def sync(self, **sync_title):
+        """the reply of the background title sync"""
+        context = mock.Mock(args=['nick'])
+        context.dispatcher.run_async.side_effect = lambda f: f()
+        update = mock.Mock()
+        update.effective_chat.id = 1
+        with mock.patch('app.titles.sync_title', **sync_title):
+            self.handler(update, context, reply=mock.Mock(), guild=self.guild, tuser=self.tuser)
+        chat_id, text = context.bot.send_message.call_args.args
+        self.assertEqual(chat_id, 1)
+        return text
+
+    def test_set(self):
+        self.assertIn('Имя *nick* так же установлено титулом', self.sync(return_value=titles.SET))
+
+    def test_creator(self):
+        self.assertIn('создатель чата', self.sync(return_value=titles.CREATOR))
+
+    def test_failed(self):
+        with self.assertLogs('app.management.commands.bot', 'WARNING'):
+            self.assertIn('не получилось', self.sync(side_effect=TelegramError('not enough rights')))
+
+
+@override_settings(AUDIT={'ENABLED': False}, TITLES_SYNC={'COOLDOWN': 600})
+class SyncTitlesCommandTest(TestCase):
+    def setUp(self):
+        for cache in (models.guild_cache, models.user_cache, models.membership_cache):
+            cache.clear()
+            self.addCleanup(cache.clear)
+        self.addCleanup(titles._syncs.clear)
+        dispatcher = mock.Mock()
+        BotCommand().add_handlers(dispatcher)
+        self.handler = next(c.args[0].callback for c in dispatcher.add_handler.call_args_list
+                            if isinstance(c.args[0], CommandHandler) and c.args[0].command == ['sync_titles'])
+        guild = Guild.objects.create(name='g', chat_id='-1')
+        tuser = TelegramUser.objects.create(django=User.objects.create(username='u'), chat_id='1')
+        GuildMembership.objects.create(tuser=tuser, guild=guild, display_name='nick')
+
+    def sync_titles(self, summary):
+        api_user = ApiUser(1, 'user', False)
+        update = mock.Mock(effective_chat=Chat(-1, Chat.SUPERGROUP), effective_user=api_user)
+        update.effective_message.from_user = api_user
+        context = mock.Mock()
+        context.bot.get_chat_member.return_value = ChatMember(api_user, ChatMember.CREATOR)
+        context.dispatcher.run_async.side_effect = lambda f: f()
+        with mock.patch('app.titles.sync_guild_titles', return_value=Counter(summary)):
+            self.handler(update, context)
+        return context.bot.send_message.call_args.args[1]
+
+    def test_no_cooldown_without_rights(self):
+        self.assertIn('повторите команду', self.sync_titles({titles.NO_RIGHTS: 1}))
+        self.assertNotIn(-1, titles._syncs)
+        self.assertIn('установлено: 1', self.sync_titles({titles.SET: 1}))
+        self.assertIn(-1, titles._syncs)
+
+
+class BotErrorHandlerTest(SimpleTestCase):
+    def test_polling_error_without_update(self):
+        dispatcher = mock.Mock()
+        BotCommand().add_handlers(dispatcher)
+        handler = dispatcher.add_error_handler.call_args.args[0]
+        try:
+            raise NetworkError('Bad Gateway')
+        except NetworkError as error:
+            with mock.patch('app.management.commands.bot.get_reporter') as get_reporter, \
+                    self.assertLogs('app.management.commands.bot', 'ERROR'), self.assertRaises(NetworkError):
+                handler(None, mock.Mock(error=error))
+            get_reporter.return_value.report.assert_called_once_with(error, '')
+
+
+class ErrorReporterTest(SimpleTestCase):
+    @staticmethod
+    def fail(message):
+        try:
+            raise ValueError(message)
+        except ValueError as e:
+            return e
+
+    def test_digest_per_fingerprint_and_interval(self):
+        sent = []
+        reporter = ErrorReporter(sent.append, interval=60, samples=3, background=False)
+        fingerprints = {reporter.report(self.fail(f'bad {i}'), ' in the chat <i>g</i>') for i in range(5)}
+        self.assertEqual(len(fingerprints), 1)
+        self.assertIn('ValueError at app/tests.py:', fingerprints.pop())
+        self.assertEqual(reporter.flush(now=1000), 1)
+        self.assertIn('bad 4', sent[0])
+        self.assertIn('in the chat <i>g</i>', sent[0])
+        self.assertEqual(len(reporter.samples), 3)
+
+        reporter.report(self.fail('<again>'))
+        self.assertEqual(reporter.flush(now=1030), 0)
+        reporter.report(self.fail('<again>'))
+        self.assertEqual(reporter.flush(now=1060), 1)
+        self.assertIn('repeated 2 times in the last 60s (7 since start)', sent[1])
+        self.assertIn('&lt;again&gt;', sent[1])
+        self.assertEqual(reporter.flush(now=2000), 0)
+
+    @override_settings(ERROR_REPORTING={'CHATS': [-1, -2]})
+    def test_digest_is_repeated_after_flood_control(self):
+        sender = mock.Mock()
+        sender.send_message.side_effect = [RetryAfter(3), True, True]
+        with mock.patch('app.sender.get_sender', return_value=sender), \
+                mock.patch('app.errors.threading.Timer') as timer:
+            ErrorReporter.from_settings().send('digest')
+        timer.assert_called_once_with(3, mock.ANY, ('digest', [-1]))
+        timer.return_value.start.assert_called_once_with()
+        _, send, args = timer.call_args.args
+        send(*args)
+        self.assertEqual([c.args[0] for c in sender.send_message.call_args_list], [-1, -2, -1])
+
+
+@override_settings(AUDIT={'ENABLED': False})
+class SendRequestTest(TestCase):
+    def setUp(self):
+        self.addCleanup(chat_remap._cache.clear)
+        models.guild_cache.clear()
+        self.addCleanup(models.guild_cache.clear)
+        patcher = mock.patch('telegram.utils.request.Request.post')
+        self.post = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('app.sender.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.request = SendRequest(retries=2)
+
+    def test_migrated_chat_is_remapped(self):
+        guild = Guild.objects.create(name='g', chat_id='-1')
+        self.post.side_effect = [ChatMigrated(-100), True, True]
+        url = 'https://api.telegram.org/bot1:t/sendMessage'
+        self.request.post(url, {'chat_id': '-1', 'text': 'a'})
+        self.request.post(url, {'chat_id': -1, 'text': 'b'})
+        self.assertEqual([c.args[1]['chat_id'] for c in self.post.call_args_list], ['-1', -100, -100])
+        self.assertEqual(Guild.get_by_chat_id(-100).pk, guild.pk)
+
+    @staticmethod
+    def refused():
+        """NetworkError the way Request._request_wrapper raises it when the connection is refused"""
+        reason = urllib3.exceptions.NewConnectionError(None, 'Connection refused')
+        try:
+            raise urllib3.exceptions.MaxRetryError(None, '/bot1:t/sendMessage', reason)
+        except urllib3.exceptions.HTTPError as error:
+            try:
+                raise NetworkError(f'urllib3 HTTPError {error}')
+            except NetworkError as e:
+                return e
+
+    def test_transient_errors_are_retried(self):
+        self.post.side_effect = [NetworkError('reset'), TimedOut(), {'id': 1}]
+        self.assertEqual(self.request.post('https://api.telegram.org/bot1:t/getChat', {'chat_id': -1}), {'id': 1})
+        self.assertEqual(self.sleep.call_count, 2)
+
+        self.post.side_effect = [self.refused(), True]
+        self.assertTrue(self.request.post('https://api.telegram.org/bot1:t/sendMessage', {'chat_id': -1, 'text': 'a'}))
+        self.assertEqual(self.sleep.call_count, 3)
+
+        # the message may have been delivered
+        for error in [TimedOut(), NetworkError('Bad Gateway'), NetworkError('urllib3 HTTPError connection reset')]:
+            self.post.side_effect = [error]
+            with self.assertRaises(NetworkError):
+                self.request.post('https://api.telegram.org/bot1:t/sendMessage', {'chat_id': -1, 'text': 'a'})
+        self.post.side_effect = [BadRequest('chat not found')]
+        with self.assertRaises(BadRequest):
+            self.request.post('https://api.telegram.org/bot1:t/getChat', {'chat_id': -1})
+        self.assertEqual(self.sleep.call_count, 3)
+
+
+class CallOrDeferTest(SimpleTestCase):
+    def setUp(self):
+        self.job_queue = mock.Mock()
+        self.bot = mock.Mock()
+
+    def test_sent(self):
+        sent = []
+        self.bot.send_message.return_value = 'message'
+        self.assertEqual(send_or_defer(self.bot, self.job_queue, -1, 'a', parse_mode='HTML'), 'message')
+        self.assertEqual(call_or_defer(self.job_queue, self.bot.send_message, -1, 'b', on_sent=sent.append), 'message')
+        self.assertEqual(sent, ['message'])
+        self.bot.send_message.assert_called_with(-1, 'b')
+        self.job_queue.run_once.assert_not_called()
+
+    def test_deferred_by_flood_control(self):
+        sent = []
+        self.bot.send_message.side_effect = [RetryAfter(10), RetryAfter(5), 'message']
+        self.assertIsNone(call_or_defer(self.job_queue, self.bot.send_message, -1, 'a', on_sent=sent.append,
+                                        parse_mode='HTML'))
+        for delay in [10, 5]:
+            callback, when = self.job_queue.run_once.call_args.args
+            self.assertTrue(delay <= when <= delay * 1.2)
+            callback(mock.Mock())
+        self.assertEqual(self.job_queue.run_once.call_count, 2)
+        self.assertEqual(sent, ['message'])
+        self.assertEqual(self.bot.send_message.call_args_list, [mock.call(-1, 'a', parse_mode='HTML')] * 3)
+
+
+@override_settings(AUDIT={'ENABLED': False})
+class WriterTest(TestCase):
+    def test_updates_with_the_same_values_are_merged(self):
+        users = [TelegramUser.objects.create(django=User.objects.create(username=f'u{i}'), chat_id=str(i))
+                 for i in range(3)]
+        writes = [('update', TelegramUser, (('first_name', 'a'),), [users[0].pk]),
+                  ('update', TelegramUser, (('first_name', 'a'),), [users[1].pk]),
+                  ('update', TelegramUser, (('first_name', 'b'),), [users[2].pk])]
+        with CaptureQueriesContext(connection) as queries:
+            Writer._apply(writes)
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('UPDATE')]), 2)
+        names = TelegramUser.objects.order_by('pk').values_list('first_name', flat=True)
+        self.assertEqual(list(names), ['a', 'a', 'b'])
+
+    @override_settings(WRITE_BATCHING={'ENABLED': True, 'MAX_BATCH': 100, 'MAX_DELAY': 0.05})
+    def test_concurrent_writes_share_a_transaction(self):
+        batches = []
+        writer = Writer()
+        with mock.patch.object(Writer, '_apply', side_effect=lambda writes: batches.append(writes)):
+            threads = [threading.Thread(target=writer.update, args=(Notification, [i]), kwargs={'notified': True})
+                       for i in range(10)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(sum(len(b) for b in batches), 10)
+        self.assertLess(len(batches), 10)
+
+    @override_settings(WRITE_BATCHING={'ENABLED': True, 'MAX_BATCH': 100, 'MAX_DELAY': 0.05, 'TIMEOUT': 1})
+    def test_writes_inside_a_transaction_are_inline(self):
+        user = TelegramUser.objects.create(django=User.objects.create(username='u'), chat_id='1')
+        writer = Writer()
+        with transaction.atomic():
+            writer.update(TelegramUser, [user.pk], first_name='a')
+            user.last_name = 'b'
+            writer.save(user, ['last_name'])
+        self.assertIsNone(writer._thread)
+        self.assertEqual(TelegramUser.objects.values_list('first_name', 'last_name').get(pk=user.pk), ('a', 'b'))
+
+
+class SqliteBackendTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_dict = dict(connection.settings_dict, **settings.DATABASE_PROFILES['sqlite_production'],
+                             NAME=os.path.join(directory.name, 'db.sqlite3'))
+        connections['profile'] = DatabaseWrapper(settings_dict, alias='profile')
+        self.addCleanup(connections.__delitem__, 'profile')
+        self.addCleanup(connections['profile'].close)
+
+    def test_production_profile(self):
+        db = connections['profile']
+        with db.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+        with CaptureQueriesContext(db) as queries, transaction.atomic(using='profile'):
+            self.assertTrue(db.connection.in_transaction)
+        self.assertEqual(queries[0]['sql'], 'BEGIN IMMEDIATE')
+
+
+@override_settings(WRITE_BATCHING={'ENABLED': True, 'MAX_BATCH': 100, 'MAX_DELAY': 0.01, 'TIMEOUT': 1})
+class WriterThreadTest(SimpleTestCase):
+    def setUp(self):
+        self.batches = []
+        patcher = mock.patch.object(Writer, '_apply', side_effect=lambda writes: self.batches.append(writes))
+        self.apply = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.writer = Writer()
+
+    def test_writer_survives_errors(self):
+        with mock.patch('app.writes.close_old_connections', side_effect=[RuntimeError('closed'), None]), \
+                self.assertLogs('app.writes', 'ERROR'):
+            self.writer.update(Notification, [1], notified=True)
+            self.writer.update(Notification, [2], notified=True)
+        self.assertEqual(len(self.batches), 2)
+
+    def test_wait_is_limited(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.apply.side_effect = lambda writes: release.wait(5)
+        with override_settings(WRITE_BATCHING={'ENABLED': True, 'TIMEOUT': 0.05}), \
+                self.assertRaises(FutureTimeoutError):
+            self.writer.update(Notification, [1], notified=True)
+
+    def test_flush(self):
+        self.writer.flush()
+        self.apply.side_effect = lambda writes: (time.sleep(0.01), self.batches.append(writes))
+        for i in range(5):
+            self.writer.update(Notification, [i], wait=False, notified=True)
+        self.writer.flush(timeout=1)
+        self.assertEqual(sum(len([w for w in b if w[0] == 'update']) for b in self.batches), 5)
+
+
+worker_runs = []
+
+
+def record_worker_run(fail=False):
+    time.sleep(0.02)
+    worker_runs.append((os.getpid(), threading.current_thread().name))
+    if fail:
+        raise ValueError('failed job')
+    return 'done'
+
+
+class ThreadedWorkerTest(SimpleTestCase):
+    def test_jobs_run_on_the_thread_pool(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('fakeredis is not installed')
+        worker_runs.clear()
+        redis = fakeredis.FakeRedis()
+        queue = RQQueue('threaded', connection=redis)
+        jobs = [queue.enqueue(record_worker_run, fail=i == 0) for i in range(8)]
+
+        worker = ThreadedWorker(['threaded'], redis, concurrency=4)
+        with mock.patch('os.fork', side_effect=AssertionError('forked')) as fork, \
+                self.assertLogs('app.worker', 'ERROR') as logs:
+            worker.work(burst=True)
+        fork.assert_not_called()
+        self.assertEqual(len(logs.records), 1)
+
+        self.assertEqual((worker.processed, worker.failed), (8, 1))
+        self.assertEqual({pid for pid, _ in worker_runs}, {os.getpid()})
+        names = {name for _, name in worker_runs}
+        self.assertTrue(all(name.startswith('worker') for name in names))
+        self.assertGreater(len(names), 1)
+        self.assertEqual([job.get_status() for job in jobs], [JobStatus.FAILED] + [JobStatus.FINISHED] * 7)
+        self.assertEqual(jobs[1].result, 'done')
+        self.assertEqual(len(StartedJobRegistry('threaded', connection=redis)), 0)
+        self.assertEqual(FailedJobRegistry('threaded', connection=redis).get_job_ids(), [jobs[0].id])
+
+
+class InteractionStoreTest(SimpleTestCase):
+    def check_store(self, store):
+        store.put(-1, 10, 'collect', ['a', 'b'])
+        self.assertEqual(store.pop(-1, 10), ('collect', ['a', 'b']))
+        self.assertIsNone(store.pop(-1, 10))
+        for message_id in range(5):
+            store.put(-1, message_id, 'collect', [])
+        self.assertIsNone(store.pop(-1, 0))
+        self.assertEqual(store.pop(-1, 4), ('collect', []))
+
+    def test_memory(self):
+        self.check_store(MemoryInteractionStore(maxsize=3))
+
+    def test_redis(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('fakeredis is not installed')
+        redis = fakeredis.FakeRedis()
+        with mock.patch('app.interactions.get_redis', return_value=redis):
+            self.check_store(RedisInteractionStore(maxsize=3))
+        self.assertEqual(redis.zcard(RedisInteractionStore.INDEX_KEY), 2)
+
+
+class ShardingTest(SimpleTestCase):
+    def test_hash_ring(self):
+        ring = HashRing(4)
+        shards = [ring.get_shard(-1000 - i) for i in range(1000)]
+        self.assertEqual(shards, [HashRing(4).get_shard(-1000 - i) for i in range(1000)])
+        self.assertEqual(set(shards), {0, 1, 2, 3})
+        bigger = HashRing(5)
+        moved = [i for i in range(1000) if bigger.get_shard(-1000 - i) != shards[i]]
+        # only chats which went to the new shard have moved
+        self.assertTrue(all(bigger.get_shard(-1000 - i) == 4 for i in moved))
+        self.assertLess(len(moved), 400)
+
+    def test_router(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('fakeredis is not installed')
+        redis = fakeredis.FakeRedis()
+        bot = Bot('1000:sharding-test')
+        router = ShardRouter(bot, Queue(), shards=3, workers=0, use_context=True)
+        update = Update.de_json({'update_id': 1, 'message': {
+            'message_id': 1, 'date': 1600000000, 'chat': {'id': -100, 'type': 'group'}, 'text': 'hi'}}, bot)
+        with mock.patch('app.sharding.get_redis', return_value=redis):
+            router.process_update(update)
+        routed = redis.lpop(KEY.format(router.ring.get_shard(-100)))
+        self.assertEqual(Update.de_json(json.loads(routed), bot).message.text, 'hi')
+
+
+class CacheInvalidationTest(SimpleTestCase):
+    def test_other_processes_drop_their_copies(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('fakeredis is not installed')
+        server = fakeredis.FakeServer()
+        caches = []
+        with mock.patch('app.cache.get_redis', side_effect=lambda *_: fakeredis.FakeRedis(server=server)):
+            for _ in range(2):
+                invalidation, cache = Invalidation(), LRUCache()
+                invalidation.register('membership', cache)
+                cache.set((1, 2), 'membership')
+                cache.set((1, 3), 'other membership')
+                invalidation.start()
+                self.addCleanup(invalidation.stop)
+                caches.append((invalidation, cache))
+            time.sleep(0.1)  # let the listeners subscribe
+            (sender, own), (_, other) = caches
+            sender.publish('membership', (1, 2))
+            for _ in range(50):
+                if other.get((1, 2)) is None:
+                    break
+                time.sleep(0.02)
+        self.assertIsNone(other.get((1, 2)))
+        self.assertEqual(other.get((1, 3)), 'other membership')
+        self.assertEqual(own.get((1, 2)), 'membership')
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class LogsTest(SimpleTestCase):
+    @staticmethod
+    def record(name='app.test', msg='message %s', args=(1,), exc_info=None):
+        return logging.LogRecord(name, logging.INFO, __file__, 1, msg, args, exc_info)
+
+    def test_rate_limit(self):
+        log_filter = RateLimitFilter(rate=2, per=60)
+        with mock.patch('app.logs.time.monotonic', return_value=1000):
+            self.assertEqual([log_filter.filter(self.record()) for _ in range(5)], [True, True, False, False, False])
+            self.assertTrue(log_filter.filter(self.record(name='app.other')))
+        with mock.patch('app.logs.time.monotonic', return_value=1060):
+            record = self.record()
+            self.assertTrue(log_filter.filter(record))
+            self.assertTrue(log_filter.filter(self.record()))
+            self.assertFalse(log_filter.filter(self.record()))
+        self.assertEqual(record.getMessage(), '(3 records dropped by rate limit) message 1')
+
+    def test_json_formatter(self):
+        try:
+            raise ValueError('bad')
+        except ValueError:
+            record = self.record(msg='тест %s', args=('args',), exc_info=sys.exc_info())
+        data = json.loads(JSONFormatter().format(record))
+        self.assertEqual((data['level'], data['logger'], data['message']), ('INFO', 'app.test', 'тест args'))
+        self.assertRegex(data['time'], r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}$')
+        self.assertIn('ValueError: bad', data['exc_info'])
+
+    def test_rotated_files_are_compressed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bot.log')
+            handler = GzipTimedRotatingFileHandler(path, when='midnight')
+            handler.emit(self.record(msg='before rotation', args=()))
+            handler.doRollover()
+            handler.emit(self.record(msg='after rotation', args=()))
+            handler.close()
+            rotated = [name for name in os.listdir(directory) if name != 'bot.log']
+            self.assertEqual(len(rotated), 1)
+            self.assertTrue(rotated[0].endswith('.gz'))
+            with gzip.open(os.path.join(directory, rotated[0]), 'rt') as f:
+                self.assertEqual(f.read(), 'before rotation\n')
+            with open(path) as f:
+                self.assertEqual(f.read(), 'after rotation\n')
+
+    def test_queue_handler(self):
+        target = ListHandler()
+        handler = QueueListenerHandler([target], maxsize=2)
+        handler.handle(self.record())
+        handler.stop()
+        self.assertEqual([r.getMessage() for r in target.records], ['message 1'])
+
+        # nobody reads the queue now
+        for i in range(5):
+            handler.handle(self.record(args=(i,)))
+        self.assertEqual(handler.dropped, 3)
+        self.assertEqual(handler.queue.qsize(), 2)
+
+
+class TracingTest(TestCase):
+    @override_settings(TRACING={'SAMPLE_RATE': 1})
+    def test_span(self):
+        @trace('inner')
+        def inner():
+            return Guild.objects.count()
+
+        @trace('handler')
+        def handler():
+            Guild.objects.exists()
+            return inner()
+
+        with mock.patch('app.tracing.metrics.registry') as registry:
+            self.assertEqual(handler(), 0)
+        counters = {(c.args[0], c.kwargs['command']): c.args[1] for c in registry.inc.call_args_list}
+        # nested spans are merged into the outer one
+        self.assertEqual(counters[('handler_queries_total', 'handler')], 2)
+        self.assertEqual(counters[('handler_api_calls_total', 'handler')], 0)
+        self.assertEqual(registry.observe.call_count, 1)
+
+    @override_settings(TRACING={'SAMPLE_RATE': 0})
+    def test_not_sampled(self):
+        with mock.patch('app.tracing.metrics.registry') as registry:
+            trace('handler')(Guild.objects.count)()
+        registry.observe.assert_not_called()
+
+
+class WebhookTest(AsyncHTTPTestCase):
+    update = {
+        'update_id': 1,
+        'message': {
+            'message_id': 1,
+            'date': 1600000000,
+            'chat': {'id': -100, 'type': 'supergroup', 'title': 'guild'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'User'},
+            'text': '/collect',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 8}],
+        },
+    }
+
+    def get_app(self):
+        self.update_queue = Queue(maxsize=1)
+        return WebhookApplication('telegram', Bot('1000:webhook-test'), self.update_queue, secret_token='secret')
+
+    def post(self, body, token='secret'):
+        return self.fetch('/telegram', method='POST', body=body, headers={SECRET_HEADER: token})
+
+    def test_update_is_queued(self):
+        response = self.post(json.dumps(self.update))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.update_queue.get_nowait().message.text, '/collect')
+
+    def test_wrong_secret_token(self):
+        self.assertEqual(self.post(json.dumps(self.update), token='wrong').code, 403)
+        self.assertTrue(self.update_queue.empty())
+
+    def test_malformed_update(self):
+        self.assertEqual(self.post('not json').code, 400)
+
+    def test_full_queue(self):
+        self.assertEqual(self.post(json.dumps(self.update)).code, 200)
+        response = self.post(json.dumps(dict(self.update, update_id=2)))
+        self.assertEqual(response.code, 503)
+        self.assertEqual(self.update_queue.qsize(), 1)
+
+
+class ConcurrentDispatcherTest(SimpleTestCase):
+    def test_chat_order_is_kept(self):
+        handled = []
+
+        def handler(update, context):
+            time.sleep(0.01)
+            handled.append((update.effective_chat.id, update.update_id, threading.current_thread().name))
+
+        bot = Bot('1000:dispatcher-test')
+        dispatcher = ConcurrentDispatcher(bot, Queue(), workers=0, update_workers=2, use_context=True)
+        dispatcher.add_handler(TypeHandler(Update, handler))
+        thread = threading.Thread(target=dispatcher.start, daemon=True)
+        thread.start()
+        for update_id in range(20):
+            chat_id = -100 - update_id % 2
+            dispatcher.update_queue.put(Update.de_json({'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': 1600000000, 'chat': {'id': chat_id, 'type': 'group'}}}, bot))
+        dispatcher.update_queue.join()
+        for queue in dispatcher._worker_queues:
+            queue.join()
+        dispatcher.stop()
+        thread.join()
+
+        self.assertEqual(len(handled), 20)
+        for chat_id in (-100, -101):
+            updates = [(update_id, name) for chat, update_id, name in handled if chat == chat_id]
+            self.assertEqual([update_id for update_id, _ in updates], sorted(update_id for update_id, _ in updates))
+            self.assertEqual(len({name for _, name in updates}), 1)
+        self.assertEqual(len({name for _, _, name in handled}), 2)
@@ -0,0 +1,183 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from app.scheduler import BaseSchedulerBackend
+from app.tasks import notification_job
+
+logger = logging.getLogger(__name__)
+
+
+class TimerEngine(object):
+    """
+    heap of timers served by one thread. The thread sleeps exactly until the nearest timer, so timers fire with
+    sub-second precision. Fired timers are passed to `callback(job_id, payload, timestamp)` in a thread pool.
+    A job id has at most one timer: scheduling it again replaces the old one. Cancelled and replaced timers are
+    marked as removed, stay in the heap and are skipped when they come up
+    """
+
+    REMOVED = object()  # job id of a removed heap entry
+
+    def __init__(self, callback, workers=4):
+        self.callback = callback
+        self._heap = []  # [timestamp, counter, job_id, payload] entries
+        self._entries = {}  # job_id -> the live entry
+        self._removed = 0
+        self._firing = set()  # job ids of the timers whose callback is running
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='timer')
+        self._thread = None
+        self._running = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _push(self, timestamp, job_id, payload):
+        self._remove(job_id)
+        entry = [timestamp, next(self._counter), job_id, payload]
+        self._entries[job_id] = entry
+        return entry
+
+    def _remove(self, job_id):
+        entry = self._entries.pop(job_id, None)
+        if entry is None:
+            return False
+        entry[2] = self.REMOVED
+        self._removed += 1
+        return True
+
+    def schedule(self, timestamp, job_id, payload):
+        with self._cond:
+            entry = self._push(timestamp, job_id, payload)
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                self._cond.notify()
+
+    def schedule_many(self, timers):
+        """timers are (timestamp, job_id, payload) tuples"""
+        with self._cond:
+            for timestamp, job_id, payload in timers:
+                self._heap.append(self._push(timestamp, job_id, payload))
+            heapq.heapify(self._heap)
+            self._compact()
+            self._cond.notify()
+
+    def cancel(self, job_id):
+        """returns False if there is no timer with `job_id`"""
+        with self._cond:
+            if not self._remove(job_id):
+                return False
+            self._compact()
+            return True
+
+    def _compact(self):
+        if self._removed > 1000 and self._removed * 2 > len(self._heap):
+            self._heap = [entry for entry in self._heap if entry[2] is not self.REMOVED]
+            heapq.heapify(self._heap)
+            self._removed = 0
+
+    def job_ids(self):
+        with self._cond:
+            return set(self._entries)
+
+    def firing_job_ids(self):
+        with self._cond:
+            return set(self._firing)
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='timer-engine', daemon=True)
+        self._thread.start()
+
+    def stop(self, wait=True):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown(wait=wait)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._heap:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                timestamp, _, job_id, payload = heapq.heappop(self._heap)
+                if job_id is self.REMOVED:
+                    self._removed -= 1
+                    continue
+                del self._entries[job_id]
+                self._firing.add(job_id)
+            self._executor.submit(self._fire, job_id, payload, timestamp)
+
+    def _fire(self, job_id, payload, timestamp):
+        try:
+            self.callback(job_id, payload, timestamp)
+        except Exception:
+            logger.exception('timer {} failed'.format(job_id))
+        finally:
+            with self._cond:
+                self._firing.discard(job_id)
+
+
+class TimerSchedulerBackend(BaseSchedulerBackend):
+    """
+    in-process alternative to rq-scheduler: notifications fire in the process which called `start()` (the bot).
+    Pending notifications are the state, so the engine loads them from the Notification table on start
+    """
+
+    def __init__(self):
+        self.engine = TimerEngine(self.run_job, workers=getattr(settings, 'NOTIFICATION_TIMER_WORKERS', 4))
+
+    def execute(self, to_enqueue, to_cancel):
+        for job_id in to_cancel:
+            self.engine.cancel(job_id)
+        if len(to_enqueue) == 1:
+            at_time, notification_pk, job_id = to_enqueue[0]
+            self.engine.schedule(at_time.timestamp(), job_id, notification_pk)
+        elif to_enqueue:
+            self.engine.schedule_many((at_time.timestamp(), job_id, pk) for at_time, pk, job_id in to_enqueue)
+
+    def scheduled_job_ids(self):
+        return self.engine.job_ids()
+
+    def running_job_ids(self):
+        return self.engine.firing_job_ids()
+
+    def drop_orphans(self, job_ids):
+        return sum(self.engine.cancel(job_id) for job_id in job_ids)
+
+    def load_pending(self):
+        from app.models import Notification
+        pending = Notification.objects.pending().exclude(job_id='').values_list('time', 'pk', 'job_id')
+        timers = [(at_time.timestamp(), job_id, pk) for at_time, pk, job_id in pending.iterator()]
+        self.engine.schedule_many(timers)
+        return len(timers)
+
+    def start(self):
+        logger.info('timer scheduler: loaded {} pending notifications'.format(self.load_pending()))
+        self.engine.start()
+
+    def run_job(self, job_id, notification_pk, timestamp):
+        logger.info('timer {} fired {:.3f}s late'.format(job_id, time.time() - timestamp))
+        close_old_connections()
+        try:
+            notification_job(notification_pk)
+        finally:
+            close_old_connections()
@@ -0,0 +1,184 @@
+"""
+display names as custom administrator titles in guild chats. Whether the bot may set titles in a chat (it needs
+the can_promote_members and can_change_info rights) is cached per chat for BOT_RIGHTS['TTL'] seconds. Bot API 4.8
+(python-telegram-bot 12.7) has no my_chat_member updates, so the entry is also dropped when the bot joins or leaves
+the chat and when a title call fails
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from telegram import ChatMember, TelegramError
+from telegram.error import RetryAfter
+
+from app.cache import LRUCache
+from app.sender import RateLimiter, get_sender
+
+logger = logging.getLogger(__name__)
+
+SET = 'set'
+UNCHANGED = 'unchanged'
+FAILED = 'failed'
+CREATOR = 'creator'
+NO_RIGHTS = 'no_rights'
+
+
+def _rights_cache():
+    config = getattr(settings, 'BOT_RIGHTS', {})
+    return LRUCache(maxsize=config.get('MAXSIZE', 10000), ttl=config.get('TTL', 600))
+
+
+rights_cache = _rights_cache()  # chat_id -> bot can set titles
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='titles')
+_sync_limiter = None
+_syncs = {}  # chat_id -> time.monotonic() of the last guild sync
+_lock = threading.Lock()
+
+
+def invalidate(chat_id):
+    rights_cache.delete(int(chat_id))
+
+
+def _can_set_titles(member):
+    return bool(member.can_promote_members and member.can_change_info)
+
+
+def sync_title(bot, chat_id, user_chat_id, title):
+    """
+    makes `title` the custom title of the user in the chat (promoting the user with can_change_info if needed),
+    returns SET, UNCHANGED, FAILED, CREATOR (the creator's title can't be set by bots) or NO_RIGHTS
+    """
+    chat_id = int(chat_id)
+    try:
+        can_set = rights_cache.get(chat_id)
+        if can_set is None:
+            # the user is probably needed too, both lookups go in parallel
+            bot_member = _executor.submit(bot.get_chat_member, chat_id, bot.id)
+            user_member = _executor.submit(bot.get_chat_member, chat_id, user_chat_id)
+            can_set = _can_set_titles(bot_member.result())
+            rights_cache.set(chat_id, can_set)
+            if not can_set:
+                return NO_RIGHTS
+            user_member = user_member.result()
+        elif not can_set:
+            return NO_RIGHTS
+        else:
+            user_member = bot.get_chat_member(chat_id, user_chat_id)
+
+        if user_member.status == ChatMember.CREATOR:
+            return CREATOR
+        if user_member.status == ChatMember.ADMINISTRATOR and user_member.custom_title == title:
+            return UNCHANGED
+        if user_member.status != ChatMember.ADMINISTRATOR:
+            bot.promote_chat_member(chat_id, user_chat_id, can_change_info=True)
+        result = bot.set_chat_administrator_custom_title(chat_id, user_chat_id, title)
+    except RetryAfter:
+        raise
+    except TelegramError:
+        invalidate(chat_id)
+        raise
+    if not result:
+        invalidate(chat_id)
+    return SET if result else FAILED
+
+
+class LimitedBot(object):
+    """proxy of a Bot which passes every API call through all `limiters`"""
+
+    def __init__(self, bot, *limiters):
+        self._bot = bot
+        self._limiters = limiters
+        self.id = bot.id
+
+    def __getattr__(self, name):
+        method = getattr(self._bot, name)
+
+        def call(*args, **kwargs):
+            for limiter in self._limiters:
+                limiter.acquire()
+            return method(*args, **kwargs)
+        return call
+
+
+def get_sync_limiter():
+    """limiter shared by all guild syncs of the process: TITLES_SYNC['BURST_LIMIT'] per TITLES_SYNC['TIME_LIMIT']"""
+    global _sync_limiter
+    with _lock:
+        if _sync_limiter is None:
+            config = getattr(settings, 'TITLES_SYNC', {})
+            _sync_limiter = RateLimiter(config.get('BURST_LIMIT', 30), config.get('TIME_LIMIT', 1))
+        return _sync_limiter
+
+
+def start_guild_sync(chat_id):
+    """
+    returns 0 and remembers the start if a sync of the chat's guild may start now, otherwise the number of seconds
+    left of TITLES_SYNC['COOLDOWN'] since the previous one
+    """
+    cooldown = getattr(settings, 'TITLES_SYNC', {}).get('COOLDOWN', 600)
+    with _lock:
+        now = time.monotonic()
+        started = _syncs.get(int(chat_id))
+        if started is not None and now - started < cooldown:
+            return cooldown - (now - started)
+        if len(_syncs) > 10000:
+            for key in [k for k, v in _syncs.items() if now - v >= cooldown]:
+                del _syncs[key]
+        _syncs[int(chat_id)] = now
+        return 0
+
+
+def cancel_guild_sync(chat_id):
+    """forgets the start of the chat's guild sync, so it may be repeated right away"""
+    with _lock:
+        _syncs.pop(int(chat_id), None)
+
+
+def sync_guild_titles(bot, memberships, progress=None):
+    """
+    sync_title for every GuildMembership (with its tuser and guild loaded) in TITLES_SYNC['CONCURRENCY'] threads.
+    API calls pass through the limiter shared by all syncs and the global limiter of the Sender, so concurrent syncs
+    and other messages of the process stay within Telegram's limits together. A call answered with
+    RetryAfter is repeated after the requested delay (up to TITLES_SYNC['RETRIES'] times). `progress(done, total,
+    membership, result)` is called after each membership. Returns a Counter of results ('error' for exceptions)
+    """
+    config = getattr(settings, 'TITLES_SYNC', {})
+    bot = LimitedBot(bot, get_sync_limiter(), get_sender().all_limiter)
+    retries = config.get('RETRIES', 5)
+
+    def sync(membership):
+        for attempt in range(retries + 1):
+            try:
+                return sync_title(bot, membership.guild.chat_id, membership.tuser.chat_id, membership.display_name)
+            except RetryAfter as e:
+                if attempt == retries:
+                    raise
+                logger.info(f'flood control in chat {membership.guild.chat_id}, retry in {e.retry_after}s')
+                time.sleep(e.retry_after)
+
+    memberships = list(memberships)
+    for chat_id in {int(m.guild.chat_id) for m in memberships}:
+        # one rights lookup per chat instead of one per thread which finds the cache empty. Always a fresh one: the
+        # sync usually follows granting the rights, of which the bot gets no update, so a cached False may be stale
+        invalidate(chat_id)
+        try:
+            rights_cache.set(chat_id, _can_set_titles(bot.get_chat_member(chat_id, bot.id)))
+        except TelegramError as e:
+            logger.warning(f'can\'t get bot rights in chat {chat_id}: {e}')
+    summary = Counter()
+    with ThreadPoolExecutor(max_workers=config.get('CONCURRENCY', 4), thread_name_prefix='sync_titles') as pool:
+        futures = {pool.submit(sync, m): m for m in memberships}
+        for done, future in enumerate(as_completed(futures), 1):
+            membership = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.warning(f'can\'t sync title of GuildMembership pk {membership.pk}: {e}')
+                result = 'error'
+            summary[result] += 1
+            if progress is not None:
+                progress(done, len(memberships), membership, result)
+    return summary
@@ -0,0 +1,86 @@
+"""
+tracing of bot handlers: a sampled handler call is a span which records its wall time, ORM queries (count and
+time) and Bot API requests (count and time). Spans are aggregated per command in app.metrics, so every bot process
+contributes and `./manage.py trace_report` shows the slowest commands
+"""
+import random
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+from app import metrics
+from app.sender import SendRequest
+
+_local = threading.local()
+
+
+class Span(object):
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.query_time = 0
+        self.api_calls = 0
+        self.api_time = 0
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_time += time.perf_counter() - start
+
+    def __enter__(self):
+        self._parent = getattr(_local, 'span', None)
+        _local.span = self
+        self._queries = connection.execute_wrapper(self.execute_wrapper)
+        self._queries.__enter__()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self._start
+        self._queries.__exit__(*exc_info)
+        _local.span = self._parent
+        registry = metrics.registry
+        registry.observe('handler_seconds', wall, command=self.name)
+        registry.inc('handler_queries_total', self.queries, command=self.name)
+        registry.inc('handler_query_seconds_total', self.query_time, command=self.name)
+        registry.inc('handler_api_calls_total', self.api_calls, command=self.name)
+        registry.inc('handler_api_seconds_total', self.api_time, command=self.name)
+        registry.flush()
+
+
+def current_span():
+    return getattr(_local, 'span', None)
+
+
+def trace(name):
+    """decorator: a span named `name` around a share (TRACING['SAMPLE_RATE']) of the calls"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            rate = getattr(settings, 'TRACING', {}).get('SAMPLE_RATE', 0)
+            if current_span() is not None or rate <= 0 or random.random() >= rate:
+                return f(*args, **kwargs)
+            with Span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracedRequest(SendRequest):
+    """SendRequest which adds its Bot API calls to the current span"""
+
+    def _request_wrapper(self, *args, **kwargs):
+        span = current_span()
+        if span is None:
+            return super()._request_wrapper(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super()._request_wrapper(*args, **kwargs)
+        finally:
+            span.api_calls += 1
+            span.api_time += time.perf_counter() - start
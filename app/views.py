@@ -1,5 +1,11 @@
+from django.http import HttpResponse
 from django.shortcuts import render
 from .models import Guild
+from . import metrics
 Guild
 
 # Create your views here.
+
+
+def prometheus_metrics(request):
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,108 @@
+"""
+webhook ingestion: tornado endpoint which checks the secret token and puts updates into a bounded queue. When the
+dispatcher falls behind and the queue is full the endpoint answers 503, so Telegram keeps the update and delivers
+it again later. Locally it can be fed with recorded updates:
+
+    curl -H 'Content-Type: application/json' -H 'X-Telegram-Bot-Api-Secret-Token: <SECRET_TOKEN>' \
+         -d @update.json http://127.0.0.1:8443/telegram
+"""
+import hmac
+import json
+import logging
+from queue import Full
+
+import tornado.web
+from django.conf import settings
+from telegram import Update
+from telegram.ext import Updater
+from telegram.utils.webhookhandler import WebhookServer
+
+from app.dispatcher import build_dispatcher
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    SUPPORTED_METHODS = ('POST',)
+
+    def initialize(self, bot, update_queue, secret_token):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.secret_token = secret_token
+
+    def post(self):
+        if self.secret_token:
+            token = self.request.headers.get(SECRET_HEADER, '')
+            if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+                raise tornado.web.HTTPError(403)
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot)
+        except (ValueError, TypeError, KeyError):
+            raise tornado.web.HTTPError(400)
+        if update is None:
+            raise tornado.web.HTTPError(400)
+        try:
+            self.update_queue.put_nowait(update)
+        except Full:
+            logger.warning('update queue is full, update {} rejected'.format(update.update_id))
+            self.set_header('Retry-After', '1')
+            raise tornado.web.HTTPError(503)
+
+    def log_exception(self, typ, value, tb):
+        if not isinstance(value, tornado.web.HTTPError):
+            super().log_exception(typ, value, tb)
+
+
+class WebhookApplication(tornado.web.Application):
+
+    def __init__(self, url_path, bot, update_queue, secret_token=None):
+        if not url_path.startswith('/'):
+            url_path = '/' + url_path
+        handler_kwargs = {'bot': bot, 'update_queue': update_queue, 'secret_token': secret_token}
+        super().__init__([(r'{}/?'.format(url_path), WebhookHandler, handler_kwargs)])
+
+    def log_request(self, handler):
+        pass
+
+
+class WebhookUpdater(Updater):
+    """
+    Updater whose dispatcher reads a bounded update queue filled by WebhookApplication.
+    `start()` registers the webhook (with the secret token) if a public url is configured and serves it
+    """
+
+    def __init__(self, dispatcher, listen='127.0.0.1', port=8443, url_path='telegram', url=None,
+                 secret_token=None, max_connections=40):
+        super().__init__(dispatcher=dispatcher, workers=None, use_context=dispatcher.use_context)
+        self.listen = listen
+        self.port = port
+        self.url_path = url_path
+        self.url = url
+        self.secret_token = secret_token
+        self.max_connections = max_connections
+
+    @classmethod
+    def from_settings(cls, update_workers=1, shards=None):
+        config = getattr(settings, 'WEBHOOK', {})
+        dispatcher = build_dispatcher(update_workers, queue_size=config.get('QUEUE_SIZE', 1000), shards=shards)
+        return cls(dispatcher, listen=config.get('LISTEN', '127.0.0.1'), port=config.get('PORT', 8443),
+                   url_path=config.get('URL_PATH', 'telegram'), url=config.get('URL'),
+                   secret_token=config.get('SECRET_TOKEN') or None,
+                   max_connections=config.get('MAX_CONNECTIONS', 40))
+
+    def start(self):
+        return self.start_webhook(listen=self.listen, port=self.port, url_path=self.url_path,
+                                  webhook_url=self.url)
+
+    def _start_webhook(self, listen, port, url_path, cert, key, bootstrap_retries, clean, webhook_url,
+                       allowed_updates):
+        app = WebhookApplication(url_path, self.bot, self.update_queue, self.secret_token)
+        self.httpd = WebhookServer(listen, port, app, None)
+        if webhook_url:
+            kwargs = {'secret_token': self.secret_token} if self.secret_token else {}
+            self.bot.set_webhook(webhook_url, max_connections=self.max_connections,
+                                 allowed_updates=allowed_updates, **kwargs)
+        logger.info('webhook is listening on {}:{}/{}'.format(listen, port, url_path.lstrip('/')))
+        self.httpd.serve_forever()
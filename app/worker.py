@@ -0,0 +1,105 @@
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+from rq.exceptions import DequeueTimeout
+from rq.job import JobStatus
+from rq.queue import Queue
+from rq.registry import StartedJobRegistry, FinishedJobRegistry, FailedJobRegistry
+from rq.utils import utcnow
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESULT_TTL = 500
+
+
+class ThreadedWorker(object):
+    """
+    rq worker which runs jobs in a pool of threads inside one process instead of forking a child per job.
+    Django stays loaded and every thread keeps its DB connection (subject to CONN_MAX_AGE) between jobs.
+    Jobs have no hard timeout: rq implements it with signals, which work only in the main thread
+    """
+
+    def __init__(self, queue_names, connection, concurrency=8):
+        self.connection = connection
+        self.queues = [Queue(name, connection=connection) for name in queue_names]
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='worker')
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._stopped = threading.Event()
+        self.processed = 0
+        self.failed = 0
+        self._counters_lock = threading.Lock()
+
+    def stop(self):
+        self._stopped.set()
+
+    def work(self, burst=False, dequeue_timeout=5):
+        """take jobs until stopped (or until the queues are empty in `burst` mode)"""
+        logger.info('start threaded worker: queues {}, concurrency {}'.format(
+            ', '.join(q.name for q in self.queues), self.concurrency))
+        try:
+            while not self._stopped.is_set():
+                self._slots.acquire()
+                try:
+                    result = Queue.dequeue_any(self.queues, None if burst else dequeue_timeout,
+                                               connection=self.connection)
+                except DequeueTimeout:
+                    result = None
+                if result is None:
+                    self._slots.release()
+                    if burst:
+                        break
+                    continue
+                job, queue = result
+                self._executor.submit(self.perform_job, job, queue)
+        finally:
+            self._executor.shutdown(wait=True)
+        logger.info('stop threaded worker: {} jobs processed, {} failed'.format(self.processed, self.failed))
+
+    def perform_job(self, job, queue):
+        close_old_connections()
+        started_registry = StartedJobRegistry(queue.name, connection=self.connection)
+        ok = False
+        try:
+            with self.connection.pipeline() as pipe:
+                job.set_status(JobStatus.STARTED, pipeline=pipe)
+                started_registry.add(job, (job.timeout or queue.DEFAULT_TIMEOUT) + 60, pipeline=pipe)
+                pipe.execute()
+            job.started_at = utcnow()
+            job._result = job.perform()
+            job.ended_at = utcnow()
+            self.handle_success(job, queue, started_registry)
+            ok = True
+        except Exception:
+            job.ended_at = utcnow()
+            exc_string = traceback.format_exc()
+            logger.exception('job {} failed'.format(job.id))
+            self.handle_failure(job, queue, started_registry, exc_string)
+        finally:
+            close_old_connections()
+            with self._counters_lock:
+                self.processed += 1
+                self.failed += not ok
+            self._slots.release()
+
+    def handle_success(self, job, queue, started_registry):
+        with self.connection.pipeline() as pipe:
+            result_ttl = job.get_result_ttl(DEFAULT_RESULT_TTL)
+            if result_ttl != 0:
+                job.set_status(JobStatus.FINISHED, pipeline=pipe)
+                job.save(pipeline=pipe, include_meta=False)
+                FinishedJobRegistry(queue.name, connection=self.connection).add(job, result_ttl, pipe)
+            job.cleanup(result_ttl, pipeline=pipe, remove_from_queue=False)
+            started_registry.remove(job, pipeline=pipe)
+            pipe.execute()
+
+    def handle_failure(self, job, queue, started_registry, exc_string):
+        with self.connection.pipeline() as pipe:
+            job.set_status(JobStatus.FAILED, pipeline=pipe)
+            started_registry.remove(job, pipeline=pipe)
+            FailedJobRegistry(queue.name, connection=self.connection).add(
+                job, ttl=job.failure_ttl, exc_string=exc_string, pipeline=pipe)
+            pipe.execute()
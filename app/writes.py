@@ -0,0 +1,149 @@
+"""
+serialized hot writes. With WRITE_BATCHING['ENABLED'] the writes of all threads of a process are queued to one
+writer thread which commits everything that arrived within MAX_DELAY seconds (at most MAX_BATCH writes) in one
+transaction, merging updates of the same model with the same values into one UPDATE. Fewer and shorter write
+transactions mean less waiting for sqlite's single write lock. Callers wait for the commit (at most TIMEOUT
+seconds) unless `wait=False`; the queued writes are flushed at exit. Without WRITE_BATCHING, and inside
+transaction.atomic (where a write belongs to the caller's transaction, which holds the write lock already), the
+writes are done right away in the calling thread
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from queue import Empty, Queue
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+logger = logging.getLogger(__name__)
+
+
+def _config():
+    return getattr(settings, 'WRITE_BATCHING', {})
+
+
+def _inline():
+    return not _config().get('ENABLED') or connection.in_atomic_block
+
+
+class Writer(object):
+    def __init__(self):
+        self._queue = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def update(self, model, pks, wait=True, **values):
+        """model.objects.filter(pk__in=pks).update(**values)"""
+        if _inline():
+            model.objects.filter(pk__in=pks).update(**values)
+            return
+        self._submit(('update', model, tuple(sorted(values.items())), list(pks)), wait)
+
+    def save(self, obj, update_fields, wait=True):
+        """obj.save(update_fields=update_fields), the fields are read when the write is done"""
+        if _inline():
+            obj.save(update_fields=update_fields)
+            return
+        self._submit(('save', obj, tuple(update_fields)), wait)
+
+    def _submit(self, write, wait):
+        future = Future()
+        self._ensure_thread()
+        self._queue.put((write, future))
+        if wait:
+            future.result(timeout=_config().get('TIMEOUT', 30))
+        else:
+            future.add_done_callback(self._log_error)
+
+    def flush(self, timeout=None):
+        """waits until the writes queued so far are committed"""
+        if self._thread is None:
+            return
+        future = Future()
+        self._queue.put((('flush',), future))
+        future.result(timeout=timeout)
+
+    @staticmethod
+    def _log_error(future):
+        if future.exception() is not None:
+            logger.error(f'batched write failed: {future.exception()}')
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='writer', daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        config = _config()
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + config.get('MAX_DELAY', 0.005)
+        while len(batch) < config.get('MAX_BATCH', 100):
+            try:
+                batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+            except Empty:
+                break
+        return batch
+
+    @staticmethod
+    def _apply(writes):
+        updates = {}
+        saves = []
+        for write in writes:
+            if write[0] == 'update':
+                _, model, values, pks = write
+                updates.setdefault((model, values), set()).update(pks)
+            elif write[0] == 'save':
+                saves.append(write[1:])
+        with transaction.atomic():
+            for (model, values), pks in updates.items():
+                model.objects.filter(pk__in=pks).update(**dict(values))
+            for obj, update_fields in saves:
+                obj.save(update_fields=update_fields)
+
+    def _write(self, batch):
+        try:
+            self._apply([write for write, _ in batch])
+        except Exception:
+            # one bad write shouldn't fail the others
+            for write, future in batch:
+                try:
+                    self._apply([write])
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(None)
+        else:
+            for _, future in batch:
+                future.set_result(None)
+
+    def _run(self):
+        while True:
+            batch = []
+            try:
+                batch = self._next_batch()
+                self._write(batch)
+                close_old_connections()
+            except Exception as e:
+                # the thread must survive anything: without it every waiting caller would time out
+                logger.exception(f'writer failed: {e}')
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _after_fork(self):
+        self._queue = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+
+writer = Writer()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=writer._after_fork)
+# the writer thread is a daemon, `wait=False` writes still in the queue would be lost
+atexit.register(lambda: writer.flush(timeout=_config().get('TIMEOUT', 30)))
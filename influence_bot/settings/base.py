@@ -22,6 +22,8 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__fil
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = ''
 TELEGRAM_TOKEN = ''
+# Bot API server, None means the official https://api.telegram.org/bot (the benchmark points it to a local fake)
+TELEGRAM_BASE_URL = None
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
@@ -85,6 +87,32 @@ DATABASES = {
     }
 }
 
+# Storage profile applied to DATABASES['default'] (choose it in local settings). 'sqlite_production' is for the bot,
+# the worker and the scheduler sharing one db.sqlite3: WAL journal (readers don't block the writer),
+# synchronous=NORMAL, transactions which wait up to `timeout` seconds for the write lock (see app/sqlite) and
+# persistent connections
+DATABASE_PROFILE = 'default'
+DATABASE_PROFILES = {
+    'default': {},
+    'sqlite_production': {
+        'ENGINE': 'app.sqlite',
+        'CONN_MAX_AGE': 10 * 60,
+        'OPTIONS': {
+            'timeout': 20,
+            'pragmas': {'journal_mode': 'WAL', 'synchronous': 'NORMAL'},
+        },
+    },
+}
+# Hot writes (notification status, TelegramUser profile refreshes) are committed in batches by one writer thread per
+# process (see app/writes.py). Meant to be enabled together with the 'sqlite_production' profile. Callers wait for
+# their write at most TIMEOUT seconds
+WRITE_BATCHING = {
+    'ENABLED': False,
+    'MAX_BATCH': 100,
+    'MAX_DELAY': 0.005,
+    'TIMEOUT': 30,
+}
+
 RQ_QUEUES = {
     'default': {
         'HOST': 'localhost',
@@ -95,6 +123,102 @@ RQ_QUEUES = {
     }
 }
 
+# Backend which fires notifications: 'rq' (rq-scheduler + rq worker processes) or 'timer' (in-process timers with
+# sub-second precision, they run inside the bot process)
+NOTIFICATION_SCHEDULER = 'rq'
+NOTIFICATION_TIMER_WORKERS = 4
+# Re-enqueue lost notification jobs and drop orphan ones when the bot starts (see reconcile_notifications command)
+RECONCILE_NOTIFICATIONS_ON_STARTUP = False
+# Notifications for the same chat which are due within this number of seconds are sent as one message (0 - never)
+NOTIFICATION_COALESCE_WINDOW = 5
+
+# Outgoing messages from notifications (see app/sender.py). Limits are Telegram's: ~30 messages per second overall
+# and ~20 messages per minute into the same group. RETRIES - attempts after transient network errors
+TELEGRAM_SENDER = {
+    'CON_POOL_SIZE': 8,
+    'RETRIES': 3,
+    'ALL_BURST_LIMIT': 30,
+    'ALL_TIME_LIMIT': 1,
+    'GROUP_BURST_LIMIT': 20,
+    'GROUP_TIME_LIMIT': 60,
+}
+
+# Guild, TelegramUser and GuildMembership instances cached by the bot (see app/models.py). TTL bounds how long
+# changes made by other processes stay unnoticed
+IDENTITY_CACHE = {
+    'MAXSIZE': 10000,
+    'TTL': 300,
+}
+
+# Commands waiting for the guild choice in a private chat (see app/interactions.py). 'redis' shares them between bot
+# processes and keeps them over restarts, 'memory' is process local
+PENDING_INTERACTIONS = {
+    'BACKEND': 'memory',
+    'MAXSIZE': 10000,
+    'TTL': 24 * 60 * 60,
+}
+
+# Whether the bot may set custom titles in a guild chat is cached per chat for TTL seconds (see app/titles.py)
+BOT_RIGHTS = {
+    'MAXSIZE': 10000,
+    'TTL': 10 * 60,
+}
+
+# Bulk title synchronization (/sync_titles, `./manage.py sync_titles`): parallel requests and the limit of Bot API
+# calls per TIME_LIMIT seconds shared by all syncs of the process (below TELEGRAM_SENDER's global limit, which they
+# also pass, to leave room for other messages); calls answered with RetryAfter are repeated up to RETRIES times.
+# /sync_titles can be repeated in a guild once per COOLDOWN seconds
+TITLES_SYNC = {
+    'CONCURRENCY': 4,
+    'BURST_LIMIT': 20,
+    'TIME_LIMIT': 1,
+    'RETRIES': 5,
+    'COOLDOWN': 10 * 60,
+}
+
+# Errors of bot handlers are sent to CHATS as digests (see app/errors.py): the first occurrence at once, repeats of
+# the same error at most once per INTERVAL seconds. SAMPLES recent errors are kept in memory
+ERROR_REPORTING = {
+    'CHATS': [163127202],
+    'INTERVAL': 5 * 60,
+    'SAMPLES': 100,
+}
+
+# Share of bot handler calls traced with wall time, ORM queries and Bot API calls (see app/tracing.py,
+# `./manage.py trace_report`)
+TRACING = {
+    'SAMPLE_RATE': 0.1,
+}
+
+# Audit trail of model changes (see app/audit.py). SINK 'db' - AuditRecord table, 'log' - the 'app.audit' logger
+AUDIT = {
+    'ENABLED': True,
+    'SINK': 'db',
+    'MODELS': ['app.TelegramUser', 'app.Guild', 'app.GuildMembership', 'app.ResourceCollection', 'app.TemporaryNPC'],
+    'BATCH_SIZE': 100,
+    'FLUSH_INTERVAL': 5,
+    'MAXSIZE': 10000,
+}
+
+# Threads processing updates of different chats in parallel (updates of one chat keep their order), 1 - sequential.
+# Overridden by `./manage.py bot --workers`
+BOT_UPDATE_WORKERS = 1
+
+# Sharded mode (see app/sharding.py): `./manage.py bot --router` and `./manage.py bot --shard K` for K in 0..BOT_SHARDS-1
+BOT_SHARDS = 1
+
+# `./manage.py bot --webhook` (see app/webhook.py). URL is the public https address given to setWebhook (leave None
+# when the webhook is registered by hand), updates beyond QUEUE_SIZE are answered with 503 and redelivered later
+WEBHOOK = {
+    'LISTEN': '127.0.0.1',
+    'PORT': 8443,
+    'URL_PATH': 'telegram',
+    'URL': None,
+    'SECRET_TOKEN': '',
+    'QUEUE_SIZE': 1000,
+    'MAX_CONNECTIONS': 40,
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -113,6 +237,9 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Loggers put records into queues ('queued_*' handlers), background threads write them to the files ('file_*'
+# handlers, rotated at midnight and gzipped). A logger producing more than 100 records per second is cut off.
+# To write JSON lines set the 'formatter' of a 'file_*' handler to 'json' in local settings
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -121,31 +248,77 @@ LOGGING = {
             'format': '{levelname} {asctime}: {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'app.logs.JSONFormatter',
+        },
+    },
+    'filters': {
+        'rate_limit': {
+            '()': 'app.logs.RateLimitFilter',
+            'rate': 100,
+            'per': 1,
+        },
     },
     'handlers': {
-        'bot': {
+        'file_bot': {
             'level': 'INFO',
-            'class': 'logging.handlers.TimedRotatingFileHandler',
+            'class': 'app.logs.GzipTimedRotatingFileHandler',
             'filename': 'logs/bot.log',
             'when': 'midnight',
             'formatter': 'simple',
         },
-        'rq': {
+        'file_rq': {
             'level': 'INFO',
-            'class': 'logging.handlers.TimedRotatingFileHandler',
+            'class': 'app.logs.GzipTimedRotatingFileHandler',
             'filename': 'logs/rq.log',
             'when': 'midnight',
             'formatter': 'simple',
         },
+        'file_audit': {
+            'level': 'INFO',
+            'class': 'app.logs.GzipTimedRotatingFileHandler',
+            'filename': 'logs/audit.log',
+            'when': 'midnight',
+            'formatter': 'simple',
+        },
+        'queued_bot': {
+            'level': 'INFO',
+            'class': 'app.logs.QueueListenerHandler',
+            'handlers': ['cfg://handlers.file_bot'],
+            'filters': ['rate_limit'],
+        },
+        'queued_rq': {
+            'level': 'INFO',
+            'class': 'app.logs.QueueListenerHandler',
+            'handlers': ['cfg://handlers.file_rq'],
+            'filters': ['rate_limit'],
+        },
+        # audit records are written in batches, a rate limit would drop them
+        'queued_audit': {
+            'level': 'INFO',
+            'class': 'app.logs.QueueListenerHandler',
+            'handlers': ['cfg://handlers.file_audit'],
+        },
     },
     'loggers': {
         'app.management.commands.bot': {
-            'handlers': ['bot'],
+            'handlers': ['queued_bot'],
             'level': 'INFO',
             'propagate': False,
         },
         'app.tasks': {
-            'handlers': ['rq'],
+            'handlers': ['queued_rq'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'app.timers': {
+            'handlers': ['queued_rq'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        # the 'log' sink of AUDIT
+        'app.audit': {
+            'handlers': ['queued_audit'],
             'level': 'INFO',
             'propagate': False,
         },
@@ -1,2 +1,4 @@
 from .base import *
 from .local import *
+
+DATABASES['default'].update(DATABASE_PROFILES[DATABASE_PROFILE])
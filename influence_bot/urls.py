@@ -16,7 +16,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from app import views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('admin/rq', include('django_rq.urls'))
+    path('admin/rq', include('django_rq.urls')),
+    path('metrics', views.prometheus_metrics),
 ]
@@ -13,12 +13,28 @@ def prepare_ignored_files():
 
 @task
 @needs(['prepare_ignored_files'])
-def runbot():
-    """run telegram bot (polling)"""
+@cmdopts([
+    ('webhook', 'w', 'receive updates with the webhook endpoint instead of polling'),
+    ('workers=', 'n', 'threads processing updates of different chats in parallel'),
+    ('router', 'r', 'pass updates to the shards instead of handling them'),
+    ('shard=', 's', 'handle updates of this shard'),
+    ('shards=', None, 'number of shards'),
+])
+def runbot(options):
+    """run telegram bot (polling or webhook)"""
     d = path("logs/")
     if not path.exists(d):
         path.mkdir(d)
-    sh("./manage.py bot")
+    args = " --webhook" if options.get('webhook') else ""
+    if options.get('workers'):
+        args += " --workers {}".format(options.workers)
+    if options.get('router'):
+        args += " --router"
+    if options.get('shard'):
+        args += " --shard {}".format(options.shard)
+    if options.get('shards'):
+        args += " --shards {}".format(options.shards)
+    sh("./manage.py bot" + args)
 
 
 @task
@@ -39,12 +55,45 @@ def runscheduler():
 
 
 @task
-def runworker():
-    """run rq worker"""
-    sh("./manage.py rqworker")
+@cmdopts([
+    ('concurrency=', 'c', 'number of jobs running at once'),
+    ('forking', 'f', 'run the stock rq worker, which forks a child per job')
+])
+def runworker(options):
+    """run notification worker"""
+    if options.get('forking'):
+        sh("./manage.py rqworker")
+    else:
+        sh("./manage.py notificationworker --concurrency {}".format(options.get('concurrency') or 8))
 
 
 @task
 def shell():
     """run django shell"""
     sh("./manage.py shell")
+
+
+@task
+@needs(['prepare_ignored_files'])
+@cmdopts([
+    ('baseline=', 'b', 'json report to compare with'),
+    ('save=', 's', 'where to save json report'),
+])
+def benchmark(options):
+    """run offline end-to-end benchmark (fakeredis and a fake Bot API)"""
+    args = ""
+    if options.get('baseline'):
+        args += " --baseline {}".format(options.baseline)
+    if options.get('save'):
+        args += " --save {}".format(options.save)
+    sh("./manage.py benchmark" + args)
+
+
+@task
+@needs(['prepare_ignored_files'])
+@cmdopts([
+    ('seconds=', 's', 'how long every process works'),
+])
+def bench_sqlite(options):
+    """bot, worker and scheduler processes on one sqlite file with every DATABASE_PROFILES entry"""
+    sh("./manage.py bench_sqlite --seconds {}".format(options.get('seconds') or 10))